@@ -1,30 +1,73 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, render_template, request, jsonify, Response, stream_with_context, g, has_request_context
 import requests
 import firebase_admin
 from firebase_admin import credentials, firestore
+from firebase_admin import auth as firebase_auth
 
 import numpy as np
 
 from io import BytesIO
 
-# TODO: Re-enable TensorFlow imports when needed aslo this one from PIL import Image
+# TODO: Re-enable TensorFlow imports when needed
 # import tensorflow_hub as hub
-# from embeddings import generate_embedding
 # from sklearn.metrics.pairwise import cosine_similarity
 
+# Image embeddings need Pillow and the embeddings module; without them the
+# vectorize routes answer 503 instead of queueing jobs that can only fail
+try:
+    from PIL import Image
+    from embeddings import generate_embedding
+except ImportError as e:
+    Image = generate_embedding = None
+    print(f"⚠️ Image embeddings disabled: {e}")
+IMAGE_EMBEDDINGS_ENABLED = generate_embedding is not None
+
 import time
-import base64
+import bisect
 import math
 import random 
 import uuid
+import hashlib
 import json
-from datetime import datetime, timedelta
+import threading
+from collections import OrderedDict, Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 
 # ======================================================
 # APP INIT
 # ======================================================
 app = Flask(__name__)
 
+# orjson-backed JSON (numpy/datetime aware); falls back to stdlib json if orjson is missing
+from json_provider import FastJSONProvider
+app.json = FastJSONProvider(app)
+app.json.sort_keys = False  # key order is irrelevant to clients and sorting costs on big payloads
+
+# Coalesces concurrent fetches of the same key (shop loads, plan lookups)
+from single_flight import SingleFlight
+# Merges concurrent /complete-sale writes of one shop into one commit
+from group_commit import GroupCommitter
+# Receipts/audit logs: local write-ahead log flushed to Firestore in the background
+from write_ahead import WriteAheadQueue
+# Idempotency-Key dedupe so a retried /complete-sale is applied once
+from idempotency import IdempotencyTable, IdempotencyConflict
+# Hot items take stock deductions on shard docs (summed on read)
+from stock_shards import SHARD_COLLECTION, WriteRateTracker, apply_shard_totals, shard_count, shard_totals
+# Integer micro-unit quantities / minor-unit money, exact conversion factors
+from fixed_point import to_micro, from_micro, to_minor, from_minor, ratio, mul_ratio, div_ratio, line_total_minor
+# FIFO batch allocation: per-request loops + NumPy engine for carts / many sales (with COGS)
+from fifo_allocation import allocate_main_item_fifo, allocate_fifo_many, allocate_selling_units_many
+# Request/span latency histograms and counters, served as Prometheus text at /metrics
+from metrics import registry as metrics_registry, span, timed, SIZE_BUCKETS
+# Counts Firestore document reads/writes/deletes/listener deliveries per request, refresh and shop
+from firestore_meter import MeteredClient
+# Background worker pool (image embedding pipeline)
+from job_queue import BatchJobQueue, QueueFull
+# Per-shop image embedding matrix (image search)
+from vector_index import ShopVectorIndex
+from embedding_codec import encode_embedding, decode_embedding
+
 
 # ======================================================
 # FIREBASE CONFIG
@@ -43,7 +86,11 @@ if not firebase_admin._apps:
     cred = credentials.Certificate(json.loads(firebase_key))
     firebase_admin.initialize_app(cred)
 
-db = firestore.client()
+# Every reference/query/batch/transaction handed out by db is metered (see /metrics);
+# FIRESTORE_METER_BYTES=0 skips the per-document size estimate
+db = MeteredClient(firestore.client(), metrics_registry,
+                   measure_bytes=os.environ.get("FIRESTORE_METER_BYTES", "1") == "1")
+firestore_meter = db.meter
 
 
 # ======================================================
@@ -62,159 +109,238 @@ print("[READY] Model loaded successfully.")
 # ======================================================
 embedding_cache_full = {
     "shops": [],
+    "search_indexes": {},  # shop_id -> token index (see build_shop_search_index)
+    "version": 0,          # bumped on every refresh; stamped on stock stream events
     "last_updated": None,
     "total_shops": 0
 }
 
-def refresh_full_item_cache():
-    """REVISED: Includes ALL items with BATCH tracking and selling units with batch links"""
-    start = time.time()
-    print("\n[INFO] Refreshing FULL shop cache (with batch tracking)...")
+cache_write_lock = threading.Lock()  # serialises installs/evictions (readers never lock)
 
-    shops_result = []
+def batch_entry(batch):
+    """Cache form of one entry of an item doc's batches array"""
+    return {
+        "batch_id": batch.get("id", f"batch_{int(time.time()*1000)}"),
+        "batch_name": batch.get("batchName", batch.get("batch_name", "Batch")),
+        "quantity": float(batch.get("quantity", 0)),
+        "remaining_quantity": float(batch.get("quantity", 0)),  # Will be updated during sales
+        "unit": batch.get("unit", "unit"),
+        "buy_price": float(batch.get("buyPrice", 0) or batch.get("buy_price", 0)),
+        "sell_price": float(batch.get("sellPrice", 0) or batch.get("sell_price", 0)),
+        "timestamp": batch.get("timestamp", 0),
+        "date": batch.get("date", ""),
+        "added_by": batch.get("addedBy", ""),
+        "selling_unit_allocations": batch.get("sellingUnitAllocations", {})  # Track allocations
+    }
 
-    for shop_doc in db.collection("Shops").stream():
-        shop_id = shop_doc.id
-        shop_data = shop_doc.to_dict()
+def selling_unit_entry(sell_unit_doc):
+    """Cache form of one sellUnits doc (with its batch links)"""
+    sell_unit_data = sell_unit_doc.to_dict() or {}
+
+    # Get batch links from selling unit (NEW)
+    batch_links = sell_unit_data.get("batchLinks", [])
+    total_units_available = 0
+
+    # Calculate total available units from batch links
+    for link in batch_links:
+        total_units_available += link.get("maxUnitsAvailable", 0) - link.get("allocatedUnits", 0)
+
+    return {
+        "sell_unit_id": sell_unit_doc.id,
+        "codes": collect_scan_codes(sell_unit_data),
+        "name": sell_unit_data.get("name", ""),
+        "conversion_factor": float(sell_unit_data.get("conversionFactor", 1.0)),
+        "sell_price": float(sell_unit_data.get("sellPrice", 0.0)),
+        "images": sell_unit_data.get("images", []),
+        "is_base_unit": sell_unit_data.get("isBaseUnit", False),
+        "thumbnail": sell_unit_data.get("images", [None])[0] if sell_unit_data.get("images") else None,
+        "created_at": sell_unit_data.get("createdAt"),
+        "updated_at": sell_unit_data.get("updatedAt"),
+        # NEW: Batch tracking for selling units
+        "batch_links": batch_links,
+        "total_units_available": total_units_available,
+        "has_batch_links": len(batch_links) > 0
+    }
+
+def load_item_embeddings(item_doc, item_name):
+    """(vectors, embeddings doc ids) of one item"""
+    embeddings = []
+    embedding_keys = []  # embeddings doc ids (image index), parallel to embeddings
+    for emb_doc in item_doc.reference.collection("embeddings").stream():
+        try:
+            vector = decode_embedding(emb_doc.to_dict())  # packed bytes or legacy list
+        except ValueError as e:
+            print(f"⚠️ Skipping embedding {emb_doc.id} of {item_name}: {e}")
+            continue
+        if vector is not None and vector.size:
+            embeddings.append(vector)
+            embedding_keys.append(emb_doc.id)
+    return embeddings, embedding_keys
+
+def load_item_selling_units(item_doc, item_name):
+    """Selling units of one item (Shops/{shop_id}/categories/{cat_id}/items/{item_id}/sellUnits)"""
+    selling_units = []
+    try:
+        sell_units_ref = item_doc.reference.collection("sellUnits")
+
+        print(f"\n🔍 Checking selling units for item: {item_name}")
+        print(f"   Item ID: {item_doc.id}")
+        print(f"   Collection path: {item_doc.reference.path}/sellUnits")
+
+        sell_units_docs = list(sell_units_ref.stream())
+
+        print(f"   Found {len(sell_units_docs)} selling units")
+
+        for sell_unit_doc in sell_units_docs:
+            selling_unit = selling_unit_entry(sell_unit_doc)
+            print(f"   Selling Unit: {selling_unit['name'] or 'No name'}")
+            print(f"     ID: {sell_unit_doc.id}")
+            print(f"     Conversion Factor: {selling_unit['conversion_factor']}")
+            print(f"     Sell Price: {selling_unit['sell_price']}")
+            selling_units.append(selling_unit)
+
+    except Exception as e:
+        print(f"❌ ERROR fetching selling units: {e}")
+        # Don't crash, just continue
+    return selling_units
+
+def item_stock_shards_ref(item_doc):
+    """Shard collection of a cached item: sales write shards under Shops/{shop}/items/{id}, not the category copy"""
+    shop_id = item_doc.reference.path.split("/")[1]
+    return db.collection("Shops").document(shop_id).collection("items").document(item_doc.id) \
+        .collection(SHARD_COLLECTION)
+
+def build_item_entry(item_doc, category_entry, cached_item=None, stock_shards=None):
+    """
+    Cache entry for one item doc. With cached_item (a listener edit of an item
+    already in the cache) its shards, embeddings and selling units are reused
+    instead of re-read: their own listeners keep them current. stock_shards
+    (shard_id -> shard doc) comes from build_shop_entry's one shard query;
+    without either, the item's shards are read.
+    """
+    item_data = item_doc.to_dict() or {}
+    item_name = item_data.get("name", "Unnamed")
+
+    # Hot items keep their deductions in shard docs: cache base + shards
+    if cached_item is not None:
+        stock_shards = cached_item.get("stock_shards", {})
+    elif stock_shards is None:
+        stock_shards = {s.id: s.to_dict() for s in item_stock_shards_ref(item_doc).stream()}
+    item_data = apply_shard_totals(item_data, stock_shards.values())
+
+    if cached_item is not None:
+        embeddings, embedding_keys = cached_item["embeddings"], cached_item["embedding_keys"]
+        selling_units = cached_item["selling_units"]
+    else:
+        embeddings, embedding_keys = load_item_embeddings(item_doc, item_name)
+        selling_units = load_item_selling_units(item_doc, item_name)
 
-        shop_entry = {
-            "shop_id": shop_id,
-            "shop_name": shop_data.get("name", ""),
-            "categories": []
+    # Get batches for this item (NEW: batch breakdown)
+    batches = item_data.get("batches", [])
+    processed_batches = [batch_entry(batch) for batch in batches]
+
+    # Calculate total stock from batches
+    total_stock_from_batches = sum(batch.get("quantity", 0) for batch in batches)
+    main_stock = float(item_data.get("stock", 0) or 0)
+
+    # Use batch total if available, otherwise use main stock
+    effective_stock = total_stock_from_batches if total_stock_from_batches > 0 else main_stock
+
+    return {
+        "item_id": item_doc.id,
+        "name": item_data.get("name", ""),
+        "thumbnail": item_data.get("images", [None])[0],
+        "sell_price": float(item_data.get("sellPrice", 0) or 0),
+        "buy_price": float(item_data.get("buyPrice", 0) or 0),
+        "stock": effective_stock,
+        "base_unit": item_data.get("baseUnit", "unit"),
+        "codes": collect_scan_codes(item_data),
+        "embeddings": embeddings,
+        "embedding_keys": embedding_keys,
+        "has_embeddings": len(embeddings) > 0,
+        "selling_units": selling_units,
+        "category_id": category_entry["category_id"],
+        "category_name": category_entry["category_name"],
+        # NEW: Batch tracking
+        "batches": processed_batches,
+        "has_batches": len(processed_batches) > 0,
+        "total_stock_from_batches": total_stock_from_batches,
+        "stock_shards": stock_shards  # shard_id -> shard doc (sharded items only)
+    }
+
+def load_shop_stock_shards(shop_id):
+    """Every stock shard of one shop in one query: item_id -> {shard_id: shard doc}"""
+    shards = {}
+    for shard_doc in shop_scoped_group_query(SHARD_COLLECTION, shop_id).stream():
+        shards.setdefault(shard_doc.reference.parent.parent.id, {})[shard_doc.id] = shard_doc.to_dict() or {}
+    return shards
+
+def build_shop_entry(shop_doc):
+    """One shop's cache entry: categories → items with batches and selling units"""
+    shop_id = shop_doc.id
+    shop_data = shop_doc.to_dict()
+
+    shop_entry = {
+        "shop_id": shop_id,
+        "shop_name": shop_data.get("name", ""),
+        "categories": []
+    }
+    stock_shards = load_shop_stock_shards(shop_id)
+
+    for cat_doc in shop_doc.reference.collection("categories").stream():
+        cat_data = cat_doc.to_dict()
+        cat_id = cat_doc.id
+
+        category_entry = {
+            "category_id": cat_id,
+            "category_name": cat_data.get("name", ""),
+            "items": []
         }
 
-        for cat_doc in shop_doc.reference.collection("categories").stream():
-            cat_data = cat_doc.to_dict()
-            cat_id = cat_doc.id
+        for item_doc in cat_doc.reference.collection("items").stream():
+            category_entry["items"].append(
+                build_item_entry(item_doc, category_entry, stock_shards=stock_shards.get(item_doc.id, {})))
 
-            category_entry = {
-                "category_id": cat_id,
-                "category_name": cat_data.get("name", ""),
-                "items": []
-            }
+        # Only skip categories that have no items at all
+        if category_entry["items"]:
+            shop_entry["categories"].append(category_entry)
 
-            for item_doc in cat_doc.reference.collection("items").stream():
-                item_data = item_doc.to_dict()
-                item_id = item_doc.id
-                item_name = item_data.get("name", "Unnamed")
-
-                # Get embeddings (if any)
-                embeddings = []
-                for emb_doc in item_doc.reference.collection("embeddings").stream():
-                    vector = emb_doc.to_dict().get("vector")
-                    if vector:
-                        embeddings.append(np.array(vector))
-
-                # Get batches for this item (NEW: batch breakdown)
-                batches = item_data.get("batches", [])
-                processed_batches = []
-                for batch in batches:
-                    processed_batches.append({
-                        "batch_id": batch.get("id", f"batch_{int(time.time()*1000)}"),
-                        "batch_name": batch.get("batchName", batch.get("batch_name", "Batch")),
-                        "quantity": float(batch.get("quantity", 0)),
-                        "remaining_quantity": float(batch.get("quantity", 0)),  # Will be updated during sales
-                        "unit": batch.get("unit", "unit"),
-                        "buy_price": float(batch.get("buyPrice", 0) or batch.get("buy_price", 0)),
-                        "sell_price": float(batch.get("sellPrice", 0) or batch.get("sell_price", 0)),
-                        "timestamp": batch.get("timestamp", 0),
-                        "date": batch.get("date", ""),
-                        "added_by": batch.get("addedBy", ""),
-                        "selling_unit_allocations": batch.get("sellingUnitAllocations", {})  # Track allocations
-                    })
-
-                # Get selling units for this item with batch links (NEW)
-                selling_units = []
-                try:
-                    # CORRECT PATH: Shops/{shop_id}/categories/{cat_id}/items/{item_id}/sellUnits
-                    sell_units_ref = db.collection("Shops").document(shop_id) \
-                        .collection("categories").document(cat_id) \
-                        .collection("items").document(item_id) \
-                        .collection("sellUnits")
-                    
-                    print(f"\n🔍 Checking selling units for item: {item_name}")
-                    print(f"   Item ID: {item_id}")
-                    print(f"   Category ID: {cat_id}")
-                    print(f"   Collection path: Shops/{shop_id}/categories/{cat_id}/items/{item_id}/sellUnits")
-                    
-                    sell_units_docs = list(sell_units_ref.stream())
-                    
-                    print(f"   Found {len(sell_units_docs)} selling units")
-                    
-                    for sell_unit_doc in sell_units_docs:
-                        sell_unit_data = sell_unit_doc.to_dict()
-                        sell_unit_id = sell_unit_doc.id
-                        
-                        print(f"   Selling Unit: {sell_unit_data.get('name', 'No name')}")
-                        print(f"     ID: {sell_unit_id}")
-                        print(f"     Conversion Factor: {sell_unit_data.get('conversionFactor', 'Not set')}")
-                        print(f"     Sell Price: {sell_unit_data.get('sellPrice', 'Not set')}")
-                        
-                        # Get batch links from selling unit (NEW)
-                        batch_links = sell_unit_data.get("batchLinks", [])
-                        total_units_available = 0
-                        
-                        # Calculate total available units from batch links
-                        for link in batch_links:
-                            total_units_available += link.get("maxUnitsAvailable", 0) - link.get("allocatedUnits", 0)
-                        
-                        selling_units.append({
-                            "sell_unit_id": sell_unit_doc.id,
-                            "name": sell_unit_data.get("name", ""),
-                            "conversion_factor": float(sell_unit_data.get("conversionFactor", 1.0)),
-                            "sell_price": float(sell_unit_data.get("sellPrice", 0.0)),
-                            "images": sell_unit_data.get("images", []),
-                            "is_base_unit": sell_unit_data.get("isBaseUnit", False),
-                            "thumbnail": sell_unit_data.get("images", [None])[0] if sell_unit_data.get("images") else None,
-                            "created_at": sell_unit_data.get("createdAt"),
-                            "updated_at": sell_unit_data.get("updatedAt"),
-                            # NEW: Batch tracking for selling units
-                            "batch_links": batch_links,
-                            "total_units_available": total_units_available,
-                            "has_batch_links": len(batch_links) > 0
-                        })
-                    
-                except Exception as e:
-                    print(f"❌ ERROR fetching selling units: {e}")
-                    # Don't crash, just continue
+    return shop_entry
 
-                # Calculate total stock from batches
-                total_stock_from_batches = sum(batch.get("quantity", 0) for batch in batches)
-                main_stock = float(item_data.get("stock", 0) or 0)
-                
-                # Use batch total if available, otherwise use main stock
-                effective_stock = total_stock_from_batches if total_stock_from_batches > 0 else main_stock
-                
-                category_entry["items"].append({
-                    "item_id": item_doc.id,
-                    "name": item_data.get("name", ""),
-                    "thumbnail": item_data.get("images", [None])[0],
-                    "sell_price": float(item_data.get("sellPrice", 0) or 0),
-                    "buy_price": float(item_data.get("buyPrice", 0) or 0),
-                    "stock": effective_stock,
-                    "base_unit": item_data.get("baseUnit", "unit"),
-                    "embeddings": embeddings,
-                    "has_embeddings": len(embeddings) > 0,
-                    "selling_units": selling_units,
-                    "category_id": category_entry["category_id"],
-                    "category_name": category_entry["category_name"],
-                    # NEW: Batch tracking
-                    "batches": processed_batches,
-                    "has_batches": len(processed_batches) > 0,
-                    "total_stock_from_batches": total_stock_from_batches
-                })
+@firestore_meter.scoped("refresh_full_item_cache")
+def refresh_full_item_cache():
+    """
+    REVISED: Includes ALL items with BATCH tracking and selling units with batch links.
+    Loads every shop at once; the app itself loads shops lazily (see LAZY SHOP CACHE),
+    this is kept for manual full reloads. Concurrent calls share one reload.
+    """
+    return shop_loads.do("__all__", _load_full_item_cache, fresh=True)
+
+def _load_full_item_cache():
+    start = time.time()
+    print("\n[INFO] Refreshing FULL shop cache (with batch tracking)...")
+
+    shops_result = []
 
-            # Only skip categories that have no items at all
-            if category_entry["items"]:
-                shop_entry["categories"].append(category_entry)
+    for shop_doc in db.collection("Shops").stream():
+        shop_entry = build_shop_entry(shop_doc)
 
         # Only skip shops with no categories
         if shop_entry["categories"]:
             shops_result.append(shop_entry)
 
-    embedding_cache_full["shops"] = shops_result
-    embedding_cache_full["total_shops"] = len(shops_result)
-    embedding_cache_full["last_updated"] = time.time()
+    search_indexes = {shop["shop_id"]: build_shop_search_index(shop) for shop in shops_result}
+
+    with cache_write_lock:
+        embedding_cache_full["shops"] = shops_result
+        embedding_cache_full["search_indexes"] = search_indexes
+        embedding_cache_full["total_shops"] = len(shops_result)
+        embedding_cache_full["last_updated"] = time.time()
+        embedding_cache_full["version"] += 1
+
+        shop_cache_lru.clear()
+        for shop in shops_result:
+            shop_cache_lru[shop["shop_id"]] = estimate_shop_bytes(shop)
 
     # Cache statistics
     total_main_items = 0
@@ -232,17 +358,712 @@ def refresh_full_item_cache():
     
     return shops_result
 
+def install_shop_entry(shop_entry, vectors=None):
+    """
+    Swap one shop into the cache (copy-on-write: readers holding the old
+    shops list / index dict keep a consistent snapshot).
+    """
+    shop_id = shop_entry["shop_id"]
+    search_index = build_shop_search_index(shop_entry, vectors)
+
+    with cache_write_lock:
+        shops = [s for s in embedding_cache_full["shops"] if s["shop_id"] != shop_id]
+        shops.append(shop_entry)
+        search_indexes = dict(embedding_cache_full["search_indexes"])
+        search_indexes[shop_id] = search_index
+
+        embedding_cache_full["shops"] = shops
+        embedding_cache_full["search_indexes"] = search_indexes
+        embedding_cache_full["total_shops"] = len(shops)
+        embedding_cache_full["last_updated"] = time.time()
+        embedding_cache_full["version"] += 1
+
+        # Resident size for the LRU (a reload keeps the shop's recency)
+        shop_cache_lru[shop_id] = estimate_shop_bytes(shop_entry)
+
+    return search_index
+
+def evict_shop_entry(shop_id):
+    """Drop one shop from the cache; returns True if it was cached"""
+    with cache_write_lock:
+        if shop_id not in embedding_cache_full["search_indexes"]:
+            return False
+        search_indexes = dict(embedding_cache_full["search_indexes"])
+        search_indexes.pop(shop_id, None)
+
+        embedding_cache_full["shops"] = [s for s in embedding_cache_full["shops"] if s["shop_id"] != shop_id]
+        embedding_cache_full["search_indexes"] = search_indexes
+        embedding_cache_full["total_shops"] = len(embedding_cache_full["shops"])
+        embedding_cache_full["version"] += 1
+        shop_cache_lru.pop(shop_id, None)
+    return True
+
+@timed("shop_load")
+@firestore_meter.scoped("refresh_shop_cache")
+def refresh_shop_cache(shop_id):
+    """Reload ONE shop from Firestore; returns its new index (None if the shop has no items)"""
+    start = time.time()
+    shop_doc = db.collection("Shops").document(shop_id).get()
+    if not shop_doc.exists:
+        evict_shop_entry(shop_id)
+        return None
+
+    shop_entry = build_shop_entry(shop_doc)
+    if not shop_entry["categories"]:
+        evict_shop_entry(shop_id)
+        return None
+
+    search_index = install_shop_entry(shop_entry)
+    print(f"[CACHE] Shop {shop_id} reloaded: {len(search_index['entries'])} items in {round((time.time()-start)*1000,2)}ms")
+    return search_index
+
+
+shop_patch_lock = threading.Lock()  # one listener patch (read → modify → install) at a time
+
+def _find_item(items, item_id):
+    return next((i for i, item in enumerate(items) if item["item_id"] == item_id), None)
+
+def _patch_selling_unit(item, change):
+    """Copy of a cached item with one sellUnits change applied"""
+    sell_unit_id = change.document.id
+    selling_units = [su for su in item["selling_units"] if su["sell_unit_id"] != sell_unit_id]
+    if change.type.name != "REMOVED":
+        position = next((i for i, su in enumerate(item["selling_units"]) if su["sell_unit_id"] == sell_unit_id),
+                        len(selling_units))
+        selling_units.insert(position, selling_unit_entry(change.document))
+    return dict(item, selling_units=selling_units)
+
+def _patch_stock_shard(item, change):
+    """Copy of a cached item with one stock shard change added to its quantities"""
+    shard_id = change.document.id
+    stock_shards = dict(item.get("stock_shards", {}))
+    old_stock, old_batches = shard_totals([stock_shards.get(shard_id)])
+    if change.type.name == "REMOVED":
+        stock_shards.pop(shard_id, None)
+    else:
+        stock_shards[shard_id] = change.document.to_dict() or {}
+    new_stock, new_batches = shard_totals([stock_shards.get(shard_id)])
+
+    batches = []
+    for batch in item["batches"]:
+        change_micro = new_batches.get(batch["batch_id"], 0) - old_batches.get(batch["batch_id"], 0)
+        if change_micro:
+            quantity = from_micro(to_micro(batch["quantity"]) + change_micro)
+            batch = dict(batch, quantity=quantity, remaining_quantity=quantity)
+        batches.append(batch)
+
+    total_stock_from_batches = sum(batch["quantity"] for batch in batches)
+    stock = total_stock_from_batches if total_stock_from_batches > 0 \
+        else from_micro(to_micro(item["stock"]) + new_stock - old_stock)
+    return dict(item, batches=batches, stock=stock, total_stock_from_batches=total_stock_from_batches,
+                stock_shards=stock_shards)
+
+@firestore_meter.scoped("patch_shop_cache")
+def apply_shop_changes(shop_id, changes):
+    """
+    Apply listener changes (items, sellUnits, stock shards) to ONE cached shop
+    and reinstall it, instead of re-reading the whole shop. Edits are built
+    from the changed docs alone; only an item the cache has never seen reads
+    Firestore (its embeddings/selling units). Returns False when the shop is
+    not cached or a change lands in an unknown category (caller reloads).
+    """
+    with shop_patch_lock:
+        search_index = get_shop_search_index(shop_id)
+        if search_index is None:
+            return False
+
+        # Copy-on-write: new category dicts / item lists, untouched items shared
+        categories = {c["category_id"]: dict(c, items=list(c["items"])) for c in search_index["shop"]["categories"]}
+        removed_ids, added_items = set(), []
+
+        for change in changes:
+            segments = change.document.reference.path.split("/")
+            if len(segments) == 6 and segments[2] == "items" and segments[4] == SHARD_COLLECTION:
+                # Shops/{shop}/items/{item}/stockShards/{k}: the cached copy is in its category
+                for category in categories.values():
+                    position = _find_item(category["items"], segments[3])
+                    if position is not None:
+                        category["items"][position] = _patch_stock_shard(category["items"][position], change)
+                continue
+            if len(segments) < 6 or segments[2] != "categories":
+                continue  # not a categories/{cat}/items/... document: never cached
+            category = categories.get(segments[3])
+            removed = change.type.name == "REMOVED"
+            if category is None:
+                if removed:
+                    continue
+                return False
+            items = category["items"]
+            position = _find_item(items, segments[5])
+
+            if len(segments) == 6:
+                if removed:
+                    if position is not None:
+                        items.pop(position)
+                        removed_ids.add(segments[5])
+                elif position is None:
+                    items.append(build_item_entry(change.document, category))
+                    added_items.append(items[-1])
+                else:
+                    items[position] = build_item_entry(change.document, category, cached_item=items[position])
+            elif position is None:
+                continue  # sub-document of an item that is not cached
+            elif segments[6] == "sellUnits":
+                items[position] = _patch_selling_unit(items[position], change)
+            elif segments[6] == SHARD_COLLECTION:
+                items[position] = _patch_stock_shard(items[position], change)
+
+        # Update the image index in place rather than rebuilding it from the cached
+        # items: vectors upserted by /vectorize-item since the load are not in them
+        vectors = search_index["vectors"]
+        remaining_ids = {item["item_id"] for c in categories.values() for item in c["items"]}
+        for item_id in removed_ids - remaining_ids:
+            vectors.remove_item(item_id)
+        for item in added_items:
+            for key, vector in zip(item["embedding_keys"], item["embeddings"]):
+                try:
+                    vectors.upsert(item["item_id"], key, vector)
+                except ValueError as e:
+                    print(f"⚠️ Vector index not updated for {item['item_id']}: {e}")
+
+        shop_entry = dict(search_index["shop"], categories=[c for c in categories.values() if c["items"]])
+        install_shop_entry(shop_entry, vectors)
+        return True
+
+
+# ======================================================
+# PER-SHOP LISTENERS (subscribe on demand, drop when idle)
+# ======================================================
+SHOP_IDLE_TTL_SECONDS = int(os.environ.get("SHOP_IDLE_TTL_SECONDS", 1800))
+SHOP_SWEEP_INTERVAL_SECONDS = 60
+
+def shop_scoped_group_query(collection_id, shop_id):
+    """collection_group(collection_id) limited to documents under Shops/{shop_id}"""
+    shop_ref = db.collection("Shops").document(shop_id)
+    # Shops/{shop_id}/\uf8ff/\uf8ff sorts after everything under Shops/{shop_id} but
+    # before sibling shops whose id merely starts with shop_id (e.g. "abc" vs "abc2")
+    end_ref = shop_ref.collection("\uf8ff").document("\uf8ff")
+    return db.collection_group(collection_id) \
+        .where(filter=firestore.FieldFilter("__name__", ">=", shop_ref)) \
+        .where(filter=firestore.FieldFilter("__name__", "<", end_ref))
+
+class ShopListenerManager:
+    """
+    Items/sellUnits/stockShards listeners per ACTIVE shop instead of global
+    collection-group listeners. A shop is subscribed when it is first queried
+    (or a till streams it) and is unsubscribed + evicted from the cache after
+    SHOP_IDLE_TTL_SECONDS without activity.
+    """
+
+    def __init__(self, idle_ttl=SHOP_IDLE_TTL_SECONDS):
+        self.idle_ttl = idle_ttl
+        self._watches = {}       # shop_id -> [watch, watch]
+        self._last_active = {}   # shop_id -> epoch seconds
+        self._lock = threading.Lock()
+        self._sweeper = None
+        self.evictions = 0
+
+    def is_subscribed(self, shop_id):
+        return shop_id in self._watches
+
+    def touch(self, shop_id):
+        """Mark activity; returns True if this call created the subscription"""
+        with self._lock:
+            self._last_active[shop_id] = time.time()
+            if shop_id in self._watches:
+                return False
+            self._watches[shop_id] = []  # reserve before subscribing outside the lock
+
+        watches = []
+        try:
+            for collection_id, collect_deltas in (("items", collect_item_stock_deltas),
+                                                  ("sellUnits", collect_selling_unit_stock_deltas),
+                                                  (SHARD_COLLECTION, collect_shard_stock_deltas)):
+                watches.append(shop_scoped_group_query(collection_id, shop_id).on_snapshot(
+                    self._make_callback(shop_id, collect_deltas, collection_id)))
+        except Exception:
+            # Drop the reservation (and any half-made watches) so the next touch retries
+            with self._lock:
+                self._watches.pop(shop_id, None)
+            for watch in watches:
+                try:
+                    watch.unsubscribe()
+                except Exception:
+                    pass
+            raise
+        with self._lock:
+            self._watches[shop_id] = watches
+        print(f"[LISTENER] Subscribed shop {shop_id} ({len(self._watches)} active shop(s))")
+        return True
+
+    def _make_callback(self, shop_id, collect_deltas, label):
+        state = {"initial": True}
+
+        def on_shop_snapshot(col_snapshot, changes, read_time):
+            # The first delivery replays every document; the cache was loaded separately
+            if state["initial"]:
+                state["initial"] = False
+                return
+            print(f"[LISTENER] {len(changes)} {label} change(s) in shop {shop_id} → patching the cache")
+            deltas = collect_deltas(changes)  # diff against the cache BEFORE it is patched
+            if not apply_shop_changes(shop_id, changes):
+                shop_loads.do(shop_id, refresh_shop_cache, shop_id, fresh=True)
+            publish_stock_deltas(deltas)
+
+        return on_shop_snapshot
+
+    def unsubscribe(self, shop_id):
+        with self._lock:
+            watches = self._watches.pop(shop_id, [])
+            self._last_active.pop(shop_id, None)
+        for watch in watches:
+            try:
+                watch.unsubscribe()
+            except Exception as e:
+                print(f"⚠️ Failed to unsubscribe shop {shop_id}: {e}")
+
+    def sweep(self):
+        """Drop listeners and cache entries of shops idle for longer than the TTL"""
+        now = time.time()
+        with self._lock:
+            idle = [shop_id for shop_id, seen in self._last_active.items() if now - seen > self.idle_ttl]
+
+        evicted = []
+        for shop_id in idle:
+            if change_feed.is_watched(stock_topic(shop_id)):
+                with self._lock:
+                    self._last_active[shop_id] = now  # tills still polling count as activity
+                continue
+            evict_cached_shop(shop_id, "idle")
+            evicted.append(shop_id)
+
+        if evicted:
+            self.evictions += len(evicted)
+            print(f"[CACHE] Evicted {len(evicted)} idle shop(s): {evicted}")
+        return evicted
+
+    def start_sweeper(self, interval=SHOP_SWEEP_INTERVAL_SECONDS):
+        if self._sweeper:
+            return
+
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.sweep()
+                    save_shop_activity()
+                except Exception as e:
+                    print(f"⚠️ Shop sweep failed: {e}")
+
+        self._sweeper = threading.Thread(target=run, name="shop-listener-sweeper", daemon=True)
+        self._sweeper.start()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "active_shops": len(self._watches),
+                "listeners": sum(len(w) for w in self._watches.values()),
+                "idle_ttl_seconds": self.idle_ttl,
+                "evictions": self.evictions
+            }
+
+shop_listeners = ShopListenerManager()
+
+@timed("cache_lookup")
+def acquire_shop_index(shop_id):
+    """
+    Search index for a shop that is being used right now: keeps its listeners
+    alive and (re)loads it if it was never cached or has been evicted.
+    """
+    newly_subscribed = shop_listeners.touch(shop_id)
+    search_index = get_shop_search_index(shop_id)
+    if search_index is None or newly_subscribed:
+        # Not cached, or cached while nobody was listening (may be stale)
+        shop_cache_lookups.inc("miss")
+        search_index = load_shop_single_flight(shop_id)
+    else:
+        shop_cache_lookups.inc("hit")
+    record_shop_access(shop_id)
+    return search_index
+
+
+# ======================================================
+# LAZY SHOP CACHE (single-flight loads, LRU bounds, pre-warming)
+# ======================================================
+SHOP_CACHE_MAX_SHOPS = int(os.environ.get("SHOP_CACHE_MAX_SHOPS", 200))
+SHOP_CACHE_MAX_BYTES = int(os.environ.get("SHOP_CACHE_MAX_MB", 0)) * 1024 * 1024  # 0 = no memory bound
+SHOP_CACHE_PREWARM_TOP_N = int(os.environ.get("SHOP_CACHE_PREWARM_TOP_N", 10))
+SHOP_ACTIVITY_FILE = os.environ.get("SHOP_ACTIVITY_FILE", "shop_activity.json")
+
+shop_cache_lru = OrderedDict()   # shop_id -> estimated bytes, least recently used first (guarded by cache_write_lock)
+shop_activity = Counter()        # shop_id -> accesses, persisted for pre-warming the next boot (guarded by cache_write_lock)
+# Incremented from request threads, listener callbacks and the sweeper: locked registry counters
+shop_cache_lookups = metrics_registry.counter("shop_cache_lookups_total", "Shop index lookups", ("result",))
+shop_cache_evictions = metrics_registry.counter("shop_cache_evictions_total", "Shops dropped from the cache", ("reason",))
+SHOP_EVICTION_REASONS = ("lru_count", "lru_bytes", "idle")
+shop_loads = SingleFlight("shop_load")  # loads/counts/durations of shop (re)loads
+
+def estimate_shop_bytes(shop_entry):
+    """Rough resident size of a cached shop (dict overhead + embedding vectors)"""
+    total = 1024
+    for category in shop_entry["categories"]:
+        for item in category["items"]:
+            total += 2048
+            total += 512 * len(item.get("batches", []))
+            total += 1024 * len(item.get("selling_units", []))
+            total += sum(getattr(e, "nbytes", 0) for e in item.get("embeddings", []))
+    return total
 
-def on_full_item_snapshot(col_snapshot, changes, read_time):
-    """Listener for changes to main items"""
-    print("[LISTENER] Main items changed → refreshing FULL cache")
-    refresh_full_item_cache()
+def record_shop_access(shop_id):
+    """Mark a shop most recently used"""
+    with cache_write_lock:
+        shop_activity[shop_id] += 1
+        if shop_id in shop_cache_lru:
+            shop_cache_lru.move_to_end(shop_id)
 
+def load_shop_single_flight(shop_id):
+    """
+    Load one shop; concurrent callers for the same shop wait on the first
+    caller's load instead of each reading the shop from Firestore.
+    """
+    search_index = shop_loads.do(shop_id, refresh_shop_cache, shop_id)
+    enforce_shop_cache_bounds(keep=shop_id)
+    return search_index
+
+def evict_cached_shop(shop_id, reason):
+    """Stop watching a shop and drop it from the cache"""
+    shop_listeners.unsubscribe(shop_id)
+    if evict_shop_entry(shop_id):
+        shop_cache_evictions.inc(reason)
+
+def enforce_shop_cache_bounds(keep=None):
+    """Evict least recently used shops until the count and memory bounds hold"""
+    evicted = []
+    while True:
+        with cache_write_lock:
+            over_count = len(shop_cache_lru) > SHOP_CACHE_MAX_SHOPS
+            over_bytes = SHOP_CACHE_MAX_BYTES and sum(shop_cache_lru.values()) > SHOP_CACHE_MAX_BYTES
+            if not (over_count or over_bytes):
+                break
+            # Shops with tills polling stock stay resident
+            victim = next((shop_id for shop_id in shop_cache_lru
+                           if shop_id != keep and not change_feed.is_watched(stock_topic(shop_id))), None)
+        if victim is None:
+            break
+        evict_cached_shop(victim, "lru_count" if over_count else "lru_bytes")
+        evicted.append(victim)
+
+    if evicted:
+        print(f"[CACHE] LRU evicted {len(evicted)} shop(s): {evicted}")
+    return evicted
+
+def save_shop_activity(path=SHOP_ACTIVITY_FILE):
+    """Persist access counts so the next boot can pre-warm the busiest shops"""
+    with cache_write_lock:
+        busiest = dict(shop_activity.most_common(max(SHOP_CACHE_MAX_SHOPS, 1)))
+    try:
+        with open(path, "w") as f:
+            json.dump(busiest, f)
+    except OSError as e:
+        print(f"⚠️ Could not save shop activity: {e}")
+
+def prewarm_shop_cache(top_n=SHOP_CACHE_PREWARM_TOP_N, path=SHOP_ACTIVITY_FILE):
+    """Load the top_n most active shops of the previous run (nothing on a first boot)"""
+    if top_n <= 0:
+        return []
+    try:
+        with open(path) as f:
+            shop_activity.update(json.load(f))
+    except (OSError, ValueError):
+        return []
+
+    warmed = []
+    for shop_id, _ in shop_activity.most_common(min(top_n, SHOP_CACHE_MAX_SHOPS)):
+        try:
+            if acquire_shop_index(shop_id) is not None:
+                warmed.append(shop_id)
+        except Exception as e:
+            print(f"⚠️ Pre-warm failed for shop {shop_id}: {e}")
+    return warmed
+
+def shop_cache_report():
+    with cache_write_lock:
+        resident = len(shop_cache_lru)
+        resident_bytes = sum(shop_cache_lru.values())
+    hits, misses = shop_cache_lookups.value("hit"), shop_cache_lookups.value("miss")
+    lookups = hits + misses
+    return {
+        "hits": hits,
+        "misses": misses,
+        "evictions": {reason: shop_cache_evictions.value(reason) for reason in SHOP_EVICTION_REASONS},
+        "hit_rate": round(hits / lookups, 4) if lookups else None,
+        "loads": shop_loads.stats(),
+        "resident_shops": resident,
+        "resident_mb": round(resident_bytes / (1024 * 1024), 2),
+        "max_shops": SHOP_CACHE_MAX_SHOPS,
+        "max_mb": SHOP_CACHE_MAX_BYTES // (1024 * 1024) or None,
+        "listeners": shop_listeners.stats()
+    }
+
+
+# ======================================================
+# PER-SHOP TOKEN INDEX (MULTI-TOKEN SEARCH)
+# ======================================================
+TOKEN_LOOKUP_CACHE_SIZE = 2048
+SCAN_CODE_FIELDS = ("barcode", "sku", "SKU", "code")
+
+def normalize_scan_code(code):
+    """Canonical form for barcode/SKU lookups"""
+    return str(code).strip().upper() if code is not None else ""
+
+def collect_scan_codes(doc_data):
+    """Barcode/SKU values on an item or selling unit document (normalised, deduplicated)"""
+    raw = [doc_data.get(field) for field in SCAN_CODE_FIELDS]
+    raw.extend(doc_data.get("barcodes") or [])
+    codes = []
+    for value in raw:
+        code = normalize_scan_code(value)
+        if code and code not in codes:
+            codes.append(code)
+    return codes
+
+def tokenize_search_text(text):
+    """Split text into lowercase tokens (duplicates dropped, order kept)"""
+    tokens = []
+    for token in (text or "").lower().split():
+        if token not in tokens:
+            tokens.append(token)
+    return tokens
+
+def build_shop_search_index(shop_entry, vectors=None):
+    """
+    Build the token index for one cached shop.
+    Every item is one entry; its posting words come from the item name plus
+    the names/display names of its selling units (they inherit the parent).
+    vectors: the shop's previous image index, kept by listener patches so
+    vectors upserted since the load survive (see apply_shop_changes).
+    """
+    entries = []        # position -> (category, item), in cache order
+    postings = {}       # word -> set(entry positions)
+    by_item_id = {}
+    by_code = {}        # barcode/SKU -> (position, sell_unit_id or None)
+
+    for category in shop_entry.get("categories", []):
+        for item in category.get("items", []):
+            position = len(entries)
+            entries.append((category, item))
+            by_item_id[item.get("item_id")] = position
+
+            words = set(tokenize_search_text(item.get("name", "")))
+            for su in item.get("selling_units", []):
+                words.update(tokenize_search_text(su.get("name", "")))
+                words.update(tokenize_search_text(su.get("display_name", "")))
+                for code in su.get("codes", []):
+                    by_code.setdefault(code, (position, su.get("sell_unit_id")))
+
+            # Item codes win over selling unit codes if both use the same value
+            for code in item.get("codes", []):
+                by_code[code] = (position, None)
+
+            for word in words:
+                postings.setdefault(word, set()).add(position)
+
+    suffixes, suffix_words = build_suffix_array(postings)
+    return {
+        "shop": shop_entry,
+        "entries": entries,
+        "postings": postings,
+        "suffixes": suffixes,          # every suffix of every word, sorted
+        "suffix_words": suffix_words,  # the word each suffix belongs to
+        "by_item_id": by_item_id,
+        "by_code": by_code,
+        "vectors": vectors if vectors is not None else build_shop_vector_index(shop_entry["shop_id"], entries),
+        "token_lookups": OrderedDict(),  # token -> frozenset(positions), LRU
+        "token_lookup_lock": threading.Lock()
+    }
+
+def build_suffix_array(words):
+    """
+    Sorted suffixes of all words + the word of each: the words containing a
+    token are the contiguous run of suffixes that start with it.
+    """
+    pairs = sorted((word[i:], word) for word in words for i in range(len(word)))
+    return [suffix for suffix, _ in pairs], [word for _, word in pairs]
+
+# Image search: exact scan below ANN_MIN_VECTORS, IVF (approximate) above it
+ANN_MIN_VECTORS = int(os.environ.get("ANN_MIN_VECTORS", 20000))
+ANN_NLIST = int(os.environ.get("ANN_NLIST", 0))     # 0 = ~sqrt(vectors)
+ANN_NPROBE = int(os.environ.get("ANN_NPROBE", 8))   # lists scanned per query (recall vs latency)
+ANN_RETRAIN_GROWTH = 2.0                            # retrain saved centroids once the shop doubled/halved
+VECTOR_INDEX_DIR = os.environ.get("VECTOR_INDEX_DIR")  # where trained quantisers are kept across restarts
+
+def build_shop_vector_index(shop_id, entries):
+    """Image embeddings → one normalised float32 matrix (+ IVF lists for big catalogues)"""
+    vectors = ShopVectorIndex.from_rows(
+        ((item.get("item_id"), key, vector)
+         for _, item in entries
+         for key, vector in zip(item.get("embedding_keys", []), item.get("embeddings", []))),
+        nprobe=ANN_NPROBE
+    )
+    if len(vectors) < ANN_MIN_VECTORS:
+        return vectors
+
+    start = time.time()
+    path = os.path.join(VECTOR_INDEX_DIR, f"{shop_id}.npz") if VECTOR_INDEX_DIR else None
+    saved = None
+    if path and os.path.exists(path):
+        try:
+            saved = ShopVectorIndex.load(path)
+        except Exception as e:
+            print(f"⚠️ Ignoring saved vector index for {shop_id}: {e}")
+
+    growth = len(vectors) / max(saved.trained_on, 1) if saved is not None else None
+    if saved is not None and saved.dim == vectors.dim and saved.centroids is not None \
+            and 1 / ANN_RETRAIN_GROWTH <= growth <= ANN_RETRAIN_GROWTH:
+        vectors.build_ivf(centroids=saved.centroids)
+        vectors.trained_on = saved.trained_on
+        source = "saved centroids"
+    else:
+        vectors.build_ivf(nlist=ANN_NLIST or None)
+        source = "k-means"
+        if path:
+            try:
+                os.makedirs(VECTOR_INDEX_DIR, exist_ok=True)
+                vectors.save(path, include_vectors=False)
+            except OSError as e:
+                print(f"⚠️ Could not save vector index for {shop_id}: {e}")
+
+    print(f"[CACHE] IVF for shop {shop_id}: {len(vectors)} vectors, {len(vectors.centroids)} lists "
+          f"({source}, {round((time.time()-start)*1000, 2)}ms)")
+    return vectors
+
+def get_shop_search_index(shop_id):
+    """Return the token index for a cached shop (None if the shop is not cached)"""
+    return embedding_cache_full.get("search_indexes", {}).get(shop_id)
+
+def lookup_token_postings(index, token):
+    """
+    Posting list for one query token: every entry having a word that contains it.
+    Covers all scorer tiers (exact, prefix, whole word, partial) because each
+    of them implies the token is a substring of some indexed word.
+    """
+    lookups = index["token_lookups"]
+    with index["token_lookup_lock"]:
+        cached = lookups.get(token)
+        if cached is not None:
+            lookups.move_to_end(token)
+            return cached
+
+    # Suffixes starting with the token: O(log n) to find, then one step per hit
+    suffixes = index["suffixes"]
+    lo = bisect.bisect_left(suffixes, token)
+    hi = bisect.bisect_left(suffixes, token + "\U0010ffff", lo)
+    postings = index["postings"]
+    matched = set()
+    for word in set(index["suffix_words"][lo:hi]):
+        matched |= postings[word]
+    matched = frozenset(matched)
+
+    with index["token_lookup_lock"]:
+        lookups[token] = matched
+        if len(lookups) > TOKEN_LOOKUP_CACHE_SIZE:
+            lookups.popitem(last=False)  # least recently used
+    return matched
+
+def find_candidate_entries(index, tokens):
+    """AND semantics: intersect per-token posting lists, smallest list first"""
+    if not tokens:
+        return []
+
+    posting_lists = sorted((lookup_token_postings(index, t) for t in tokens), key=len)
+    candidates = set(posting_lists[0])
+    for positions in posting_lists[1:]:
+        if not candidates:
+            break
+        candidates &= positions
+
+    return sorted(candidates)
+
+def calculate_search_score(text, search_query, debug_name=""):
+    """Calculate search relevance score (0-100) with detailed debugging"""
+    if not text or not search_query:
+        if debug_name:
+            print(f"    {debug_name}: No text or query (score: 0)")
+        return 0, []
+
+    text_lower = text.lower()
+    query_lower = search_query.lower()
+
+    debug_steps = []
+
+    if text_lower == query_lower:
+        debug_steps.append(f"Exact match: '{text}' == '{search_query}'")
+        if debug_name:
+            print(f"    {debug_name}: ✅ EXACT MATCH (score: 100)")
+        return 100, debug_steps
+
+    if text_lower.startswith(query_lower):
+        debug_steps.append(f"Starts with query: '{text}' starts with '{search_query}'")
+        if debug_name:
+            print(f"    {debug_name}: ✅ STARTS WITH (score: 90)")
+        return 90, debug_steps
+
+    words = text_lower.split()
+    for word in words:
+        if word.startswith(query_lower):
+            debug_steps.append(f"Word starts with: word '{word}' in '{text}' starts with '{search_query}'")
+            if debug_name:
+                print(f"    {debug_name}: ✅ WORD STARTS WITH (score: 85)")
+            return 85, debug_steps
+
+    padded_text = f" {text_lower} "
+    padded_query = f" {query_lower} "
+    if padded_query in padded_text:
+        debug_steps.append(f"Whole word match: '{search_query}' found as whole word in '{text}'")
+        if debug_name:
+            print(f"    {debug_name}: ✅ WHOLE WORD MATCH (score: 80)")
+        return 80, debug_steps
+
+    if query_lower in text_lower:
+        position = text_lower.find(query_lower)
+        position_penalty = min(position * 0.5, 10)
+        score = max(70, 79 - position_penalty)
+        debug_steps.append(f"Partial match at position {position}: '{search_query}' found in '{text}' (penalty: {position_penalty:.1f})")
+        if debug_name:
+            print(f"    {debug_name}: ✅ PARTIAL MATCH at position {position} (score: {score:.1f})")
+        return score, debug_steps
+
+    debug_steps.append(f"No match: '{search_query}' not found in '{text}'")
+    if debug_name:
+        print(f"    {debug_name}: ❌ NO MATCH (score: 0)")
+    return 0, debug_steps
+
+def calculate_multi_token_score(text, search_query, tokens, debug_name=""):
+    """
+    Score a (possibly multi-word) query against text.
+    The whole query is scored first, so phrase matches keep their tier.
+    Otherwise every token must match (AND) and the combined score is the
+    weakest token's tier, e.g. 'milk 500ml' vs '500ml Fresh Milk' -> 85.
+    """
+    score, debug_steps = calculate_search_score(text, search_query, debug_name)
+    if score > 0 or len(tokens) < 2:
+        return score, debug_steps
 
-def on_selling_units_snapshot(col_snapshot, changes, read_time):
-    """Listener for changes to selling units"""
-    print("[LISTENER] Selling units changed → refreshing FULL cache")
-    refresh_full_item_cache()
+    token_scores = []
+    for token in tokens:
+        token_score, token_debug = calculate_search_score(text, token)
+        if token_score <= 0:
+            if debug_name:
+                print(f"    {debug_name}: ❌ TOKEN '{token}' MISSING (score: 0)")
+            return 0, debug_steps + [f"Token '{token}' not found in '{text}'"]
+        token_scores.append(token_score)
+        debug_steps.extend([f"Token '{token}': {d}" for d in token_debug])
+
+    combined = min(token_scores)
+    debug_steps.append(f"All {len(tokens)} tokens matched, combined score = weakest token ({combined:.1f})")
+    if debug_name:
+        print(f"    {debug_name}: ✅ ALL TOKENS MATCHED (score: {combined:.1f})")
+    return combined, debug_steps
 
 
 # ======================================================
@@ -250,14 +1071,14 @@ def on_selling_units_snapshot(col_snapshot, changes, read_time):
 # ======================================================
 
 def find_item_in_cache(shop_id, item_id):
-    """Find item in cache by shop_id and item_id"""
-    for shop in embedding_cache_full["shops"]:
-        if shop["shop_id"] == shop_id:
-            for category in shop["categories"]:
-                for item in category["items"]:
-                    if item["item_id"] == item_id:
-                        return item
-    return None
+    """Find item in cache by shop_id and item_id (via the shop's index)"""
+    search_index = get_shop_search_index(shop_id)
+    if not search_index:
+        return None
+    position = search_index["by_item_id"].get(item_id)
+    if position is None:
+        return None
+    return search_index["entries"][position][1]
 
 def find_selling_unit_in_cache(shop_id, item_id, sell_unit_id):
     """Find selling unit in cache"""
@@ -268,94 +1089,100 @@ def find_selling_unit_in_cache(shop_id, item_id, sell_unit_id):
                 return sell_unit
     return None
 
-def allocate_main_item_fifo(batches, requested_quantity):
+# ============== CART ALLOCATION (FIFO preview with COGS) ==============
+@app.route('/allocate-cart', methods=['POST'])
+def allocate_cart():
     """
-    Allocate quantity from batches using FIFO for main items
-    Returns: {
-        "success": True/False,
-        "allocation": [{"batch_id": "...", "quantity": x, "price": y}, ...],
-        "total_price": z
-    }
+    FIFO-allocate a whole cart against the cached batches without selling it:
+    {shop_id, items: [{item_id, quantity, type?, sell_unit_id?, conversion_factor?}]}.
+    Selling-unit lines are allocated over the cached unit's batch links at its
+    own factor and link prices; other lines over the item's batches. Lines of
+    the same item (or selling unit) are allocated one after another in one
+    NumPy pass. Returns per-line takes with revenue, COGS and margin, plus cart totals.
     """
-    if not batches:
-        return {"success": False, "error": "No batches available"}
-    
-    # Sort batches by timestamp (oldest first)
-    sorted_batches = sorted(batches, key=lambda x: x.get("timestamp", 0))
-    
-    allocation = []
-    remaining = requested_quantity
-    total_price = 0
-    
-    for batch in sorted_batches:
-        if remaining <= 0:
-            break
-        
-        available = batch.get("remaining_quantity", 0)
-        if available > 0:
-            take = min(available, remaining)
-            batch_price = batch.get("sell_price", 0)
-            
-            allocation.append({
-                "batch_id": batch["batch_id"],
-                "batch_name": batch.get("batch_name", "Batch"),
-                "quantity": take,
-                "price": batch_price,
-                "unit": batch.get("unit", "unit"),
-                "batch_info": batch
-            })
-            
-            total_price += take * batch_price
-            remaining -= take
-    
-    if remaining > 0:
-        return {"success": False, "error": f"Insufficient stock. Only {requested_quantity - remaining} available"}
-    
-    return {"success": True, "allocation": allocation, "total_price": total_price}
+    data = request.get_json(silent=True) or {}
+    shop_id = data.get('shop_id')
+    items = data.get('items')
+    if not shop_id or not isinstance(items, list) or not items:
+        return jsonify({"status": "error", "message": "shop_id and items required"}), 400
 
-def allocate_selling_unit_fifo(batch_links, requested_units, conversion_factor):
-    """
-    Allocate selling units from batch links using FIFO
-    Returns allocation in MAIN units for stock deduction
-    """
-    if not batch_links:
-        return {"success": False, "error": "No batch links available"}
-    
-    # Sort batch links (FIFO - we need to get batch timestamps from cache)
-    # For now, use the order they appear (should be FIFO if created properly)
-    sorted_links = sorted(batch_links, key=lambda x: x.get("batchTimestamp", 0))
-    
-    allocation = []
-    remaining_units = requested_units
-    total_price = 0
-    
-    for link in sorted_links:
-        if remaining_units <= 0:
-            break
-        
-        available_units = link.get("maxUnitsAvailable", 0) - link.get("allocatedUnits", 0)
-        if available_units > 0:
-            take_units = min(available_units, remaining_units)
-            price_per_unit = link.get("pricePerUnit", 0)
-            
-            # Convert to main units for stock deduction
-            take_main_units = take_units / conversion_factor
-            
-            allocation.append({
-                "batch_id": link.get("batchId"),
-                "units_taken": take_units,
-                "main_units_taken": take_main_units,
-                "price_per_unit": price_per_unit,
-                "total_for_batch": take_units * price_per_unit
-            })
-            
-            total_price += take_units * price_per_unit
-            remaining_units -= take_units
-    
-    if remaining_units > 0:
-        return {"success": False, "error": f"Insufficient units. Only {requested_units - remaining_units} available"}
-    
-    return {"success": True, "allocation": allocation, "total_price": total_price}
+    search_index = acquire_shop_index(shop_id)
+    if search_index is None:
+        return jsonify({"status": "error", "message": f"Shop {shop_id} not found or has no items"}), 404
+
+    lines = [None] * len(items)
+    by_item = {}  # item_id -> [(line position, base quantity)]
+    by_unit = {}  # (item_id, sell_unit_id) -> [(line position, selling units)]
+    for position, item in enumerate(items):
+        if not isinstance(item, dict):
+            lines[position] = {"item_id": None, "success": False, "error": "Each item must be an object"}
+            continue
+        item_id = item.get('item_id')
+        if not isinstance(item_id, str):
+            lines[position] = {"item_id": None, "success": False, "error": "item_id must be a string"}
+            continue
+        if item_id not in search_index["by_item_id"]:
+            lines[position] = {"item_id": item_id, "success": False, "error": f"Item {item_id} not found"}
+            continue
+        cached = search_index["entries"][search_index["by_item_id"][item_id]][1]
+        sell_unit = None
+        if item.get('type') == 'selling_unit':
+            sell_unit = next((su for su in cached.get("selling_units", [])
+                              if su.get("sell_unit_id") == item.get('sell_unit_id')), None)
+        try:
+            quantity_micro = to_micro(item.get('quantity', 0))
+            if quantity_micro <= 0:
+                raise ValueError(quantity_micro)
+            if sell_unit and sell_unit.get("batch_links"):
+                by_unit.setdefault((item_id, sell_unit["sell_unit_id"]), []).append(
+                    (position, from_micro(quantity_micro)))
+                continue
+            if item.get('type') == 'selling_unit':
+                factor = sell_unit["conversion_factor"] if sell_unit else item.get('conversion_factor', 1.0)
+            else:
+                factor = 1
+            base_micro = mul_ratio(quantity_micro, factor)
+        except (TypeError, ValueError, ZeroDivisionError):
+            lines[position] = {"item_id": item_id, "success": False, "error": "Invalid quantity or conversion factor"}
+            continue
+        by_item.setdefault(item_id, []).append((position, from_micro(base_micro)))
+
+    for item_id, item_lines in by_item.items():
+        cached = search_index["entries"][search_index["by_item_id"][item_id]][1]
+        batches = [{**b, "remaining_quantity": b["quantity"]} for b in cached.get("batches", [])]
+        with span("batch_selection"):
+            results = allocate_fifo_many(batches, [quantity for _, quantity in item_lines])
+        for (position, quantity), result in zip(item_lines, results):
+            lines[position] = {"item_id": item_id, "base_quantity": quantity, **result}
+
+    for (item_id, sell_unit_id), unit_lines in by_unit.items():
+        cached = search_index["entries"][search_index["by_item_id"][item_id]][1]
+        sell_unit = next(su for su in cached["selling_units"] if su.get("sell_unit_id") == sell_unit_id)
+        buy_prices = {b["batch_id"]: b.get("buy_price", 0) for b in cached.get("batches", [])}
+        with span("batch_selection"):
+            results = allocate_selling_units_many(sell_unit["batch_links"], [units for _, units in unit_lines],
+                                                  sell_unit["conversion_factor"], buy_prices)
+        for (position, units), result in zip(unit_lines, results):
+            lines[position] = {"item_id": item_id, "sell_unit_id": sell_unit_id, "selling_units": units, **result}
+            if result["success"]:
+                lines[position]["base_quantity"] = from_micro(
+                    sum(part["main_units_taken_micro"] for part in result["allocation"]))
+
+    allocated = [line for line in lines if line["success"]]
+    revenue = sum(to_minor(line["total_price"]) for line in allocated)
+    cogs = sum(to_minor(line["cogs"]) for line in allocated)
+    return jsonify({
+        "status": "success",
+        "shop_id": shop_id,
+        "can_fulfill": len(allocated) == len(lines),
+        "lines": lines,
+        "totals": {
+            "revenue": from_minor(revenue),
+            "cogs": from_minor(cogs),
+            "margin": from_minor(revenue - cogs),
+            "margin_pct": round((revenue - cogs) / revenue * 100, 2) if revenue else None
+        }
+    })
 
 # PLANS
 PLANS_CONFIG = {
@@ -525,58 +1352,896 @@ def dashboard():
 
 
 # ======================================================
-# VECTORIZE ITEM (STOCK IMAGE → EMBEDDING)
+# VECTORIZE ITEM (STOCK IMAGE → EMBEDDING, ASYNC PIPELINE)
 # ======================================================
-@app.route("/vectorize-item", methods=["POST"])
-def vectorize_item():
-    try:
-        data = request.get_json(force=True)
+VECTORIZE_WORKERS = int(os.environ.get("VECTORIZE_WORKERS", 2))
+VECTORIZE_BATCH_SIZE = int(os.environ.get("VECTORIZE_BATCH_SIZE", 8))
+VECTORIZE_QUEUE_SIZE = int(os.environ.get("VECTORIZE_QUEUE_SIZE", 500))
+VECTORIZE_MAX_ATTEMPTS = 3
+VECTORIZE_DOWNLOAD_THREADS = 8
+VECTORIZE_BATCH_MAX_IMAGES = 32
+EMBEDDING_IMAGE_SIZE = (224, 224)
+EMBEDDING_MODEL_NAME = "mobilenet_v2_100_224"
+EMBEDDING_STORAGE = os.environ.get("EMBEDDING_STORAGE", "float16")  # float16 | int8 | list (legacy)
 
-        required = [
-            "event",
-            "image_url",
-            "item_id",
-            "shop_id",
-            "category_id",
-            "image_index",
-            "timestamp",
-        ]
+image_download_pool = ThreadPoolExecutor(max_workers=VECTORIZE_DOWNLOAD_THREADS, thread_name_prefix="image-download")
 
-        missing = [k for k in required if k not in data]
-        if missing:
-            return jsonify({"status": "error", "missing_fields": missing}), 400
+def load_item_image(target):
+    """Download (image_url) or take the uploaded bytes (image_bytes), decode, resize → (224, 224, 3) uint8"""
+    content = target.get("image_bytes")
+    if content is None:
+        response = requests.get(target["image_url"], timeout=10)
+        response.raise_for_status()
+        content = response.content
+    img = Image.open(BytesIO(content)).convert("RGB")
+    img = img.resize(EMBEDDING_IMAGE_SIZE)
+    return np.asarray(img)
 
-        print(f"📥 /vectorize-item → {data['item_id']} image {data['image_index']}")
-
-        response = requests.get(data["image_url"], timeout=10)
-        img = Image.open(BytesIO(response.content)).convert("RGB")
-        img = img.resize((224, 224))
-
-        vector = generate_embedding(np.array(img))
-
-        db.collection("Shops") \
-            .document(data["shop_id"]) \
-            .collection("categories") \
-            .document(data["category_id"]) \
-            .collection("items") \
-            .document(data["item_id"]) \
-            .collection("embeddings") \
-            .document(str(data["image_index"])) \
-            .set({
-                "vector": vector.tolist(),
-                "model": "mobilenet_v2_100_224",
-                "updatedAt": firestore.SERVER_TIMESTAMP,
-            })
+# Cleared the first time the model rejects a stacked batch, so later batches
+# go straight to one call per image
+embedding_batches_supported = True
 
-        return jsonify({
-            "status": "success",
-            "embedding_length": len(vector),
-        })
+def embed_images(images):
+    """
+    (224, 224, 3) images → (N, D) float32 vectors in ONE forward pass: the
+    images are stacked into an (N, 224, 224, 3) tensor for a single
+    generate_embedding call. If the model rejects the batch (raises, or does
+    not return one vector per image) each image is embedded on its own.
+    """
+    global embedding_batches_supported
+    if embedding_batches_supported:
+        try:
+            vectors = np.asarray(generate_embedding(np.stack(images)), dtype=np.float32)
+            if vectors.ndim == 2 and len(vectors) == len(images):
+                return vectors
+            if vectors.ndim == 1 and len(images) == 1:
+                return vectors.reshape(1, -1)
+            reason = f"returned shape {vectors.shape} for {len(images)} image(s)"
+        except Exception as e:
+            reason = str(e)
+        embedding_batches_supported = False
+        print(f"⚠️ Embedding model rejected a batch ({reason}); embedding one image at a time")
+    return np.stack([np.asarray(generate_embedding(image), dtype=np.float32).ravel() for image in images])
 
+def image_embeddings_unavailable():
+    """503 response for the embedding routes when Pillow/embeddings are not installed"""
+    return jsonify({
+        "status": "error",
+        "message": "Image embeddings are not available on this server"
+    }), 503
+
+def item_embedding_ref(shop_id, category_id, item_id, image_index):
+    return db.collection("Shops") \
+        .document(shop_id) \
+        .collection("categories") \
+        .document(category_id) \
+        .collection("items") \
+        .document(item_id) \
+        .collection("embeddings") \
+        .document(str(image_index))
+
+def vectorize_and_store(targets):
+    """
+    Embed many item images at once: decode them in parallel, run ONE batched
+    forward pass, then write every vector in ONE Firestore batch.
+    targets: dicts with shop_id, category_id, item_id, image_index and
+    image_url or image_bytes. Returns one result (or Exception) per target.
+    """
+    outcomes = [None] * len(targets)
+    timings = {}
+
+    start = time.time()
+    loads = [image_download_pool.submit(load_item_image, target) for target in targets]
+    images, positions = [], []
+    for i, future in enumerate(loads):
+        try:
+            images.append(future.result())
+            positions.append(i)
+        except Exception as e:
+            outcomes[i] = e
+    timings["decode_ms"] = round((time.time() - start) * 1000, 2)
+
+    if not images:
+        return outcomes, timings
+
+    start = time.time()
+    vectors = embed_images(images)
+    timings["embed_ms"] = round((time.time() - start) * 1000, 2)
+
+    start = time.time()
+    batch = db.batch()
+    for i, vector in zip(positions, vectors):
+        target = targets[i]
+        batch.set(item_embedding_ref(target["shop_id"], target["category_id"], target["item_id"], target["image_index"]), {
+            **encode_embedding(vector, EMBEDDING_STORAGE),
+            "model": EMBEDDING_MODEL_NAME,
+            "updatedAt": firestore.SERVER_TIMESTAMP,
+        })
+        outcomes[i] = {"embedding_length": len(vector)}
+    batch.commit()
+    timings["write_ms"] = round((time.time() - start) * 1000, 2)
+
+    # Make the new vectors searchable right away (no shop reload needed)
+    for i, vector in zip(positions, vectors):
+        target = targets[i]
+        search_index = get_shop_search_index(target["shop_id"])
+        if search_index and target["item_id"] in search_index["by_item_id"]:
+            try:
+                search_index["vectors"].upsert(target["item_id"], str(target["image_index"]), vector)
+            except ValueError as e:
+                print(f"⚠️ Vector index not updated for {target['item_id']}: {e}")
+
+    print(f"🧠 Vectorized {len(positions)}/{len(targets)} image(s) in one batch")
+    return outcomes, timings
+
+def process_vectorize_batch(jobs):
+    """Worker side of /vectorize-item: one batched embed + write per dequeued batch"""
+    outcomes, _ = vectorize_and_store([job["payload"] for job in jobs])
+    return outcomes
+
+vectorize_pipeline = BatchJobQueue(
+    "vectorize",
+    process_vectorize_batch,
+    workers=VECTORIZE_WORKERS,
+    batch_size=VECTORIZE_BATCH_SIZE,
+    max_queue=VECTORIZE_QUEUE_SIZE,
+    max_attempts=VECTORIZE_MAX_ATTEMPTS
+)
+
+@app.route("/vectorize-item", methods=["POST"])
+def vectorize_item():
+    """Queue an item photo for embedding; returns 202 with a job id to poll"""
+    if not IMAGE_EMBEDDINGS_ENABLED:
+        return image_embeddings_unavailable()
+    try:
+        data = request.get_json(force=True)
+
+        required = [
+            "event",
+            "image_url",
+            "item_id",
+            "shop_id",
+            "category_id",
+            "image_index",
+            "timestamp",
+        ]
+
+        missing = [k for k in required if k not in data]
+        if missing:
+            return jsonify({"status": "error", "missing_fields": missing}), 400
+
+        print(f"📥 /vectorize-item → {data['item_id']} image {data['image_index']} (queued)")
+
+        # Re-uploading the same slot before it ran only embeds the newest image
+        dedupe_key = f"{data['shop_id']}/{data['category_id']}/{data['item_id']}/{data['image_index']}"
+        job_id = vectorize_pipeline.submit(data, dedupe_key=dedupe_key)
+
+        return jsonify({
+            "status": "queued",
+            "job_id": job_id,
+            "status_url": f"/vectorize-item/jobs/{job_id}",
+            "queue_depth": vectorize_pipeline.stats()["queue_depth"]
+        }), 202
+
+    except QueueFull as e:
+        return jsonify({"status": "error", "message": str(e)}), 503, {"Retry-After": "5"}
     except Exception as e:
         print("🔥 /vectorize-item error:", e)
         return jsonify({"status": "error", "message": str(e)}), 500
 
+def parse_vectorize_items_request():
+    """
+    Targets for /vectorize-items from either
+      JSON: {shop_id, category_id, item_id, images: [{image_url, image_index, item_id?, category_id?}] | image_urls: [...]}
+      multipart: shop_id, category_id, item_id, start_index? + files under "images"
+    """
+    if request.files:
+        form = request.form
+        files = request.files.getlist("images")
+        start_index = int(form.get("start_index", 0))
+        base = {k: form.get(k) for k in ("shop_id", "category_id", "item_id")}
+        return [{**base, "image_index": start_index + n, "image_bytes": f.read()} for n, f in enumerate(files)]
+
+    data = request.get_json(force=True) or {}
+    base = {k: data.get(k) for k in ("shop_id", "category_id", "item_id")}
+    images = data.get("images")
+    if images is None:
+        images = [{"image_url": url, "image_index": n} for n, url in enumerate(data.get("image_urls") or [])]
+
+    targets = []
+    for n, image in enumerate(images):
+        if isinstance(image, str):
+            image = {"image_url": image}
+        targets.append({
+            **base,
+            **{k: image[k] for k in ("category_id", "item_id") if image.get(k)},
+            "image_url": image.get("image_url"),
+            "image_index": image.get("image_index", n)
+        })
+    return targets
+
+@app.route("/vectorize-items", methods=["POST"])
+def vectorize_items():
+    """Embed several images (URLs or uploads) with one parallel decode and one Firestore batch write"""
+    if not IMAGE_EMBEDDINGS_ENABLED:
+        return image_embeddings_unavailable()
+    try:
+        targets = parse_vectorize_items_request()
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Invalid request: {e}"}), 400
+
+    if not targets:
+        return jsonify({"status": "error", "message": "No images given"}), 400
+    if len(targets) > VECTORIZE_BATCH_MAX_IMAGES:
+        return jsonify({"status": "error", "message": f"At most {VECTORIZE_BATCH_MAX_IMAGES} images per call"}), 400
+
+    invalid = [n for n, t in enumerate(targets)
+               if not (t.get("shop_id") and t.get("category_id") and t.get("item_id"))
+               or (t.get("image_url") is None and t.get("image_bytes") is None)]
+    if invalid:
+        return jsonify({"status": "error", "message": "shop_id, category_id, item_id and an image are required",
+                        "invalid_images": invalid}), 400
+
+    print(f"📥 /vectorize-items → {len(targets)} image(s)")
+    start = time.time()
+    try:
+        outcomes, timings = vectorize_and_store(targets)
+    except Exception as e:
+        print("🔥 /vectorize-items error:", e)
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+    results = []
+    for target, outcome in zip(targets, outcomes):
+        row = {"item_id": target["item_id"], "image_index": target["image_index"]}
+        if isinstance(outcome, Exception):
+            row.update({"status": "error", "message": str(outcome)})
+        else:
+            row.update({"status": "success", **outcome})
+        results.append(row)
+
+    embedded = sum(1 for r in results if r["status"] == "success")
+    return jsonify({
+        "status": "success" if embedded == len(results) else ("partial" if embedded else "error"),
+        "results": results,
+        "meta": {
+            "images": len(results),
+            "embedded": embedded,
+            **timings,
+            "total_ms": round((time.time() - start) * 1000, 2)
+        }
+    }), 200 if embedded else 502
+
+IMAGE_SEARCH_MAX_K = 50
+
+@app.route("/image-search", methods=["POST"])
+def image_search():
+    """
+    Find items that look like a photo: {shop_id, image_url | vector, k?, min_score?, nprobe?, exact?}
+    or multipart with an "image" file. Top-K by cosine similarity over the shop's
+    embedding matrix (IVF-approximate for big catalogues unless exact=1),
+    returned in the /sales result shape plus "similarity".
+    """
+    try:
+        start = time.time()
+        if request.files:
+            data = request.form.to_dict()
+            target = {"image_bytes": request.files["image"].read()}
+        else:
+            data = request.get_json(force=True) or {}
+            target = {"image_url": data.get("image_url")}
+
+        shop_id = data.get("shop_id")
+        k = min(max(int(data.get("k", 10)), 1), IMAGE_SEARCH_MAX_K)
+        min_score = float(data["min_score"]) if data.get("min_score") not in (None, "") else None
+        nprobe = int(data["nprobe"]) if data.get("nprobe") not in (None, "") else None
+        exact = str(data.get("exact", "")).lower() in ("1", "true")
+        if not shop_id:
+            return jsonify({"status": "error", "message": "shop_id is required"}), 400
+
+        if data.get("vector") is not None:
+            query_vector = np.asarray(data["vector"], dtype=np.float32)
+        elif target.get("image_bytes") is not None or target.get("image_url"):
+            if not IMAGE_EMBEDDINGS_ENABLED:
+                return image_embeddings_unavailable()  # a precomputed "vector" still works
+            query_vector = embed_images([load_item_image(target)])[0]
+        else:
+            return jsonify({"status": "error", "message": "image_url, vector or an image upload is required"}), 400
+        embed_ms = round((time.time() - start) * 1000, 2)
+
+        search_index = acquire_shop_index(shop_id)
+        if search_index is None:
+            return jsonify({"status": "error", "message": "Shop not found or has no items"}), 404
+
+        vectors = search_index["vectors"]
+        with span("vector_search"):
+            matches = vectors.search(query_vector, k=k, min_score=min_score, nprobe=nprobe, exact=exact)
+        approximate = vectors.centroids is not None and not exact and (nprobe or vectors.nprobe) < len(vectors.centroids)
+
+        items = []
+        for item_id, score in matches:
+            rows = build_lookup_rows(search_index, search_index["by_item_id"].get(item_id), None, [])
+            for row in rows:
+                row["similarity"] = round(score, 4)
+            items.extend(rows)
+
+        return jsonify({
+            "items": items,
+            "meta": {
+                "shop_id": shop_id,
+                "k": k,
+                "matches": len(matches),
+                "mode": "ivf" if approximate else "exact",
+                "indexed": vectors.stats(),
+                "embed_ms": embed_ms,
+                "total_ms": round((time.time() - start) * 1000, 2),
+                "cache_version": embedding_cache_full["version"]
+            }
+        })
+
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    except Exception as e:
+        print("🔥 /image-search error:", e)
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@app.route("/vectorize-item/jobs/<job_id>", methods=["GET"])
+def vectorize_item_job(job_id):
+    job = vectorize_pipeline.status(job_id)
+    if job is None:
+        return jsonify({"status": "error", "message": "Unknown or expired job"}), 404
+    return jsonify({"status": "success", "job": job})
+
+@app.route("/vectorize-item/stats", methods=["GET"])
+def vectorize_item_stats():
+    """Queue depth, busy workers, retries and batch sizes of the embedding pipeline"""
+    return jsonify({"status": "success", "pipeline": vectorize_pipeline.stats()})
+
+
+# ======================================================
+# SALES SEARCH HELPERS (shared by /sales and /sales/batch)
+# ======================================================
+def get_cart_reservations(item_id, batch_id=None):
+    """Get reserved quantities from active carts (simulated)"""
+    return 0
+
+def calculate_real_availability(batch, unit_type="base", conversion_factor=1):
+    """Calculate REAL available quantity considering cart reservations - FIXED CONVERSION!"""
+    batch_id = batch.get("batch_id")
+    item_id = batch.get("item_id", "")
+
+    # Micro-units: exact comparisons instead of float tolerances
+    reserved = to_micro(get_cart_reservations(item_id, batch_id))
+    real_available = max(0, to_micro(batch.get("quantity", 0)) - reserved)
+
+    if unit_type == "selling_unit" and conversion_factor > 0:
+        # FIXED: MULTIPLY by conversion_factor, not divide!
+        # Example: 1 carton × 10 = 10 Ram sticks available
+        available_selling_units = mul_ratio(real_available, conversion_factor, "floor")
+
+        # Selling units can be sold as long as there's ANY stock (1 micro-unit)
+        can_fulfill_selling_unit = available_selling_units >= 1
+
+        return {
+            "real_quantity": from_micro(real_available),  # In parent units (e.g., cartons)
+            "available_selling_units": from_micro(available_selling_units),  # In selling units (e.g., Ram sticks)
+            "can_fulfill_base": real_available >= to_micro(1),
+            "can_fulfill_selling_unit": can_fulfill_selling_unit,
+            "is_partial": available_selling_units < to_micro(1)  # For UI display
+        }
+    else:
+        # Base units logic
+        return {
+            "real_quantity": from_micro(real_available),
+            "available_selling_units": 0,
+            "can_fulfill_base": real_available >= to_micro(1),
+            "can_fulfill_selling_unit": False,
+            "is_partial": False
+        }
+
+@timed("batch_selection")
+def find_best_batch_for_unit(batches, unit_type, conversion_factor=1, current_batch_id=None):
+    """Find the best batch for a specific unit type"""
+    if not batches:
+        return None, []
+
+    sorted_batches = sorted(batches, key=lambda b: b.get("timestamp", 0))
+    best_batch = None
+    alternative_batches = []
+
+    for batch in sorted_batches:
+        availability = calculate_real_availability(batch, unit_type, conversion_factor)
+
+        is_current_batch = (current_batch_id == batch.get("batch_id"))
+
+        if unit_type == "base":
+            can_fulfill = availability["can_fulfill_base"]
+        else:
+            can_fulfill = availability["can_fulfill_selling_unit"]
+
+        batch_info = {
+            "batch": batch,
+            "availability": availability,
+            "can_fulfill": can_fulfill,
+            "is_current": is_current_batch,
+            "available_selling_units": availability.get("available_selling_units", 0)
+        }
+
+        if is_current_batch and can_fulfill:
+            return batch_info, alternative_batches
+
+        if can_fulfill and not best_batch:
+            best_batch = batch_info
+        else:
+            alternative_batches.append(batch_info)
+
+    # If no batch can fulfill, return the first batch anyway
+    if not best_batch and sorted_batches:
+        first_batch = sorted_batches[0]
+        availability = calculate_real_availability(first_batch, unit_type, conversion_factor)
+        best_batch = {
+            "batch": first_batch,
+            "availability": availability,
+            "can_fulfill": availability.get("can_fulfill_selling_unit", False),
+            "is_current": False,
+            "is_fallback": True,
+            "available_selling_units": availability.get("available_selling_units", 0)
+        }
+        print(f"        🔄 Using fallback batch")
+
+    return best_batch, alternative_batches
+
+def generate_notifications(batch_info, unit_type, conversion_factor=1):
+    """Generate smart notifications for batch"""
+    notifications = []
+    batch = batch_info.get("batch", {})
+    availability = batch_info.get("availability", {})
+
+    if not batch:
+        return notifications
+
+    if unit_type == "base":
+        # Base unit notifications
+        real_qty = availability.get("real_quantity", 0)
+        if 0 < real_qty < 5:
+            notifications.append({
+                "type": "low_stock_warning",
+                "message": f"Only {real_qty:.1f} base units left in '{batch.get('batch_name', 'current')}' batch",
+                "severity": "warning"
+            })
+    else:
+        # Selling unit notifications
+        available_units = availability.get("available_selling_units", 0)
+        if available_units > 0:
+            if available_units < 3:
+                notifications.append({
+                    "type": "low_stock_warning",
+                    "message": f"Only {available_units:.1f} selling units left in '{batch.get('batch_name', 'current')}' batch",
+                    "severity": "warning"
+                })
+
+            # Check if it's a partial unit (less than 1)
+            if 0 < available_units < 1:
+                notifications.append({
+                    "type": "partial_stock",
+                    "message": f"Partial stock available ({available_units:.2f} units)",
+                    "severity": "info"
+                })
+
+    # Insufficient quantity warning
+    if not batch_info.get("can_fulfill", False):
+        if unit_type == "base":
+            notifications.append({
+                "type": "insufficient_for_base",
+                "message": "Not enough for base units (needs ≥1)",
+                "severity": "error",
+                "suggestion": "Try selling units instead"
+            })
+        else:
+            # For selling units, check if there's ANY stock
+            if availability.get("available_selling_units", 0) <= 0:
+                notifications.append({
+                    "type": "out_of_stock",
+                    "message": "Out of stock for selling units",
+                    "severity": "error"
+                })
+            else:
+                # There's some stock but maybe not enough
+                notifications.append({
+                    "type": "limited_stock",
+                    "message": "Limited stock available",
+                    "severity": "warning"
+                })
+
+    return notifications
+
+def build_item_search_results(item, category, query, query_tokens, search_debug_info, match_all=False):
+    """
+    Build the /sales result rows (main item + matching selling units) for one cached item.
+    match_all=True skips scoring and returns every unit (item_id / barcode lookups).
+    """
+    results = []
+    category_id = category.get("category_id")
+    category_name = category.get("category_name")
+    item_name = item.get("name", "")
+    item_id = item.get("item_id")
+    batches = item.get("batches", [])
+
+    if not batches:
+        print(f"      ⚠️  Skipping '{item_name}' - no batches")
+        return results
+
+    print(f"\n    📍 Item: '{item_name}' (ID: {item_id})")
+    print(f"      Has {len(batches)} batch(es), {len(item.get('selling_units', []))} selling unit(s)")
+
+    def score_text(text, debug_name=""):
+        if match_all:
+            return 100, [f"Direct lookup of item '{item_id}'"]
+        return calculate_multi_token_score(text, query, query_tokens, debug_name)
+
+    current_batch_id = None
+
+    # --------------------------------------------------
+    # PROCESS MAIN ITEM (BASE UNITS)
+    # --------------------------------------------------
+    print(f"      🔍 Checking main item match...")
+    main_item_score, main_item_debug = score_text(
+        item_name, f"Main Item '{item_name}'"
+    )
+    main_item_matches = main_item_score > 0
+
+    if main_item_matches:
+        print(f"      ✅ MAIN ITEM MATCHED with score {main_item_score}")
+
+        best_batch_info, alternative_batches = find_best_batch_for_unit(
+            batches, "base", current_batch_id=current_batch_id
+        )
+
+        if best_batch_info:
+            batch = best_batch_info["batch"]
+            availability = best_batch_info["availability"]
+            notifications = generate_notifications(best_batch_info, "base")
+
+            real_qty = availability["real_quantity"]
+            if real_qty >= 1:
+                batch_status = "active_healthy" if real_qty > 3 else "active_low_stock"
+            elif real_qty > 0:
+                batch_status = "insufficient_for_base"
+            else:
+                batch_status = "exhausted"
+
+            next_available_batch = None
+            for alt in alternative_batches:
+                if alt.get("can_fulfill", False):
+                    next_available_batch = alt["batch"]
+                    break
+
+            main_item_response = {
+                "type": "main_item",
+                "item_id": item_id,
+                "main_item_id": item_id,
+                "category_id": item.get("category_id") or category_id,
+                "category_name": item.get("category_name") or category_name,
+                "name": item_name,
+                "display_name": item_name,
+                "thumbnail": item.get("thumbnail"),
+                "batch_status": batch_status,
+                "batch_id": batch.get("batch_id"),
+                "batch_name": batch.get("batch_name"),
+                "batch_remaining": availability["real_quantity"],
+                "real_available": availability["real_quantity"],
+                "price": round(float(batch.get("sell_price", 0)), 2),
+                "base_unit": batch.get("unit", item.get("base_unit", "unit")),
+                "batch_switch_required": not best_batch_info.get("can_fulfill", False),
+                "can_fulfill": best_batch_info.get("can_fulfill", False),
+                "is_current_batch": best_batch_info.get("is_current", False),
+                "next_batch_available": next_available_batch is not None,
+                "next_batch_id": next_available_batch.get("batch_id") if next_available_batch else None,
+                "next_batch_name": next_available_batch.get("batch_name") if next_available_batch else None,
+                "next_batch_price": round(float(next_available_batch.get("sell_price", 0)), 2) if next_available_batch else None,
+                "notifications": notifications,
+                "unit_type": "base",
+                "search_score": main_item_score,
+                "parent_item_name": item_name,
+                "debug": {
+                    "match_type": "main_item_direct",
+                    "matched_text": item_name,
+                    "score_calculation": main_item_debug,
+                    "query_used": query,
+                    "batch_availability": real_qty
+                }
+            }
+            results.append(main_item_response)
+
+            search_debug_info.append({
+                "item_name": item_name,
+                "type": "main_item",
+                "score": main_item_score,
+                "batch_status": batch_status,
+                "can_fulfill": best_batch_info.get("can_fulfill", False)
+            })
+
+            print(f"      📝 Added to results (score: {main_item_score}, batch: {batch_status})")
+        else:
+            print(f"      ⚠️  No suitable batch found")
+    else:
+        print(f"      ❌ No match for main item")
+
+    # --------------------------------------------------
+    # PROCESS SELLING UNITS WITH CORRECTED CONVERSION
+    # --------------------------------------------------
+    selling_units = item.get("selling_units", [])
+
+    if selling_units:
+        print(f"      🔍 Checking {len(selling_units)} selling unit(s)...")
+
+    for su_idx, su in enumerate(selling_units):
+        su_name = su.get("name", "")
+        su_display_name = su.get("display_name", su_name)
+
+        su_scores = []
+        su_debug_info = []
+
+        su_name_score, su_name_debug = score_text(
+            su_name, f"SU Name '{su_name}'"
+        )
+        if su_name_score > 0:
+            su_scores.append(("su_name", su_name_score))
+            su_debug_info.extend([f"SU Name: {d}" for d in su_name_debug])
+
+        su_display_score, su_display_debug = score_text(
+            su_display_name, f"SU Display '{su_display_name}'"
+        )
+        if su_display_score > 0:
+            su_scores.append(("su_display", su_display_score))
+            su_debug_info.extend([f"SU Display: {d}" for d in su_display_debug])
+
+        parent_item_score, parent_debug = score_text(item_name, f"Parent '{item_name}'")
+        if parent_item_score > 50:
+            inherited_score = parent_item_score * 0.7
+            su_scores.append(("parent_inherited", inherited_score))
+            su_debug_info.extend([f"Parent Inheritance: {d} (inherited: {inherited_score:.1f})" for d in parent_debug])
+
+        # Tokens split across unit and parent (e.g. 'milk half' → 'Half' of 'Fresh Milk')
+        if not su_scores and len(query_tokens) > 1:
+            combined_text = f"{su_name} {item_name}"
+            combined_score, combined_debug = score_text(
+                combined_text, f"SU + Parent '{combined_text}'"
+            )
+            if combined_score > 0:
+                su_scores.append(("su_and_parent", combined_score))
+                su_debug_info.extend([f"SU + Parent: {d}" for d in combined_debug])
+
+        if su_scores:
+            best_score_type, max_score = max(su_scores, key=lambda x: x[1])
+
+            if max_score > 30:
+                print(f"      ✅ Selling Unit {su_idx+1}: '{su_display_name}' matched via {best_score_type} (score: {max_score:.1f})")
+
+                conversion = float(su.get("conversion_factor", 1))
+                if conversion <= 0:
+                    print(f"      ⚠️  Skipping - invalid conversion factor: {conversion}")
+                    continue
+
+                # Find the best batch for this selling unit
+                best_batch_info, alternative_batches = find_best_batch_for_unit(
+                    batches, "selling_unit", conversion, current_batch_id
+                )
+
+                batch = None
+                availability = None
+                can_fulfill = False
+                batch_status = "no_suitable_batch"
+                notifications = []
+                unit_price = 0
+                available_selling_units = 0
+
+                if best_batch_info:
+                    batch = best_batch_info["batch"]
+                    availability = best_batch_info["availability"]
+                    notifications = generate_notifications(best_batch_info, "selling_unit", conversion)
+                    can_fulfill = best_batch_info.get("can_fulfill", False)
+                    available_selling_units = availability.get("available_selling_units", 0)
+
+                    # Determine batch status
+                    if available_selling_units >= 1:
+                        batch_status = "active_healthy" if available_selling_units > 10 else "active_low_stock"
+                    elif available_selling_units > 0:
+                        batch_status = "partial_stock"
+                    else:
+                        batch_status = "out_of_stock"
+
+                    # Calculate price per selling unit
+                    if batch and conversion > 0:
+                        unit_price = float(batch.get("sell_price", 0)) / conversion
+
+                    print(f"        ✅ Found batch: {batch.get('batch_name', 'unnamed')}")
+                    print(f"        📊 Available selling units: {available_selling_units} (conversion: {conversion})")
+                else:
+                    print(f"        ⚠️  No suitable batch found, showing anyway")
+
+                    if batches:
+                        # Use first batch for display purposes
+                        first_batch = sorted(batches, key=lambda b: b.get("timestamp", 0))[0]
+                        batch = first_batch
+                        availability = calculate_real_availability(first_batch, "selling_unit", conversion)
+                        available_selling_units = availability.get("available_selling_units", 0)
+
+                        if conversion > 0 and batch.get("sell_price"):
+                            unit_price = float(batch.get("sell_price", 0)) / conversion
+
+                        notifications = [{
+                            "type": "no_batch_link",
+                            "message": "No batch link configured",
+                            "severity": "warning"
+                        }]
+                        batch_status = "no_batch_link"
+                    else:
+                        notifications = [{
+                            "type": "no_batches",
+                            "message": "No stock batches available",
+                            "severity": "error"
+                        }]
+                        batch_status = "no_batches"
+
+                # Find next available batch
+                next_available_batch = None
+                if alternative_batches:
+                    for alt in alternative_batches:
+                        if alt.get("can_fulfill", False):
+                            next_available_batch = alt["batch"]
+                            break
+
+                next_unit_price = None
+                if next_available_batch and conversion > 0:
+                    next_unit_price = float(next_available_batch.get("sell_price", 0)) / conversion
+
+                # Create selling unit response
+                selling_unit_response = {
+                    "type": "selling_unit",
+                    "item_id": item_id,
+                    "main_item_id": item_id,
+                    "sell_unit_id": su.get("sell_unit_id"),
+                    "category_id": item.get("category_id") or category_id,
+                    "category_name": item.get("category_name") or category_name,
+                    "name": f"{su_name}",
+                    "display_name": su_display_name,
+                    "parent_item_name": item_name,
+                    "thumbnail": su.get("thumbnail") or item.get("thumbnail"),
+                    "batch_status": batch_status,
+                    "batch_id": batch.get("batch_id") if batch else None,
+                    "batch_name": batch.get("batch_name") if batch else None,
+                    "batch_remaining": availability["real_quantity"] if availability else 0,
+                    "real_available_units": available_selling_units,  # This is now CORRECT!
+                    "real_available_fraction": 0,  # Not used with new logic
+                    "price": round(unit_price, 4),
+                    "available_stock": round(float(batch.get("quantity", 0)) if batch else 0, 2),
+                    "conversion_factor": conversion,
+                    "base_unit": batch.get("unit", item.get("base_unit", "unit")) if batch else item.get("base_unit", "unit"),
+                    "batch_switch_required": not can_fulfill and available_selling_units <= 0,
+                    "can_fulfill": can_fulfill,
+                    "is_current_batch": best_batch_info.get("is_current", False) if best_batch_info else False,
+                    "next_batch_available": next_available_batch is not None,
+                    "next_batch_id": next_available_batch.get("batch_id") if next_available_batch else None,
+                    "next_batch_name": next_available_batch.get("batch_name") if next_available_batch else None,
+                    "next_batch_price": round(next_unit_price, 4) if next_unit_price else None,
+                    "has_batch_links": len(su.get("batch_links", [])) > 0,
+                    "batch_links": su.get("batch_links", []),
+                    "notifications": notifications,
+                    "unit_type": "selling_unit",
+                    "search_score": max_score,
+                    "matched_by": best_score_type,
+                    "debug": {
+                        "match_type": best_score_type,
+                        "matched_text": su_display_name if best_score_type == "su_display" else su_name,
+                        "score_calculation": su_debug_info,
+                        "parent_item": item_name,
+                        "parent_score": parent_item_score,
+                        "query_used": query,
+                        "batch_available_units": available_selling_units,
+                        "conversion_applied": conversion,
+                        "parent_batch_qty": batch.get("quantity", 0) if batch else 0
+                    }
+                }
+                results.append(selling_unit_response)
+
+                search_debug_info.append({
+                    "item_name": f"{item_name} → {su_display_name}",
+                    "type": "selling_unit",
+                    "score": max_score,
+                    "match_type": best_score_type,
+                    "batch_status": batch_status,
+                    "can_fulfill": can_fulfill,
+                    "available_units": available_selling_units,
+                    "conversion": conversion
+                })
+
+                print(f"      📝 Added selling unit (score: {max_score:.1f}, status: {batch_status}, units: {available_selling_units})")
+            else:
+                print(f"      ❌ Selling unit score too low: {max_score:.1f} (threshold: 30)")
+        else:
+            if len(selling_units) <= 3:
+                print(f"      ❌ Selling Unit {su_idx+1}: '{su_display_name}' - no match")
+
+    return results
+
+def sort_search_results(results):
+    """
+    Sort with priority:
+    1. Can fulfill (available for sale)
+    2. Higher search score
+    3. More available units
+    4. Main items before selling units
+    5. Alphabetical
+    """
+    results.sort(key=lambda x: (
+        not x.get("can_fulfill", False),
+        -x.get("search_score", 0),
+        -x.get("real_available_units", 0),
+        x.get("type") == "selling_unit",
+        x.get("name", "").lower()
+    ))
+    return results
+
+@timed("search_scoring")
+def search_shop_index(search_index, query, search_debug_info):
+    """
+    Run one query against a shop's token index.
+    Only items holding every query token are scored (posting-list intersection).
+    """
+    query_tokens = tokenize_search_text(query)
+    candidate_positions = find_candidate_entries(search_index, query_tokens)
+    print(f"\n🔍 SEARCHING ACROSS SHOP '{search_index['shop'].get('shop_name', 'Unnamed')}'...")
+    print(f"🧩 Tokens: {query_tokens} → {len(candidate_positions)} candidate item(s) of {len(search_index['entries'])}")
+
+    results = []
+    total_items_scanned = 0
+    total_selling_units_scanned = 0
+    current_category = None
+
+    for position in candidate_positions:
+        category, item = search_index["entries"][position]
+        if category is not current_category:
+            current_category = category
+            print(f"\n  📂 Category: {category.get('category_name')} (ID: {category.get('category_id')})")
+            print(f"  {'─'*60}")
+
+        if item.get("batches"):
+            total_items_scanned += 1
+            total_selling_units_scanned += len(item.get("selling_units", []))
+
+        results.extend(build_item_search_results(item, category, query, query_tokens, search_debug_info))
+
+    return {
+        "results": sort_search_results(results),
+        "query_tokens": query_tokens,
+        "candidate_items": len(candidate_positions),
+        "items_scanned": total_items_scanned,
+        "selling_units_scanned": total_selling_units_scanned
+    }
+
+def build_lookup_rows(search_index, position, sell_unit_id, search_debug_info):
+    """
+    Rows for a direct (non-scored) lookup of one indexed item.
+    With sell_unit_id only that selling unit is returned, otherwise the main item.
+    """
+    if position is None:
+        return []
+
+    category, item = search_index["entries"][position]
+    rows = build_item_search_results(item, category, "", [], search_debug_info, match_all=True)
+    if sell_unit_id:
+        return [r for r in rows if r.get("sell_unit_id") == sell_unit_id]
+    return [r for r in rows if r.get("type") == "main_item"] or rows
+
+@timed("scan_lookup")
+def lookup_scan_code(search_index, code, search_debug_info):
+    """O(1) barcode/SKU lookup → (rows, matched sell_unit_id or None)"""
+    hit = search_index["by_code"].get(normalize_scan_code(code))
+    if not hit:
+        return [], None
+    position, sell_unit_id = hit
+    return build_lookup_rows(search_index, position, sell_unit_id, search_debug_info), sell_unit_id
+
 
 # ======================================================
 # ======================================================
@@ -595,7 +2260,8 @@ def sales():
         print(f"\n{'='*80}")
         print(f"🔍 SEARCH REQUEST RECEIVED at {time.strftime('%H:%M:%S')}")
         print(f"{'='*80}")
-        print(f"📋 Request Data: {json.dumps(data, indent=2)}")
+        if app.debug:  # serializing the whole body on every search is too costly outside debug runs
+            print(f"📋 Request Data: {app.json.dumps(data)}")
 
         # Get query and shop_id
         query = (data.get("query") or "").lower().strip()
@@ -619,7 +2285,8 @@ def sales():
 
         # Find shop in cache
         print(f"\n📦 LOOKING FOR SHOP {shop_id} IN CACHE...")
-        shop = next((s for s in embedding_cache_full["shops"] if s["shop_id"] == shop_id), None)
+        search_index = acquire_shop_index(shop_id)
+        shop = search_index["shop"] if search_index else None
         if not shop:
             print(f"❌ Shop {shop_id} NOT FOUND in cache")
             return jsonify({
@@ -634,552 +2301,12 @@ def sales():
         print(f"✅ Found shop: {shop_name}")
         print(f"📊 Shop has {len(shop.get('categories', []))} categories")
         
-        results = []
         search_debug_info = []
-
-        # --------------------------------------------------
-        # HELPER FUNCTIONS FOR SMART BATCH LOGIC - FIXED!
-        # --------------------------------------------------
-        
-        def get_cart_reservations(item_id, batch_id=None):
-            """Get reserved quantities from active carts (simulated)"""
-            return 0
-        
-        def calculate_real_availability(batch, unit_type="base", conversion_factor=1):
-            """Calculate REAL available quantity considering cart reservations - FIXED CONVERSION!"""
-            batch_qty = float(batch.get("quantity", 0))
-            batch_id = batch.get("batch_id")
-            item_id = batch.get("item_id", "")
-            
-            reserved = get_cart_reservations(item_id, batch_id)
-            real_available = max(0, batch_qty - reserved)
-            
-            if unit_type == "selling_unit" and conversion_factor > 0:
-                # FIXED: MULTIPLY by conversion_factor, not divide!
-                # Example: 1 carton × 10 = 10 Ram sticks available
-                available_selling_units = real_available * conversion_factor
-                
-                # Selling units can be sold as long as there's ANY stock
-                can_fulfill_selling_unit = available_selling_units >= 0.000001
-                
-                return {
-                    "real_quantity": real_available,  # In parent units (e.g., cartons)
-                    "available_selling_units": available_selling_units,  # In selling units (e.g., Ram sticks)
-                    "can_fulfill_base": real_available >= 1,
-                    "can_fulfill_selling_unit": can_fulfill_selling_unit,
-                    "is_partial": available_selling_units < 1  # For UI display
-                }
-            else:
-                # Base units logic
-                return {
-                    "real_quantity": real_available,
-                    "available_selling_units": 0,
-                    "can_fulfill_base": real_available >= 1,
-                    "can_fulfill_selling_unit": False,
-                    "is_partial": False
-                }
-        
-        def find_best_batch_for_unit(batches, unit_type, conversion_factor=1, current_batch_id=None):
-            """Find the best batch for a specific unit type"""
-            if not batches:
-                return None, []
-            
-            sorted_batches = sorted(batches, key=lambda b: b.get("timestamp", 0))
-            best_batch = None
-            alternative_batches = []
-            
-            for batch in sorted_batches:
-                availability = calculate_real_availability(batch, unit_type, conversion_factor)
-                
-                is_current_batch = (current_batch_id == batch.get("batch_id"))
-                
-                if unit_type == "base":
-                    can_fulfill = availability["can_fulfill_base"]
-                else:
-                    can_fulfill = availability["can_fulfill_selling_unit"]
-                
-                batch_info = {
-                    "batch": batch,
-                    "availability": availability,
-                    "can_fulfill": can_fulfill,
-                    "is_current": is_current_batch,
-                    "available_selling_units": availability.get("available_selling_units", 0)
-                }
-                
-                if is_current_batch and can_fulfill:
-                    return batch_info, alternative_batches
-                
-                if can_fulfill and not best_batch:
-                    best_batch = batch_info
-                else:
-                    alternative_batches.append(batch_info)
-            
-            # If no batch can fulfill, return the first batch anyway
-            if not best_batch and sorted_batches:
-                first_batch = sorted_batches[0]
-                availability = calculate_real_availability(first_batch, unit_type, conversion_factor)
-                best_batch = {
-                    "batch": first_batch,
-                    "availability": availability,
-                    "can_fulfill": availability.get("can_fulfill_selling_unit", False),
-                    "is_current": False,
-                    "is_fallback": True,
-                    "available_selling_units": availability.get("available_selling_units", 0)
-                }
-                print(f"        🔄 Using fallback batch")
-            
-            return best_batch, alternative_batches
-        
-        def generate_notifications(batch_info, unit_type, conversion_factor=1):
-            """Generate smart notifications for batch"""
-            notifications = []
-            batch = batch_info.get("batch", {})
-            availability = batch_info.get("availability", {})
-            
-            if not batch:
-                return notifications
-            
-            if unit_type == "base":
-                # Base unit notifications
-                real_qty = availability.get("real_quantity", 0)
-                if 0 < real_qty < 5:
-                    notifications.append({
-                        "type": "low_stock_warning",
-                        "message": f"Only {real_qty:.1f} base units left in '{batch.get('batch_name', 'current')}' batch",
-                        "severity": "warning"
-                    })
-            else:
-                # Selling unit notifications
-                available_units = availability.get("available_selling_units", 0)
-                if available_units > 0:
-                    if available_units < 3:
-                        notifications.append({
-                            "type": "low_stock_warning",
-                            "message": f"Only {available_units:.1f} selling units left in '{batch.get('batch_name', 'current')}' batch",
-                            "severity": "warning"
-                        })
-                    
-                    # Check if it's a partial unit (less than 1)
-                    if 0 < available_units < 1:
-                        notifications.append({
-                            "type": "partial_stock",
-                            "message": f"Partial stock available ({available_units:.2f} units)",
-                            "severity": "info"
-                        })
-            
-            # Insufficient quantity warning
-            if not batch_info.get("can_fulfill", False):
-                if unit_type == "base":
-                    notifications.append({
-                        "type": "insufficient_for_base",
-                        "message": "Not enough for base units (needs ≥1)",
-                        "severity": "error",
-                        "suggestion": "Try selling units instead"
-                    })
-                else:
-                    # For selling units, check if there's ANY stock
-                    if availability.get("available_selling_units", 0) <= 0:
-                        notifications.append({
-                            "type": "out_of_stock",
-                            "message": "Out of stock for selling units",
-                            "severity": "error"
-                        })
-                    else:
-                        # There's some stock but maybe not enough
-                        notifications.append({
-                            "type": "limited_stock",
-                            "message": "Limited stock available",
-                            "severity": "warning"
-                        })
-            
-            return notifications
-        
-        # --------------------------------------------------
-        # ENHANCED SEARCH SCORING FUNCTION
-        # --------------------------------------------------
-        
-        def calculate_search_score(text, search_query, debug_name=""):
-            """Calculate search relevance score (0-100) with detailed debugging"""
-            if not text or not search_query:
-                if debug_name:
-                    print(f"    {debug_name}: No text or query (score: 0)")
-                return 0, []
-            
-            text_lower = text.lower()
-            query_lower = search_query.lower()
-            
-            debug_steps = []
-            
-            if text_lower == query_lower:
-                debug_steps.append(f"Exact match: '{text}' == '{search_query}'")
-                if debug_name:
-                    print(f"    {debug_name}: ✅ EXACT MATCH (score: 100)")
-                return 100, debug_steps
-            
-            if text_lower.startswith(query_lower):
-                debug_steps.append(f"Starts with query: '{text}' starts with '{search_query}'")
-                if debug_name:
-                    print(f"    {debug_name}: ✅ STARTS WITH (score: 90)")
-                return 90, debug_steps
-            
-            words = text_lower.split()
-            for word in words:
-                if word.startswith(query_lower):
-                    debug_steps.append(f"Word starts with: word '{word}' in '{text}' starts with '{search_query}'")
-                    if debug_name:
-                        print(f"    {debug_name}: ✅ WORD STARTS WITH (score: 85)")
-                    return 85, debug_steps
-            
-            padded_text = f" {text_lower} "
-            padded_query = f" {query_lower} "
-            if padded_query in padded_text:
-                debug_steps.append(f"Whole word match: '{search_query}' found as whole word in '{text}'")
-                if debug_name:
-                    print(f"    {debug_name}: ✅ WHOLE WORD MATCH (score: 80)")
-                return 80, debug_steps
-            
-            if query_lower in text_lower:
-                position = text_lower.find(query_lower)
-                position_penalty = min(position * 0.5, 10)
-                score = max(70, 79 - position_penalty)
-                debug_steps.append(f"Partial match at position {position}: '{search_query}' found in '{text}' (penalty: {position_penalty:.1f})")
-                if debug_name:
-                    print(f"    {debug_name}: ✅ PARTIAL MATCH at position {position} (score: {score:.1f})")
-                return score, debug_steps
-            
-            debug_steps.append(f"No match: '{search_query}' not found in '{text}'")
-            if debug_name:
-                print(f"    {debug_name}: ❌ NO MATCH (score: 0)")
-            return 0, debug_steps
-
-        # --------------------------------------------------
-        # IMPROVED SEARCH LOGIC
-        # --------------------------------------------------
-        
-        print(f"\n🔍 SEARCHING ACROSS SHOP '{shop_name}'...")
-        total_items_scanned = 0
-        total_selling_units_scanned = 0
-        
-        for category_idx, category in enumerate(shop.get("categories", [])):
-            category_id = category.get("category_id")
-            category_name = category.get("category_name")
-            
-            print(f"\n  📂 Category {category_idx+1}: {category_name} (ID: {category_id})")
-            print(f"  {'─'*60}")
-
-            for item_idx, item in enumerate(category.get("items", [])):
-                item_name = item.get("name", "")
-                item_name_lower = item_name.lower()
-                item_id = item.get("item_id")
-                batches = item.get("batches", [])
-                
-                if not batches:
-                    continue
-                
-                total_items_scanned += 1
-                
-                print(f"\n    📍 Item {item_idx+1}: '{item_name}' (ID: {item_id})")
-                print(f"      Has {len(batches)} batch(es), {len(item.get('selling_units', []))} selling unit(s)")
-                
-                batches = item.get("batches", [])
-                if not batches:
-                    print(f"      ⚠️  Skipping - no batches")
-                    continue
-                
-                current_batch_id = None
-                
-                # --------------------------------------------------
-                # PROCESS MAIN ITEM (BASE UNITS)
-                # --------------------------------------------------
-                print(f"      🔍 Checking main item match...")
-                main_item_score, main_item_debug = calculate_search_score(
-                    item_name, query, f"Main Item '{item_name}'"
-                )
-                main_item_matches = main_item_score > 0
-                
-                if main_item_matches:
-                    print(f"      ✅ MAIN ITEM MATCHED with score {main_item_score}")
-                    
-                    best_batch_info, alternative_batches = find_best_batch_for_unit(
-                        batches, "base", current_batch_id=current_batch_id
-                    )
-                    
-                    if best_batch_info:
-                        batch = best_batch_info["batch"]
-                        availability = best_batch_info["availability"]
-                        notifications = generate_notifications(best_batch_info, "base")
-                        
-                        real_qty = availability["real_quantity"]
-                        if real_qty >= 1:
-                            batch_status = "active_healthy" if real_qty > 3 else "active_low_stock"
-                        elif real_qty > 0:
-                            batch_status = "insufficient_for_base"
-                        else:
-                            batch_status = "exhausted"
-                        
-                        next_available_batch = None
-                        for alt in alternative_batches:
-                            if alt.get("can_fulfill", False):
-                                next_available_batch = alt["batch"]
-                                break
-                        
-                        main_item_response = {
-                            "type": "main_item",
-                            "item_id": item_id,
-                            "main_item_id": item_id,
-                            "category_id": item.get("category_id") or category_id,
-                            "category_name": item.get("category_name") or category_name,
-                            "name": item_name,
-                            "display_name": item_name,
-                            "thumbnail": item.get("thumbnail"),
-                            "batch_status": batch_status,
-                            "batch_id": batch.get("batch_id"),
-                            "batch_name": batch.get("batch_name"),
-                            "batch_remaining": availability["real_quantity"],
-                            "real_available": availability["real_quantity"],
-                            "price": round(float(batch.get("sell_price", 0)), 2),
-                            "base_unit": batch.get("unit", item.get("base_unit", "unit")),
-                            "batch_switch_required": not best_batch_info.get("can_fulfill", False),
-                            "can_fulfill": best_batch_info.get("can_fulfill", False),
-                            "is_current_batch": best_batch_info.get("is_current", False),
-                            "next_batch_available": next_available_batch is not None,
-                            "next_batch_id": next_available_batch.get("batch_id") if next_available_batch else None,
-                            "next_batch_name": next_available_batch.get("batch_name") if next_available_batch else None,
-                            "next_batch_price": round(float(next_available_batch.get("sell_price", 0)), 2) if next_available_batch else None,
-                            "notifications": notifications,
-                            "unit_type": "base",
-                            "search_score": main_item_score,
-                            "parent_item_name": item_name,
-                            "debug": {
-                                "match_type": "main_item_direct",
-                                "matched_text": item_name,
-                                "score_calculation": main_item_debug,
-                                "query_used": query,
-                                "batch_availability": real_qty
-                            }
-                        }
-                        results.append(main_item_response)
-                        
-                        search_debug_info.append({
-                            "item_name": item_name,
-                            "type": "main_item",
-                            "score": main_item_score,
-                            "batch_status": batch_status,
-                            "can_fulfill": best_batch_info.get("can_fulfill", False)
-                        })
-                        
-                        print(f"      📝 Added to results (score: {main_item_score}, batch: {batch_status})")
-                    else:
-                        print(f"      ⚠️  No suitable batch found")
-                else:
-                    print(f"      ❌ No match for main item")
-
-                # --------------------------------------------------
-                # PROCESS SELLING UNITS WITH CORRECTED CONVERSION
-                # --------------------------------------------------
-                selling_units = item.get("selling_units", [])
-                total_selling_units_scanned += len(selling_units)
-                
-                if selling_units:
-                    print(f"      🔍 Checking {len(selling_units)} selling unit(s)...")
-                
-                for su_idx, su in enumerate(selling_units):
-                    su_name = su.get("name", "")
-                    su_display_name = su.get("display_name", su_name)
-                    
-                    su_scores = []
-                    su_debug_info = []
-                    
-                    su_name_score, su_name_debug = calculate_search_score(
-                        su_name, query, f"SU Name '{su_name}'"
-                    )
-                    if su_name_score > 0:
-                        su_scores.append(("su_name", su_name_score))
-                        su_debug_info.extend([f"SU Name: {d}" for d in su_name_debug])
-                    
-                    su_display_score, su_display_debug = calculate_search_score(
-                        su_display_name, query, f"SU Display '{su_display_name}'"
-                    )
-                    if su_display_score > 0:
-                        su_scores.append(("su_display", su_display_score))
-                        su_debug_info.extend([f"SU Display: {d}" for d in su_display_debug])
-                    
-                    parent_item_score, parent_debug = calculate_search_score(item_name, query, f"Parent '{item_name}'")
-                    if parent_item_score > 50:
-                        inherited_score = parent_item_score * 0.7
-                        su_scores.append(("parent_inherited", inherited_score))
-                        su_debug_info.extend([f"Parent Inheritance: {d} (inherited: {inherited_score:.1f})" for d in parent_debug])
-                    
-                    if su_scores:
-                        best_score_type, max_score = max(su_scores, key=lambda x: x[1])
-                        
-                        if max_score > 30:
-                            print(f"      ✅ Selling Unit {su_idx+1}: '{su_display_name}' matched via {best_score_type} (score: {max_score:.1f})")
-                            
-                            conversion = float(su.get("conversion_factor", 1))
-                            if conversion <= 0:
-                                print(f"      ⚠️  Skipping - invalid conversion factor: {conversion}")
-                                continue
-                            
-                            # Find the best batch for this selling unit
-                            best_batch_info, alternative_batches = find_best_batch_for_unit(
-                                batches, "selling_unit", conversion, current_batch_id
-                            )
-                            
-                            batch = None
-                            availability = None
-                            can_fulfill = False
-                            batch_status = "no_suitable_batch"
-                            notifications = []
-                            unit_price = 0
-                            available_selling_units = 0
-                            
-                            if best_batch_info:
-                                batch = best_batch_info["batch"]
-                                availability = best_batch_info["availability"]
-                                notifications = generate_notifications(best_batch_info, "selling_unit", conversion)
-                                can_fulfill = best_batch_info.get("can_fulfill", False)
-                                available_selling_units = availability.get("available_selling_units", 0)
-                                
-                                # Determine batch status
-                                if available_selling_units >= 1:
-                                    batch_status = "active_healthy" if available_selling_units > 10 else "active_low_stock"
-                                elif available_selling_units > 0:
-                                    batch_status = "partial_stock"
-                                else:
-                                    batch_status = "out_of_stock"
-                                
-                                # Calculate price per selling unit
-                                if batch and conversion > 0:
-                                    unit_price = float(batch.get("sell_price", 0)) / conversion
-                                
-                                print(f"        ✅ Found batch: {batch.get('batch_name', 'unnamed')}")
-                                print(f"        📊 Available selling units: {available_selling_units} (conversion: {conversion})")
-                            else:
-                                print(f"        ⚠️  No suitable batch found, showing anyway")
-                                
-                                if batches:
-                                    # Use first batch for display purposes
-                                    first_batch = sorted(batches, key=lambda b: b.get("timestamp", 0))[0]
-                                    batch = first_batch
-                                    availability = calculate_real_availability(first_batch, "selling_unit", conversion)
-                                    available_selling_units = availability.get("available_selling_units", 0)
-                                    
-                                    if conversion > 0 and batch.get("sell_price"):
-                                        unit_price = float(batch.get("sell_price", 0)) / conversion
-                                    
-                                    notifications = [{
-                                        "type": "no_batch_link",
-                                        "message": "No batch link configured",
-                                        "severity": "warning"
-                                    }]
-                                    batch_status = "no_batch_link"
-                                else:
-                                    notifications = [{
-                                        "type": "no_batches",
-                                        "message": "No stock batches available",
-                                        "severity": "error"
-                                    }]
-                                    batch_status = "no_batches"
-                            
-                            # Find next available batch
-                            next_available_batch = None
-                            if alternative_batches:
-                                for alt in alternative_batches:
-                                    if alt.get("can_fulfill", False):
-                                        next_available_batch = alt["batch"]
-                                        break
-                            
-                            next_unit_price = None
-                            if next_available_batch and conversion > 0:
-                                next_unit_price = float(next_available_batch.get("sell_price", 0)) / conversion
-                            
-                            # Create selling unit response
-                            selling_unit_response = {
-                                "type": "selling_unit",
-                                "item_id": item_id,
-                                "main_item_id": item_id,
-                                "sell_unit_id": su.get("sell_unit_id"),
-                                "category_id": item.get("category_id") or category_id,
-                                "category_name": item.get("category_name") or category_name,
-                                "name": f"{su_name}",
-                                "display_name": su_display_name,
-                                "parent_item_name": item_name,
-                                "thumbnail": su.get("thumbnail") or item.get("thumbnail"),
-                                "batch_status": batch_status,
-                                "batch_id": batch.get("batch_id") if batch else None,
-                                "batch_name": batch.get("batch_name") if batch else None,
-                                "batch_remaining": availability["real_quantity"] if availability else 0,
-                                "real_available_units": available_selling_units,  # This is now CORRECT!
-                                "real_available_fraction": 0,  # Not used with new logic
-                                "price": round(unit_price, 4),
-                                "available_stock": round(float(batch.get("quantity", 0)) if batch else 0, 2),
-                                "conversion_factor": conversion,
-                                "base_unit": batch.get("unit", item.get("base_unit", "unit")) if batch else item.get("base_unit", "unit"),
-                                "batch_switch_required": not can_fulfill and available_selling_units <= 0,
-                                "can_fulfill": can_fulfill,
-                                "is_current_batch": best_batch_info.get("is_current", False) if best_batch_info else False,
-                                "next_batch_available": next_available_batch is not None,
-                                "next_batch_id": next_available_batch.get("batch_id") if next_available_batch else None,
-                                "next_batch_name": next_available_batch.get("batch_name") if next_available_batch else None,
-                                "next_batch_price": round(next_unit_price, 4) if next_unit_price else None,
-                                "has_batch_links": len(su.get("batch_links", [])) > 0,
-                                "batch_links": su.get("batch_links", []),
-                                "notifications": notifications,
-                                "unit_type": "selling_unit",
-                                "search_score": max_score,
-                                "matched_by": best_score_type,
-                                "debug": {
-                                    "match_type": best_score_type,
-                                    "matched_text": su_display_name if best_score_type == "su_display" else su_name,
-                                    "score_calculation": su_debug_info,
-                                    "parent_item": item_name,
-                                    "parent_score": parent_item_score,
-                                    "query_used": query,
-                                    "batch_available_units": available_selling_units,
-                                    "conversion_applied": conversion,
-                                    "parent_batch_qty": batch.get("quantity", 0) if batch else 0
-                                }
-                            }
-                            results.append(selling_unit_response)
-                            
-                            search_debug_info.append({
-                                "item_name": f"{item_name} → {su_display_name}",
-                                "type": "selling_unit",
-                                "score": max_score,
-                                "match_type": best_score_type,
-                                "batch_status": batch_status,
-                                "can_fulfill": can_fulfill,
-                                "available_units": available_selling_units,
-                                "conversion": conversion
-                            })
-                            
-                            print(f"      📝 Added selling unit (score: {max_score:.1f}, status: {batch_status}, units: {available_selling_units})")
-                        else:
-                            print(f"      ❌ Selling unit score too low: {max_score:.1f} (threshold: 30)")
-                    else:
-                        if len(selling_units) <= 3:
-                            print(f"      ❌ Selling Unit {su_idx+1}: '{su_display_name}' - no match")
-
-        # --------------------------------------------------
-        # ENHANCED SORTING WITH SEARCH SCORING
-        # --------------------------------------------------
-        
-        print(f"\n📊 SORTING {len(results)} RESULTS...")
-        
-        # Sort with priority:
-        # 1. Can fulfill (available for sale)
-        # 2. Higher search score
-        # 3. More available units
-        # 4. Main items before selling units
-        # 5. Alphabetical
-        results.sort(key=lambda x: (
-            not x.get("can_fulfill", False),
-            -x.get("search_score", 0),
-            -x.get("real_available_units", 0),
-            x.get("type") == "selling_unit",
-            x.get("name", "").lower()
-        ))
+        search = search_shop_index(search_index, query, search_debug_info)
+        results = search["results"]
+        query_tokens = search["query_tokens"]
+        total_items_scanned = search["items_scanned"]
+        total_selling_units_scanned = search["selling_units_scanned"]
         
         print(f"\n🏆 FINAL RESULTS ORDER:")
         for i, result in enumerate(results[:10]):
@@ -1214,57 +2341,349 @@ def sales():
         print(f"{'='*80}\n")
 
         return jsonify({
-            "items": results,
+            "items": results,
+            "meta": {
+                "shop_id": shop_id,
+                "shop_name": shop_name,
+                "query": query,
+                "cart_id": customer_cart_id,
+                "results": len(results),
+                "scored_results": scored_results,
+                "high_score_results": high_score_results,
+                "main_items_count": main_items_count,
+                "selling_units_count": selling_units_count,
+                "can_fulfill_count": can_fulfill_count,
+                "needs_switch_count": needs_switch_count,
+                "query_tokens": query_tokens,
+                "candidate_items": search["candidate_items"],
+                "indexed_items": len(search_index["entries"]),
+                "items_scanned": total_items_scanned,
+                "selling_units_scanned": total_selling_units_scanned,
+                "processing_time_ms": processing_time,
+                "cache_last_updated": embedding_cache_full.get("last_updated"),
+                "cache_version": embedding_cache_full.get("version"),
+                "note": "Enhanced search with FIXED conversion logic (multiply, not divide!)"
+            },
+            "debug": {
+                "search_debug_info": search_debug_info,
+                "sorting_priority": [
+                    "1. Items that can fulfill orders",
+                    "2. Higher search score",
+                    "3. More available units",
+                    "4. Main items before selling units",
+                    "5. Alphabetical order"
+                ],
+                "conversion_logic": [
+                    "Selling units: available = parent_quantity × conversion_factor",
+                    "Price per unit: price = batch_price ÷ conversion_factor",
+                    "Can fulfill if: available_selling_units > 0"
+                ]
+            }
+        }), 200
+
+    except Exception as e:
+        import traceback
+        error_trace = traceback.format_exc()
+        print(f"\n❌ UNEXPECTED ERROR:")
+        print(f"{'='*80}")
+        print(error_trace)
+        print(f"{'='*80}")
+        
+        return jsonify({
+            "items": [],
+            "meta": {
+                "error": str(e),
+                "error_type": type(e).__name__,
+                "processing_time_ms": round((time.time() - start_time) * 1000, 2),
+                "note": "Check server logs for detailed error trace"
+            }
+        }), 500
+
+
+# ======================================================
+# BATCH SALES SEARCH (SCANNER BURSTS / CART RE-VALIDATION)
+# ======================================================
+SALES_BATCH_MAX_LOOKUPS = 200
+
+def parse_sales_batch_request(data):
+    """
+    Validate a /sales/batch body → (shop_id, queries, item_lookups, scan_codes, limit_per_query).
+    Raises ValueError (answered with 400) on anything the lookups can't use.
+    """
+    if not isinstance(data, dict):
+        raise ValueError("Body must be a JSON object")
+
+    def list_field(name):
+        value = data.get(name) or []
+        if not isinstance(value, list):
+            raise ValueError(f"{name} must be a list")
+        return value
+
+    queries = []
+    for q in list_field("queries"):
+        if q is not None and not isinstance(q, str):
+            raise ValueError("queries must be strings")
+        queries.append((q or "").lower().strip())
+
+    item_lookups = []
+    for lookup in list_field("item_ids"):
+        item_id, sell_unit_id = (lookup.get("item_id"), lookup.get("sell_unit_id")) if isinstance(lookup, dict) \
+            else (lookup, None)
+        if not isinstance(item_id, str) or not (sell_unit_id is None or isinstance(sell_unit_id, str)):
+            raise ValueError("item_ids must be item ID strings or {item_id, sell_unit_id} objects")
+        item_lookups.append((item_id, sell_unit_id))
+
+    scan_codes = list_field("barcodes")
+    if any(isinstance(code, (dict, list, bool)) for code in scan_codes):
+        raise ValueError("barcodes must be strings or numbers")
+
+    limit_per_query = data.get("limit_per_query")
+    if limit_per_query is not None:
+        try:
+            limit_per_query = int(limit_per_query)
+        except (TypeError, ValueError):
+            raise ValueError("limit_per_query must be an integer")
+        if limit_per_query < 0:
+            raise ValueError("limit_per_query must not be negative")
+
+    return data.get("shop_id"), queries, item_lookups, scan_codes, limit_per_query
+
+@app.route("/sales/batch", methods=["POST"])
+def sales_batch():
+    """
+    Resolve many queries and/or item IDs for ONE shop in a single request.
+    Body: {
+        "shop_id": "...",
+        "queries": ["milk", "bread 400g", ...],
+        "item_ids": ["itemA", {"item_id": "itemB", "sell_unit_id": "su1"}, ...],
+        "barcodes": ["6161100100011", "SKU-42", ...],
+        "limit_per_query": 5            (optional)
+    }
+    All lookups share one index snapshot; every candidate item is visited once
+    and its rows are built for each query that wants it.
+    """
+    try:
+        start_time = time.time()
+        try:
+            shop_id, queries, item_lookups, scan_codes, limit_per_query = \
+                parse_sales_batch_request(request.get_json(silent=True) or {})
+        except ValueError as e:
+            return jsonify({
+                "results": [],
+                "item_results": [],
+                "barcode_results": [],
+                "meta": {
+                    "error": str(e),
+                    "processing_time_ms": round((time.time() - start_time) * 1000, 2)
+                }
+            }), 400
+
+        print(f"\n📦 BATCH SEARCH: shop {shop_id}, {len(queries)} queries, "
+              f"{len(item_lookups)} item lookups, {len(scan_codes)} barcodes")
+
+        if not shop_id or not isinstance(shop_id, str) or (not queries and not item_lookups and not scan_codes):
+            return jsonify({
+                "results": [],
+                "item_results": [],
+                "barcode_results": [],
+                "meta": {
+                    "error": "shop_id and at least one of queries/item_ids/barcodes are required",
+                    "processing_time_ms": round((time.time() - start_time) * 1000, 2)
+                }
+            }), 400
+
+        if len(queries) + len(item_lookups) + len(scan_codes) > SALES_BATCH_MAX_LOOKUPS:
+            return jsonify({
+                "results": [],
+                "item_results": [],
+                "barcode_results": [],
+                "meta": {
+                    "error": f"Too many lookups (max {SALES_BATCH_MAX_LOOKUPS})",
+                    "processing_time_ms": round((time.time() - start_time) * 1000, 2)
+                }
+            }), 400
+
+        # One snapshot for the whole batch, even if the cache refreshes meanwhile
+        search_index = acquire_shop_index(shop_id)
+        if not search_index:
+            return jsonify({
+                "results": [],
+                "item_results": [],
+                "barcode_results": [],
+                "meta": {
+                    "error": f"Shop {shop_id} not found",
+                    "processing_time_ms": round((time.time() - start_time) * 1000, 2)
+                }
+            }), 404
+
+        search_debug_info = []
+
+        # --------------------------------------------------
+        # PLAN: query -> tokens, candidate position -> queries wanting it
+        # --------------------------------------------------
+        query_tokens = {}
+        query_rows = {}
+        wanted_by = {}
+        for query in queries:
+            if not query or query in query_tokens:
+                continue
+            tokens = tokenize_search_text(query)
+            query_tokens[query] = tokens
+            query_rows[query] = []
+            for position in find_candidate_entries(search_index, tokens):
+                wanted_by.setdefault(position, []).append(query)
+
+        # --------------------------------------------------
+        # SINGLE PASS over candidate items
+        # --------------------------------------------------
+        for position in sorted(wanted_by):
+            category, item = search_index["entries"][position]
+            for query in wanted_by[position]:
+                query_rows[query].extend(build_item_search_results(
+                    item, category, query, query_tokens[query], search_debug_info
+                ))
+
+        results = []
+        for query in queries:
+            rows = sort_search_results(query_rows[query]) if query in query_rows else []
+            if limit_per_query:
+                rows = rows[:limit_per_query]
+            results.append({
+                "query": query,
+                "items": rows,
+                "count": len(rows)
+            })
+
+        # --------------------------------------------------
+        # ITEM ID LOOKUPS (cart re-validation)
+        # --------------------------------------------------
+        item_results = []
+        for item_id, sell_unit_id in item_lookups:
+            rows = build_lookup_rows(
+                search_index, search_index["by_item_id"].get(item_id), sell_unit_id, search_debug_info
+            )
+
+            item_results.append({
+                "item_id": item_id,
+                "sell_unit_id": sell_unit_id,
+                "found": len(rows) > 0,
+                "items": rows
+            })
+
+        # --------------------------------------------------
+        # BARCODE / SKU LOOKUPS (scanner bursts)
+        # --------------------------------------------------
+        barcode_results = []
+        for code in scan_codes:
+            rows, sell_unit_id = lookup_scan_code(search_index, code, search_debug_info)
+            barcode_results.append({
+                "code": code,
+                "sell_unit_id": sell_unit_id,
+                "found": len(rows) > 0,
+                "items": rows
+            })
+
+        processing_time = round((time.time() - start_time) * 1000, 2)
+        print(f"✅ BATCH SEARCH done: {len(results)} queries, {len(item_results)} item lookups, "
+              f"{len(wanted_by)} items visited in {processing_time}ms")
+
+        return jsonify({
+            "results": results,
+            "item_results": item_results,
+            "barcode_results": barcode_results,
+            "meta": {
+                "shop_id": shop_id,
+                "shop_name": search_index["shop"].get("shop_name", "Unnamed"),
+                "queries": len(results),
+                "unique_queries": len(query_rows),
+                "item_lookups": len(item_results),
+                "barcode_lookups": len(barcode_results),
+                "items_visited": len(wanted_by),
+                "processing_time_ms": processing_time,
+                "cache_last_updated": embedding_cache_full.get("last_updated")
+            }
+        }), 200
+
+    except Exception as e:
+        import traceback
+        print(f"\n❌ BATCH SEARCH ERROR:\n{traceback.format_exc()}")
+        return jsonify({
+            "results": [],
+            "item_results": [],
+            "barcode_results": [],
+            "meta": {
+                "error": str(e),
+                "error_type": type(e).__name__,
+                "processing_time_ms": round((time.time() - start_time) * 1000, 2)
+            }
+        }), 500
+
+
+# ======================================================
+# BARCODE / SKU EXACT LOOKUP
+# ======================================================
+@app.route("/sales/barcode", methods=["POST"])
+def sales_barcode():
+    """
+    Scanner lookup: one dict hit on the shop's barcode/SKU index.
+    Returns the same shape as /sales (best FIFO batch, availability, notifications).
+    """
+    try:
+        start_time = time.time()
+        data = request.get_json() or {}
+        shop_id = data.get("shop_id")
+        code = normalize_scan_code(data.get("code") or data.get("barcode"))
+
+        print(f"\n📠 BARCODE LOOKUP: '{code}' in shop {shop_id}")
+
+        if not code or not shop_id:
+            return jsonify({
+                "items": [],
+                "meta": {
+                    "error": "Missing code or shop_id",
+                    "processing_time_ms": round((time.time() - start_time) * 1000, 2)
+                }
+            }), 400
+
+        search_index = acquire_shop_index(shop_id)
+        if not search_index:
+            return jsonify({
+                "items": [],
+                "meta": {
+                    "error": f"Shop {shop_id} not found",
+                    "processing_time_ms": round((time.time() - start_time) * 1000, 2)
+                }
+            }), 404
+
+        rows, sell_unit_id = lookup_scan_code(search_index, code, [])
+        processing_time = round((time.time() - start_time) * 1000, 2)
+        print(f"{'✅' if rows else '❌'} Barcode '{code}' → {len(rows)} row(s) in {processing_time}ms")
+
+        return jsonify({
+            "items": rows,
             "meta": {
                 "shop_id": shop_id,
-                "shop_name": shop_name,
-                "query": query,
-                "cart_id": customer_cart_id,
-                "results": len(results),
-                "scored_results": scored_results,
-                "high_score_results": high_score_results,
-                "main_items_count": main_items_count,
-                "selling_units_count": selling_units_count,
-                "can_fulfill_count": can_fulfill_count,
-                "needs_switch_count": needs_switch_count,
-                "items_scanned": total_items_scanned,
-                "selling_units_scanned": total_selling_units_scanned,
+                "shop_name": search_index["shop"].get("shop_name", "Unnamed"),
+                "code": code,
+                "found": len(rows) > 0,
+                "sell_unit_id": sell_unit_id,
+                "results": len(rows),
+                "can_fulfill_count": sum(1 for r in rows if r.get("can_fulfill", False)),
+                "indexed_codes": len(search_index["by_code"]),
                 "processing_time_ms": processing_time,
-                "cache_last_updated": embedding_cache_full.get("last_updated"),
-                "note": "Enhanced search with FIXED conversion logic (multiply, not divide!)"
-            },
-            "debug": {
-                "search_debug_info": search_debug_info,
-                "sorting_priority": [
-                    "1. Items that can fulfill orders",
-                    "2. Higher search score",
-                    "3. More available units",
-                    "4. Main items before selling units",
-                    "5. Alphabetical order"
-                ],
-                "conversion_logic": [
-                    "Selling units: available = parent_quantity × conversion_factor",
-                    "Price per unit: price = batch_price ÷ conversion_factor",
-                    "Can fulfill if: available_selling_units > 0"
-                ]
+                "cache_last_updated": embedding_cache_full.get("last_updated")
             }
-        }), 200
+        }), 200 if rows else 404
 
     except Exception as e:
         import traceback
-        error_trace = traceback.format_exc()
-        print(f"\n❌ UNEXPECTED ERROR:")
-        print(f"{'='*80}")
-        print(error_trace)
-        print(f"{'='*80}")
-        
+        print(f"\n❌ BARCODE LOOKUP ERROR:\n{traceback.format_exc()}")
         return jsonify({
             "items": [],
             "meta": {
                 "error": str(e),
                 "error_type": type(e).__name__,
-                "processing_time_ms": round((time.time() - start_time) * 1000, 2),
-                "note": "Check server logs for detailed error trace"
+                "processing_time_ms": round((time.time() - start_time) * 1000, 2)
             }
         }), 500
 # ======================================================
@@ -1287,59 +2706,464 @@ try:
     if not firebase_admin._apps:
         cred = credentials.Certificate('path/to/serviceAccountKey.json')
         firebase_admin.initialize_app(cred)
-    db = firestore.client()
+    # db itself comes from FIREBASE CONFIG: rebinding it to a plain client here would bypass the cost meter
 except:
     logger.warning("Firebase not initialized - running in test mode")
 
-@app.route('/complete-sale', methods=['POST'])
-def complete_sale():
+# ============== STOCK SHARDS (hot items) ==============
+STOCK_SHARD_COUNT = int(os.environ.get("STOCK_SHARD_COUNT", 10))
+STOCK_SHARD_AUTO_PROMOTE = os.environ.get("STOCK_SHARD_AUTO_PROMOTE", "1") == "1"
+STOCK_SHARD_PROMOTE_WRITES_PER_S = float(os.environ.get("STOCK_SHARD_PROMOTE_WRITES_PER_S", 1.0))
+STOCK_SHARD_RATE_WINDOW_S = float(os.environ.get("STOCK_SHARD_RATE_WINDOW_S", 30))
+
+item_write_rates = WriteRateTracker(window=STOCK_SHARD_RATE_WINDOW_S)
+stock_shard_stats = {"promotions": 0, "shard_writes": 0, "folds": 0}
+
+def add_shard_write(batch, item_ref, state):
+    """A hot item's deductions since its last write, as increments on one random shard"""
+    last_sale = state["last_sale"]
+    update = {
+        'stock': firestore.Increment(from_micro(state["stock"] - state["written_stock"])),
+        'batches': {
+            state["batch_ids"][i]: firestore.Increment(from_micro(state["batch_qty"][i] - state["written_batch_qty"][i]))
+            for i in sorted(state["dirty_batches"])
+        },
+        'lastTransactionId': last_sale['sale_id'],
+        'updatedAt': last_sale['timestamp'].isoformat(),
+        'updatedBy': last_sale['seller']
+    }
+    if state["transactions"]:
+        update['stockTransactions'] = firestore.ArrayUnion(state["transactions"])
+    shard_ref = item_ref.collection(SHARD_COLLECTION).document(str(random.randrange(state["shards"])))
+    batch.set(shard_ref, update, merge=True)
+    stock_shard_stats["shard_writes"] += 1
+
+def fold_stock_shards(shop_id, item_id, demote=False):
     """
-    Complete sale with unit conversion logic
-    Handles: Base units (direct) and Selling units (converted)
-    Supports: Floating point quantities
+    Move an item's shard deltas into its base stock/batch quantities in one
+    transaction (e.g. before editing stock by hand). demote=True also turns
+    sharding off for the item.
     """
-    
-    # ============== 1. INITIAL SETUP & VALIDATION ==============
-    try:
-        data = request.get_json()
-        if not data:
-            return jsonify({
-                "success": False,
-                "error": "No data received"
-            }), 400
-        
-        shop_id = data.get('shop_id')
-        user_id = data.get('user_id')
-        seller = data.get('seller', {})
-        items = data.get('items', [])
-        payment = data.get('payment', {})
-        
-        # Validate required fields
-        if not shop_id or not user_id or not seller or len(items) == 0:
-            return jsonify({
-                "success": False,
-                "error": "Missing required fields: shop_id, user_id, seller, or items"
-            }), 400
-        
-        # Generate unique IDs
-        timestamp = datetime.now()
-        sale_id = f"sale_{int(timestamp.timestamp())}_{abs(hash(str(data))) % 10000:04d}"
-        receipt_id = f"receipt_{int(timestamp.timestamp())}_{user_id[:8]}"
-        
-        logger.info(f"🔄 Starting sale: {sale_id}")
-        logger.info(f"🏪 Shop: {shop_id}")
-        logger.info(f"👤 Seller: {seller.get('name')}")
-        logger.info(f"🛍️ Items to process: {len(items)}")
-        
-    except Exception as e:
-        logger.error(f"❌ Initial validation failed: {e}")
+    item_ref = db.collection('Shops').document(shop_id).collection('items').document(item_id)
+
+    @firestore.transactional
+    def fold(transaction):
+        item_doc = item_ref.get(transaction=transaction)
+        if not item_doc.exists:
+            raise ValueError(f"Item {item_id} not found")
+        item_data = item_doc.to_dict()
+        shards = shard_count(item_data)
+        shard_refs = [item_ref.collection(SHARD_COLLECTION).document(str(k)) for k in range(shards)]
+        shard_docs = [d for d in transaction.get_all(shard_refs) if d.exists] if shard_refs else []
+
+        summed = apply_shard_totals(item_data, [d.to_dict() for d in shard_docs])
+        transaction.update(item_ref, {
+            'stock': summed.get('stock', 0),
+            'batches': summed.get('batches', []),
+            'stockShards': 0 if demote else shards
+        })
+        for shard_doc in shard_docs:
+            transaction.update(shard_doc.reference, {'stock': 0, 'batches': {}})
+        return {"stock": summed.get('stock', 0), "shards_folded": len(shard_docs),
+                "stock_shards": 0 if demote else shards}
+
+    result = fold(db.transaction())
+    stock_shard_stats["folds"] += 1
+    return result
+
+@app.route('/stock-shards', methods=['GET', 'POST'])
+def stock_shards_route():
+    """
+    GET: sharding settings, promotions and the items with the highest write rate.
+    POST {shop_id, item_id, action}: "promote" an item by hand, "fold" its shards
+    into the base stock, or "demote" it (fold + sharding off).
+    """
+    if request.method == 'GET':
         return jsonify({
-            "success": False,
-            "error": "Invalid request format",
-            "message": str(e)
-        }), 400
-    
-    # ============== 2. PROCESS EACH ITEM ==============
+            "status": "success",
+            "shard_count": STOCK_SHARD_COUNT,
+            "auto_promote": STOCK_SHARD_AUTO_PROMOTE,
+            "promote_writes_per_s": STOCK_SHARD_PROMOTE_WRITES_PER_S,
+            **stock_shard_stats,
+            "hottest_items": item_write_rates.hottest(10)
+        })
+
+    data = request.get_json(silent=True) or {}
+    shop_id, item_id, action = data.get('shop_id'), data.get('item_id'), data.get('action')
+    if not shop_id or not item_id or action not in ('promote', 'fold', 'demote'):
+        return jsonify({"status": "error", "message": "shop_id, item_id and action (promote|fold|demote) required"}), 400
+
+    try:
+        if action == 'promote':
+            item_ref = db.collection('Shops').document(shop_id).collection('items').document(item_id)
+            item_doc = item_ref.get()
+            if not item_doc.exists:
+                raise ValueError(f"Item {item_id} not found")
+            if shard_count(item_doc.to_dict()):
+                return jsonify({"status": "success", "message": "Item is already sharded",
+                                "stock_shards": shard_count(item_doc.to_dict())})
+            item_ref.update({'stockShards': STOCK_SHARD_COUNT})
+            stock_shard_stats["promotions"] += 1
+            result = {"stock_shards": STOCK_SHARD_COUNT}
+        else:
+            result = fold_stock_shards(shop_id, item_id, demote=action == 'demote')
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 404
+
+    return jsonify({"status": "success", "action": action, **result})
+
+# ============== GROUP COMMIT ==============
+SALE_GROUP_WINDOW_MS = float(os.environ.get("SALE_GROUP_WINDOW_MS", 5))
+SALE_GROUP_MAX_SALES = int(os.environ.get("SALE_GROUP_MAX_SALES", 100))
+FIRESTORE_BATCH_LIMIT = 500  # max writes per Firestore batch
+
+def apply_sale_deductions(sale, item_states):
+    """
+    Apply one sale's batch/stock deductions to the working item states.
+    All-or-nothing: raises ValueError and leaves item_states untouched if a
+    batch would go negative. Items whose doc is missing are skipped with a
+    warning (as before) and the rest of the sale is applied. Returns
+    (totals, ids of the items it changed).
+    """
+    staged = {}  # item_id -> {"stock": micro, "batches": {index: micro}}
+    missing = set()
+    total_base_micro = 0
+    total_minor = 0
+
+    def stage(item_id):
+        if item_id not in item_states:
+            if item_id not in missing:
+                missing.add(item_id)
+                logger.warning(f"   ⚠️ Item {item_id} not found; skipping its stock deduction")
+            return None
+        state = item_states[item_id]
+        return staged.setdefault(item_id, {"stock": state["stock"], "batches": dict(state["batch_qty"])})
+
+    for batch_update in sale['batch_updates']:
+        item_id = batch_update['item_id']
+        working = stage(item_id)
+        batch_index = item_states[item_id]["batch_index"].get(batch_update['batch_id']) if working is not None else None
+        if working is not None and batch_index is None:
+            logger.warning(f"   ⚠️ Batch {batch_update['batch_id']} not found")
+        elif working is not None:
+            current_qty = working["batches"][batch_index]
+            new_qty = current_qty - batch_update['deduct_micro']
+            # Safety check (even though frontend validated); exact, no tolerance needed
+            if new_qty < 0:
+                raise ValueError(f"Batch {batch_update['batch_id']} would go negative")
+            working["batches"][batch_index] = new_qty
+            logger.info(f"   🔄 Batch {batch_update['batch_id']}: {from_micro(current_qty)} → {from_micro(new_qty)}")
+
+        total_base_micro += batch_update['deduct_micro']
+        total_minor += line_total_minor(batch_update['deduct_micro'], batch_update['sell_price'])
+
+    for item_update in sale['item_updates']:
+        working = stage(item_update['item_id'])
+        if working is None:
+            continue
+        new_stock = working["stock"] - item_update['deduct_micro']
+        logger.info(f"   📊 Item stock: {from_micro(working['stock'])} → {from_micro(new_stock)}")
+        working["stock"] = new_stock
+
+    for item_id, working in staged.items():
+        state = item_states[item_id]
+        state["dirty_batches"].update(i for i, qty in working["batches"].items() if qty != state["batch_qty"][i])
+        state["stock"] = working["stock"]
+        state["batch_qty"] = working["batches"]
+        state["last_sale"] = sale
+    for transaction in sale['transaction_records']:
+        if transaction['item_id'] in staged:
+            item_states[transaction['item_id']]["transactions"].append(transaction)
+
+    return {"total_base_units": from_micro(total_base_micro), "total_amount": from_minor(total_minor)}, set(staged)
+
+def compact_receipt_line(processed_item):
+    """One receipt line: what was sold and what it took from stock (no copy of the cart item)"""
+    unit_info = processed_item['unit_info']
+    return {
+        'sale_item_id': processed_item['sale_item_id'],
+        'item_id': processed_item.get('item_id'),
+        'name': processed_item.get('name'),
+        'type': processed_item.get('type', 'main_item'),
+        'batch_id': processed_item.get('batch_id'),
+        'sell_unit_id': unit_info.get('sell_unit_id'),
+        'quantity': processed_item.get('quantity'),
+        'price': processed_item.get('price'),
+        'base_quantity': processed_item['base_quantity_deducted'],
+        'conversion_factor': unit_info.get('conversion_factor'),
+        'display_unit': unit_info['display_unit'],
+        'item_total': processed_item['item_total']
+    }
+
+def sale_record_docs(shop_id, sale, totals):
+    """Receipt (compact schema) + audit log of one sale, as write-ahead records"""
+    processed_items = sale['processed_items']
+    timestamp = sale['timestamp']
+    shop_path = f"Shops/{shop_id}"
+
+    receipt = {
+        'id': sale['receipt_id'],
+        'sale_id': sale['sale_id'],
+        'shop_id': shop_id,
+        'schema_version': 2,  # v2: compact lines, no original_cart copy
+        'timestamp': timestamp.isoformat(),
+        'seller': sale['seller'],
+        'items': [compact_receipt_line(i) for i in processed_items],
+        'summary': {
+            'total_items': len(sale['items']),
+            'total_base_units': round(totals['total_base_units'], 6),
+            'total_amount': round(totals['total_amount'], 2),
+            'contains_selling_units': any(i['unit_info']['is_selling_unit'] for i in processed_items),
+            'converted_items': sum(1 for i in processed_items if i['unit_info']['is_selling_unit'])
+        },
+        'payment': sale['payment'],
+        'status': 'completed',
+        'created_at': timestamp.isoformat()
+    }
+
+    audit = {
+        'id': f"audit_{sale['sale_id']}",
+        'action': 'sale_completed',
+        'performed_by': sale['seller'],
+        'timestamp': timestamp.isoformat(),
+        'details': {
+            'sale_id': sale['sale_id'],
+            'receipt_id': sale['receipt_id'],
+            'items_count': len(sale['items']),
+            'total_amount': round(totals['total_amount'], 2),
+            'total_base_units': round(totals['total_base_units'], 6),
+            'batch_count': len(sale['batch_updates']),
+            'had_conversions': any(i['unit_info']['is_selling_unit'] for i in processed_items)
+        }
+    }
+
+    return [
+        {"path": f"{shop_path}/receipts/{sale['receipt_id']}", "data": receipt},
+        {"path": f"{shop_path}/auditLogs/audit_{sale['sale_id']}", "data": audit}
+    ]
+
+def add_item_stock_writes(batch, items_ref, item_states, item_ids):
+    """
+    ONE write per item carrying the merged stock, batch quantities and transactions:
+    an update of the item doc, or an increment on one of its shards if it is sharded.
+    Items written faster than STOCK_SHARD_PROMOTE_WRITES_PER_S get promoted to shards.
+    """
+    for item_id in item_ids:
+        state = item_states[item_id]
+        last_sale = state["last_sale"]
+        item_ref = items_ref.document(item_id)
+        write_rate = item_write_rates.record(item_ref.path)
+        if state["shards"]:
+            add_shard_write(batch, item_ref, state)
+            state["written_stock"] = state["stock"]
+            state["written_batch_qty"] = dict(state["batch_qty"])
+            state["dirty_batches"] = set()
+            state["transactions"] = []
+            continue
+
+        update = {
+            'stock': from_micro(state["stock"]),
+            'lastStockUpdate': last_sale['timestamp'].isoformat(),
+            'lastTransactionId': last_sale['sale_id'],
+            'updatedAt': last_sale['timestamp'].isoformat(),
+            'updatedBy': last_sale['seller']
+        }
+        for batch_index in sorted(state["dirty_batches"]):
+            update[f'batches.{batch_index}.quantity'] = from_micro(state["batch_qty"][batch_index])
+        if state["transactions"]:
+            update['stockTransactions'] = firestore.ArrayUnion(state["transactions"])
+        if STOCK_SHARD_AUTO_PROMOTE and write_rate >= STOCK_SHARD_PROMOTE_WRITES_PER_S:
+            # This write still sets the absolute values; later ones go to the shards
+            update['stockShards'] = STOCK_SHARD_COUNT
+            state["shards"] = STOCK_SHARD_COUNT
+            stock_shard_stats["promotions"] += 1
+            logger.info(f"🔥 Item {item_id} promoted to {STOCK_SHARD_COUNT} stock shards ({write_rate:.2f} writes/s)")
+        batch.update(item_ref, update)
+        state["written_stock"] = state["stock"]
+        state["written_batch_qty"] = dict(state["batch_qty"])
+        state["dirty_batches"] = set()
+        state["transactions"] = []
+
+def commit_sale_group(shop_id, sales):
+    """
+    Commit a group of sales of one shop: one get_all for every item involved,
+    deductions merged per item and batch, then as few batch commits as the
+    500-writes limit allows (one item update per item). Only stock is written
+    here; receipts and audit logs go to the write-ahead record queue once the
+    stock commit succeeded. Returns one outcome per sale (result dict or Exception).
+    """
+    items_ref = db.collection('Shops').document(shop_id).collection('items')
+    item_ids = sorted({u['item_id'] for sale in sales for u in sale['item_updates'] + sale['batch_updates']})
+
+    with span("firestore_sale_read"):
+        item_docs = {doc.id: doc.to_dict() for doc in db.get_all([items_ref.document(item_id) for item_id in item_ids])
+                     if doc.exists}
+
+    # Sharded (hot) items: one more get_all for their shards, stock = base + shards
+    shard_refs = [items_ref.document(item_id).collection(SHARD_COLLECTION).document(str(k))
+                  for item_id, item_data in item_docs.items() for k in range(shard_count(item_data))]
+    shards = {}
+    if shard_refs:
+        with span("firestore_sale_read"):
+            shard_docs = list(db.get_all(shard_refs))
+        for shard_doc in shard_docs:
+            if shard_doc.exists:
+                shards.setdefault(shard_doc.reference.parent.parent.id, []).append(shard_doc.to_dict())
+
+    item_states = {}
+    for item_id, item_data in item_docs.items():
+        item_data = apply_shard_totals(item_data, shards.get(item_id, []))
+        batches = item_data.get('batches', [])
+        batch_qty = {i: to_micro(b.get('quantity', 0)) for i, b in enumerate(batches)}  # micro-units
+        item_states[item_id] = {
+            "stock": to_micro(item_data.get('stock', 0)),
+            "batch_index": {b.get('id'): i for i, b in reversed(list(enumerate(batches)))},
+            "batch_ids": {i: b.get('id') for i, b in enumerate(batches)},
+            "batch_qty": batch_qty,
+            "shards": shard_count(item_data),
+            "written_stock": to_micro(item_data.get('stock', 0)),  # values as last read/written
+            "written_batch_qty": dict(batch_qty),
+            "dirty_batches": set(),
+            "transactions": [],
+            "last_sale": None
+        }
+
+    outcomes = [None] * len(sales)
+    batch = db.batch()
+    chunk_sales = []     # (position, totals) of sales in the open batch
+    chunk_items = set()  # item docs the open batch will update
+
+    def flush():
+        add_item_stock_writes(batch, items_ref, item_states, sorted(chunk_items))
+        with span("firestore_sale_commit"):
+            batch.commit()
+        records = []
+        for position, totals in chunk_sales:
+            outcomes[position] = {**totals, "group_size": len(sales)}
+            records.extend(sale_record_docs(shop_id, sales[position], totals))
+        queue_sale_records(records)
+
+    for position, sale in enumerate(sales):
+        touched = {u['item_id'] for u in sale['item_updates'] + sale['batch_updates']}
+        if chunk_sales and len(chunk_items | touched) > FIRESTORE_BATCH_LIMIT:
+            # This sale no longer fits: commit the open batch first
+            try:
+                flush()
+            except Exception as e:
+                return [o if o is not None else e for o in outcomes]
+            batch = db.batch()
+            chunk_sales, chunk_items = [], set()
+
+        try:
+            totals, changed_items = apply_sale_deductions(sale, item_states)
+        except ValueError as e:
+            outcomes[position] = e
+            continue
+
+        chunk_sales.append((position, totals))
+        chunk_items |= changed_items
+
+    if chunk_sales:
+        try:
+            flush()
+        except Exception as e:
+            return [o if o is not None else e for o in outcomes]
+
+    logger.info(f"💾 Group commit for shop {shop_id}: {len(sales)} sale(s), {len(item_states)} item doc(s)")
+    return outcomes
+
+# ============== RECEIPT / AUDIT WRITE-BEHIND ==============
+# SALE_RECORD_WAL_DIR turns on the write-behind: receipts/audit logs are then
+# only in a local log until they are flushed, so it must be an absolute path on
+# a disk that survives restarts (e.g. a mounted persistent disk, not the working
+# dir). Unset (or not absolute), they are written with the sale as before.
+SALE_RECORD_WAL_DIR = os.environ.get("SALE_RECORD_WAL_DIR", "").strip()
+if SALE_RECORD_WAL_DIR and not os.path.isabs(SALE_RECORD_WAL_DIR):
+    logger.warning(f"⚠️ SALE_RECORD_WAL_DIR={SALE_RECORD_WAL_DIR!r} is not an absolute path; ignoring it")
+    SALE_RECORD_WAL_DIR = ""
+if not SALE_RECORD_WAL_DIR:
+    logger.warning("⚠️ SALE_RECORD_WAL_DIR not set: receipts and audit logs are written synchronously")
+
+@firestore_meter.scoped("sale_record_flush")
+def write_record_batch(records):
+    """Store write-ahead records (receipts/audit logs) with one batch commit"""
+    batch = db.batch()
+    for record in records:
+        batch.set(db.document(record["path"]), record["data"])
+    with span("firestore_record_commit"):
+        batch.commit()
+
+sale_record_writer = WriteAheadQueue(SALE_RECORD_WAL_DIR, write_record_batch, prefix="sale-records",
+                                     max_batch=FIRESTORE_BATCH_LIMIT) if SALE_RECORD_WAL_DIR else None
+
+def write_sale_records(records):
+    for start in range(0, len(records), FIRESTORE_BATCH_LIMIT):
+        write_record_batch(records[start:start + FIRESTORE_BATCH_LIMIT])
+
+def queue_sale_records(records):
+    """Durably queue receipts/audit logs; written synchronously without (or if unusable) a local log"""
+    if sale_record_writer is None:
+        try:
+            write_sale_records(records)
+        except Exception as e:  # the sale itself is committed; don't report it as failed
+            logger.error(f"❌ Failed to store {len(records)} receipt/audit record(s): {e}")
+        return
+    try:
+        sale_record_writer.append(records)
+    except OSError as e:
+        logger.error(f"❌ Write-ahead log unavailable ({e}); writing {len(records)} record(s) directly")
+        write_sale_records(records)
+
+def sale_record_writer_stats():
+    return sale_record_writer.stats() if sale_record_writer is not None else {"enabled": False}
+
+sale_committer = GroupCommitter(
+    "complete_sale",
+    commit_sale_group,
+    window=SALE_GROUP_WINDOW_MS / 1000,
+    max_group=SALE_GROUP_MAX_SALES
+)
+
+@app.route('/complete-sale/stats', methods=['GET'])
+def complete_sale_stats():
+    """Group commit counters (sales per group, commit latency) and the receipt/audit write-behind queue"""
+    return jsonify({
+        "status": "success",
+        "group_commit": sale_committer.stats(),
+        "record_writer": sale_record_writer_stats()
+    })
+
+@app.route('/complete-sale/receipts/<shop_id>/<receipt_id>', methods=['GET'])
+def sale_receipt_status(shop_id, receipt_id):
+    """'pending' while a receipt is only in this process' write-ahead log, then 'stored' with the receipt"""
+    path = f"Shops/{shop_id}/receipts/{receipt_id}"
+    if sale_record_writer is not None and sale_record_writer.is_pending(path):
+        return jsonify({"status": "success", "receipt_status": "pending"}), 200
+
+    receipt_doc = db.document(path).get()
+    if not receipt_doc.exists:
+        return jsonify({"status": "error", "receipt_status": "not_found"}), 404
+    return jsonify({"status": "success", "receipt_status": "stored", "receipt": receipt_doc.to_dict()}), 200
+
+class SaleItemError(ValueError):
+    """A cart line that cannot be sold (carries the line's name)"""
+
+    def __init__(self, message, item_name=None):
+        super().__init__(message)
+        self.item_name = item_name
+
+def new_sale_ids(user_id, timestamp):
+    """Unique sale_id / receipt_id (the receipt number stays the epoch second)"""
+    unique = uuid.uuid4().hex[:12]
+    seconds = int(timestamp.timestamp())
+    return f"sale_{seconds}_{unique}", f"receipt_{seconds}_{user_id[:8]}_{unique}"
+
+def build_sale_payload(shop_id, seller, items, payment, sale_id, receipt_id, timestamp):
+    """
+    Cart lines → the payload commit_sale_group applies: batch/item deductions
+    in base units, stock transaction records and receipt lines.
+    Raises SaleItemError for the first line that cannot be sold.
+    """
     processed_items = []
     batch_updates = []
     item_updates = []
@@ -1365,11 +3189,9 @@ def complete_sale():
                 if conversion_factor <= 0:
                     raise ValueError(f"Invalid conversion factor: {conversion_factor}")
                 
-                # Calculate base quantity
-                base_quantity = original_quantity * conversion_factor
-                
-                # Round to 6 decimal places for consistency
-                base_quantity = round(base_quantity, 6)
+                # Calculate base quantity (exact: micro-units × rational factor)
+                base_micro = mul_ratio(to_micro(original_quantity), conversion_factor)
+                base_quantity = from_micro(base_micro)
                 
                 logger.info(f"   🔄 Converting selling unit:")
                 logger.info(f"     Original: {original_quantity} selling units")
@@ -1388,7 +3210,8 @@ def complete_sale():
                 
             else:
                 # This is a base/main item - no conversion needed
-                base_quantity = original_quantity
+                base_micro = to_micro(original_quantity)
+                base_quantity = from_micro(base_micro)
                 logger.info(f"   ✅ Base item - deducting {base_quantity} units directly")
                 
                 unit_info = {
@@ -1400,15 +3223,17 @@ def complete_sale():
                 }
             
             # ========== 2B. VALIDATE QUANTITIES ==========
-            if base_quantity <= 0:
+            if base_micro <= 0:
                 raise ValueError(f"Invalid quantity: {base_quantity}")
+            line_total = from_minor(line_total_minor(base_micro, sell_price))
             
             # ========== 2C. PREPARE BATCH UPDATE ==========
             batch_update = {
                 'shop_id': shop_id,
                 'item_id': item_id,
                 'batch_id': batch_id,
-                'deduct_quantity': base_quantity,  # Float!
+                'deduct_quantity': base_quantity,
+                'deduct_micro': base_micro,
                 'original_item': item,
                 'unit_info': unit_info,
                 'sell_price': sell_price
@@ -1419,7 +3244,8 @@ def complete_sale():
             item_update = {
                 'shop_id': shop_id,
                 'item_id': item_id,
-                'deduct_quantity': base_quantity,  # Float!
+                'deduct_quantity': base_quantity,
+                'deduct_micro': base_micro,
                 'sell_price': sell_price
             }
             item_updates.append(item_update)
@@ -1436,7 +3262,7 @@ def complete_sale():
                 'selling_units_quantity': unit_info.get('selling_units_quantity'),
                 'conversion_factor': unit_info.get('conversion_factor'),
                 'unit_price': sell_price,
-                'total_price': base_quantity * sell_price,
+                'total_price': line_total,
                 'unit': unit_info['base_unit'],
                 'display_unit': unit_info['display_unit'],
                 'performed_by': seller,
@@ -1452,7 +3278,7 @@ def complete_sale():
                 'processed_at': timestamp.isoformat(),
                 'base_quantity_deducted': base_quantity,
                 'unit_info': unit_info,
-                'item_total': base_quantity * sell_price,
+                'item_total': line_total,
                 'sale_item_id': f"{sale_id}_item{item_idx}"
             })
             processed_items.append(processed_item)
@@ -1461,146 +3287,189 @@ def complete_sale():
         
     except Exception as e:
         logger.error(f"❌ Item processing failed: {e}")
+        raise SaleItemError(str(e), item.get('name') if 'item' in locals() else 'unknown') from e
+
+    return {
+        'shop_id': shop_id,
+        'sale_id': sale_id,
+        'receipt_id': receipt_id,
+        'timestamp': timestamp,
+        'seller': seller,
+        'items': items,
+        'payment': payment,
+        'processed_items': processed_items,
+        'batch_updates': batch_updates,
+        'item_updates': item_updates,
+        'transaction_records': transaction_records
+    }
+    
+def sale_success_body(sale, committed):
+    """/complete-sale response of a committed sale (also what idempotent retries get back)"""
+    processed_items = sale['processed_items']
+    receipt_id = sale['receipt_id']
+    return {
+        "success": True,
+        "message": "Sale completed successfully",
+        "sale_id": sale['sale_id'],
+        "receipt_id": receipt_id,
+        "receipt_number": receipt_id.split('_')[1] if '_' in receipt_id else receipt_id,
+        "timestamp": sale['timestamp'].isoformat(),
+        "summary": {
+            "total_amount": round(committed['total_amount'], 2),
+            "total_base_units": round(committed['total_base_units'], 6),
+            "items_count": len(sale['items']),
+            "selling_units_converted": sum(1 for i in processed_items if i['unit_info']['is_selling_unit'])
+        },
+        # With the write-behind on, the receipt is stored shortly after this response
+        "receipt_status": "pending" if sale_record_writer is not None else "stored",
+        "receipt_status_url": f"/complete-sale/receipts/{sale.get('shop_id')}/{receipt_id}",
+        "debug_info": {
+            "shop_id": sale.get('shop_id'),
+            "seller": sale['seller'].get('name'),
+            "batch_updates_count": len(sale['batch_updates']),
+            "transaction_records": len(sale['transaction_records']),
+            "group_commit_size": committed['group_size']
+        }
+    }
+
+# ============== SALE IDEMPOTENCY ==============
+SALE_IDEMPOTENCY_TTL_S = float(os.environ.get("SALE_IDEMPOTENCY_TTL_S", "86400"))
+SALE_IDEMPOTENCY_MAX_KEYS = int(os.environ.get("SALE_IDEMPOTENCY_MAX_KEYS", "50000"))
+
+# Server errors are not remembered: the retry runs the sale again
+sale_requests = IdempotencyTable("complete_sale", ttl=SALE_IDEMPOTENCY_TTL_S,
+                                 max_entries=SALE_IDEMPOTENCY_MAX_KEYS,
+                                 storable=lambda response: response[1] < 500)
+
+def sale_fingerprint(data):
+    """
+    Digest of what a sale does: the fields process_sale() reads, with missing
+    seller/items/payment as empty. /complete-sale and /complete-sale/bulk both
+    fingerprint this same payload, so a sale tried online and then replayed
+    from the offline queue under the same key matches instead of conflicting.
+    """
+    canonical = {
+        'shop_id': data.get('shop_id'),
+        'user_id': data.get('user_id'),
+        'seller': data.get('seller') or {},
+        'items': data.get('items') or [],
+        'payment': data.get('payment') or {}
+    }
+    return hashlib.sha256(json.dumps(canonical, sort_keys=True, default=str).encode()).hexdigest()
+
+def run_sale(data):
+    """process_sale() as a storable (body, status) pair"""
+    response, status = process_sale(data)
+    return response.get_json(), status
+
+@app.route('/complete-sale', methods=['POST'])
+def complete_sale():
+    """
+    Complete a sale. Clients should send an `Idempotency-Key` header (or an
+    `idempotency_key` field): a retry with the same key returns the stored
+    response without touching Firestore, and a duplicate sent while the first
+    attempt is still running waits for it. Keys are remembered by this process
+    only (see idempotency.py): run one worker, or route a till to one worker.
+    """
+    data = request.get_json(silent=True)
+    key = request.headers.get('Idempotency-Key') or (data or {}).get('idempotency_key')
+    if not key or not isinstance(data, dict):
+        return process_sale(data)
+
+    try:
+        (body, status), replayed = sale_requests.run(f"{data.get('shop_id')}:{key}", sale_fingerprint(data),
+                                                     run_sale, data)
+    except IdempotencyConflict as e:
         return jsonify({
             "success": False,
-            "error": f"Failed to process items: {str(e)}",
-            "failed_at_item": item.get('name') if 'item' in locals() else 'unknown'
-        }), 400
+            "error": "Idempotency key reuse",
+            "message": str(e)
+        }), 422
+
+    if replayed:
+        logger.info(f"♻️ Replayed stored response for idempotency key {key}")
+    response = jsonify(body)
+    response.headers['Idempotent-Replayed'] = 'true' if replayed else 'false'
+    return response, status
+
+@app.route('/complete-sale/idempotency', methods=['GET'])
+def complete_sale_idempotency_stats():
+    """Dedupe table counters: executed, replayed, waited on a running duplicate, evicted"""
+    return jsonify({"status": "success", "idempotency": sale_requests.stats()})
+
+def process_sale(data):
+    """
+    Complete sale with unit conversion logic
+    Handles: Base units (direct) and Selling units (converted)
+    Supports: Floating point quantities
+    """
     
-    # ============== 3. EXECUTE DATABASE UPDATES ==============
+    # ============== 1. INITIAL SETUP & VALIDATION ==============
     try:
-        logger.info(f"\n💾 Executing database updates...")
-        
-        # Create a batch write for atomic updates
-        batch = db.batch()
-        
-        # Track totals
-        total_base_units = 0
-        total_amount = 0
-        
-        # 3A. UPDATE BATCHES
-        for batch_update in batch_updates:
-            item_ref = db.collection('Shops').document(batch_update['shop_id']) \
-                      .collection('items').document(batch_update['item_id'])
-            
-            # We need to update a specific batch in the array
-            # This requires reading the item first to find batch index
-            item_doc = item_ref.get()
-            if item_doc.exists:
-                item_data = item_doc.to_dict()
-                batches = item_data.get('batches', [])
-                
-                # Find the specific batch
-                batch_found = False
-                for i, b in enumerate(batches):
-                    if b.get('id') == batch_update['batch_id']:
-                        batch_found = True
-                        
-                        # Calculate new quantity (handle float)
-                        current_qty = float(b.get('quantity', 0))
-                        new_qty = current_qty - batch_update['deduct_quantity']
-                        
-                        # Safety check (even though frontend validated)
-                        if new_qty < -0.001:  # Small tolerance
-                            raise ValueError(f"Batch {batch_update['batch_id']} would go negative")
-                        
-                        # Update batch quantity
-                        batch_path = f'batches.{i}.quantity'
-                        batch.update(item_ref, {batch_path: round(new_qty, 6)})
-                        
-                        logger.info(f"   🔄 Batch {batch_update['batch_id']}: {current_qty} → {round(new_qty, 6)}")
-                        break
-                
-                if not batch_found:
-                    logger.warning(f"   ⚠️ Batch {batch_update['batch_id']} not found")
-            
-            total_base_units += batch_update['deduct_quantity']
-            total_amount += batch_update['deduct_quantity'] * batch_update['sell_price']
-        
-        # 3B. UPDATE ITEM STOCK
-        for item_update in item_updates:
-            item_ref = db.collection('Shops').document(item_update['shop_id']) \
-                      .collection('items').document(item_update['item_id'])
-            
-            # Get current stock
-            item_doc = item_ref.get()
-            if item_doc.exists:
-                item_data = item_doc.to_dict()
-                current_stock = float(item_data.get('stock', 0))
-                new_stock = current_stock - item_update['deduct_quantity']
-                
-                # Update stock
-                batch.update(item_ref, {
-                    'stock': round(new_stock, 6),
-                    'lastStockUpdate': timestamp.isoformat(),
-                    'lastTransactionId': sale_id,
-                    'updatedAt': timestamp.isoformat(),
-                    'updatedBy': seller
-                })
-                
-                logger.info(f"   📊 Item stock: {current_stock} → {round(new_stock, 6)}")
-        
-        # 3C. ADD TRANSACTION RECORDS
-        for transaction in transaction_records:
-            item_ref = db.collection('Shops').document(shop_id) \
-                      .collection('items').document(transaction['item_id'])
-            
-            batch.update(item_ref, {
-                'stockTransactions': firestore.ArrayUnion([transaction])
-            })
-        
-        # 3D. CREATE RECEIPT
-        receipt_ref = db.collection('Shops').document(shop_id) \
-                     .collection('receipts').document(receipt_id)
-        
-        receipt_data = {
-            'id': receipt_id,
-            'sale_id': sale_id,
-            'shop_id': shop_id,
-            'timestamp': timestamp.isoformat(),
-            'seller': seller,
-            'items': processed_items,
-            'original_cart': items,  # Keep original for reference
-            'summary': {
-                'total_items': len(items),
-                'total_base_units': round(total_base_units, 6),
-                'total_amount': round(total_amount, 2),
-                'contains_selling_units': any(i['unit_info']['is_selling_unit'] for i in processed_items),
-                'converted_items': sum(1 for i in processed_items if i['unit_info']['is_selling_unit'])
-            },
-            'payment': payment,
-            'status': 'completed',
-            'created_at': timestamp.isoformat()
-        }
+        if not data:
+            return jsonify({
+                "success": False,
+                "error": "No data received"
+            }), 400
         
-        batch.set(receipt_ref, receipt_data)
+        shop_id = data.get('shop_id')
+        user_id = data.get('user_id')
+        seller = data.get('seller', {})
+        items = data.get('items', [])
+        payment = data.get('payment', {})
         
-        # 3E. CREATE AUDIT LOG
-        audit_ref = db.collection('Shops').document(shop_id) \
-                    .collection('auditLogs').document(f"audit_{sale_id}")
+        # Validate required fields
+        if not shop_id or not user_id or not seller or len(items) == 0:
+            return jsonify({
+                "success": False,
+                "error": "Missing required fields: shop_id, user_id, seller, or items"
+            }), 400
         
-        audit_data = {
-            'id': f"audit_{sale_id}",
-            'action': 'sale_completed',
-            'performed_by': seller,
-            'timestamp': timestamp.isoformat(),
-            'details': {
-                'sale_id': sale_id,
-                'receipt_id': receipt_id,
-                'items_count': len(items),
-                'total_amount': round(total_amount, 2),
-                'total_base_units': round(total_base_units, 6),
-                'batch_count': len(batch_updates),
-                'had_conversions': any(i['unit_info']['is_selling_unit'] for i in processed_items)
-            }
-        }
+        # Generate unique IDs
+        timestamp = datetime.now()
+        sale_id, receipt_id = new_sale_ids(user_id, timestamp)
         
-        batch.set(audit_ref, audit_data)
+        logger.info(f"🔄 Starting sale: {sale_id}")
+        logger.info(f"🏪 Shop: {shop_id}")
+        logger.info(f"👤 Seller: {seller.get('name')}")
+        logger.info(f"🛍️ Items to process: {len(items)}")
         
-        # 3F. COMMIT ALL UPDATES
-        batch.commit()
-        logger.info(f"✅ Database updates committed successfully")
+    except Exception as e:
+        logger.error(f"❌ Initial validation failed: {e}")
+        return jsonify({
+            "success": False,
+            "error": "Invalid request format",
+            "message": str(e)
+        }), 400
+    
+    # ============== 2. PROCESS EACH ITEM ==============
+    try:
+        sale = build_sale_payload(shop_id, seller, items, payment, sale_id, receipt_id, timestamp)
+    except SaleItemError as e:
+        return jsonify({
+            "success": False,
+            "error": f"Failed to process items: {str(e)}",
+            "failed_at_item": e.item_name
+        }), 400
+    
+    # ============== 3. EXECUTE DATABASE UPDATES ==============
+    # Sales of the same shop arriving within a few ms are committed together
+    try:
+        logger.info(f"\n💾 Queueing database updates (group commit)...")
+        committed = sale_committer.submit(shop_id, sale)
+        total_amount = committed['total_amount']
+        total_base_units = committed['total_base_units']
+        logger.info(f"✅ Database updates committed successfully (group of {committed['group_size']})")
         
+    except ValueError as e:
+        # A batch would go negative: same answer as /complete-sale/bulk gives
+        logger.warning(f"⚠️ Sale rejected: {e}")
+        return jsonify({
+            "success": False,
+            "error": "Insufficient stock",
+            "message": str(e),
+            "sale_id": sale_id
+        }), 409
     except Exception as e:
         logger.error(f"❌ Database update failed: {e}")
         return jsonify({
@@ -1618,25 +3487,227 @@ def complete_sale():
     logger.info(f"   Items: {len(items)}")
     logger.info("=" * 60)
     
+    return jsonify(sale_success_body(sale, committed)), 200
+
+# ============== BULK SALE SYNC (offline tills) ==============
+BULK_SALE_MAX_SALES = int(os.environ.get("BULK_SALE_MAX_SALES", 500))
+
+def parse_client_timestamp(value):
+    """When a queued sale happened (ISO string or epoch s/ms); now if missing, invalid or in the future"""
+    now = datetime.now()
+    try:
+        if isinstance(value, (int, float)):
+            sold_at = datetime.fromtimestamp(value / 1000 if value > 1e11 else value)
+        elif isinstance(value, str) and value:
+            sold_at = datetime.fromisoformat(value.replace('Z', '+00:00'))
+            if sold_at.tzinfo is not None:
+                sold_at = sold_at.astimezone().replace(tzinfo=None)
+        else:
+            return now
+    except (ValueError, OverflowError, OSError):
+        return now
+    return min(sold_at, now)
+
+@timed("batch_selection")
+def allocate_queued_sale_lines(search_index, items, working_batches):
+    """
+    Check one queued sale against the cached stock left by the sales before it
+    (working_batches: item_id -> cached batches with a running remaining_quantity).
+    A line keeps its batch if that batch still covers it, otherwise it is
+    re-allocated FIFO over the item's batches (split per batch). All-or-nothing:
+    raises (SaleItemError for bad lines) and leaves working_batches untouched.
+    """
+    lines = []
+    taken = []  # (batch, quantity) to undo if a later line fails
+    try:
+        if not isinstance(items, list):
+            raise SaleItemError("items must be a list")
+        for item in items:
+            if not isinstance(item, dict):
+                raise SaleItemError(f"Invalid sale line: {item!r}")
+            item_id = item.get('item_id')
+            name = item.get('name')
+            if not isinstance(item_id, str):
+                raise SaleItemError(f"Invalid item_id: {item_id!r}", name)
+            if item_id not in working_batches:
+                position = search_index["by_item_id"].get(item_id)
+                if position is None:
+                    raise SaleItemError(f"Item {item_id} not found", name)
+                cached = search_index["entries"][position][1]
+                working_batches[item_id] = [{**b, "remaining_quantity": b["quantity"]} for b in cached.get("batches", [])]
+            batches = working_batches[item_id]
+
+            try:
+                factor = ratio(item.get('conversion_factor', 1.0)) if item.get('type') == 'selling_unit' else 1
+                base_micro = mul_ratio(to_micro(item.get('quantity', 0)), factor)
+            except (TypeError, ValueError, ZeroDivisionError):
+                raise SaleItemError(f"Invalid quantity: {item.get('quantity')}", name)
+            if factor <= 0 or base_micro <= 0:
+                raise SaleItemError(f"Invalid quantity: {from_micro(base_micro)}", name)
+
+            chosen = next((b for b in batches if b["batch_id"] == item.get('batch_id')), None)
+            if chosen is not None and to_micro(chosen["remaining_quantity"]) >= base_micro:
+                allocation = [{"batch_id": chosen["batch_id"], "quantity_micro": base_micro, "batch_info": chosen}]
+            else:
+                result = allocate_main_item_fifo(batches, from_micro(base_micro))
+                if not result["success"]:
+                    raise SaleItemError(result["error"], name)
+                allocation = result["allocation"]
+
+            for part in allocation:
+                batch = part["batch_info"]
+                batch["remaining_quantity"] = from_micro(to_micro(batch["remaining_quantity"]) - part["quantity_micro"])
+                taken.append((batch, part["quantity_micro"]))
+                line = {**item, "batch_id": part["batch_id"]}
+                if part["batch_id"] != item.get('batch_id') or len(allocation) > 1:
+                    line["quantity"] = from_micro(div_ratio(part["quantity_micro"], factor))
+                    line["requested_batch_id"] = item.get('batch_id')
+                lines.append(line)
+    except Exception:
+        for batch, quantity_micro in taken:
+            batch["remaining_quantity"] = from_micro(to_micro(batch["remaining_quantity"]) + quantity_micro)
+        raise
+    return lines
+
+@app.route('/complete-sale/bulk', methods=['POST'])
+def complete_sale_bulk():
+    """
+    Sync a till's offline queue in one request:
+    {shop_id, user_id, seller, payment?, sales: [{idempotency_key, items, timestamp?, seller?, payment?}]}
+
+    Sales are checked against the cached stock and FIFO-allocated in order in
+    one pass (each sees the stock the previous ones took), then committed as
+    ONE group (as few Firestore batches as the 500-writes limit allows).
+    Returns one result per sale, shaped like the /complete-sale response.
+    idempotency_key shares the /complete-sale dedupe table, so re-syncing a
+    queue replays results instead of selling twice.
+    """
+    start = time.time()
+    data = request.get_json(silent=True) or {}
+    shop_id = data.get('shop_id')
+    user_id = data.get('user_id')
+    sales = data.get('sales')
+    if not shop_id or not user_id or not isinstance(sales, list) or not sales:
+        return jsonify({
+            "success": False,
+            "error": "Missing required fields: shop_id, user_id or sales"
+        }), 400
+    if len(sales) > BULK_SALE_MAX_SALES:
+        return jsonify({
+            "success": False,
+            "error": f"Too many sales in one request (max {BULK_SALE_MAX_SALES})"
+        }), 413
+
+    search_index = acquire_shop_index(shop_id)
+    if search_index is None:
+        return jsonify({"success": False, "error": f"Shop {shop_id} not found or has no items"}), 404
+
+    logger.info(f"📥 Bulk sync: {len(sales)} queued sale(s) for shop {shop_id}")
+    keys = [queued.get('idempotency_key') if isinstance(queued, dict) else None for queued in sales]
+    results = [None] * len(sales)  # (body, status)
+    replayed = set()
+    claims = {}      # position -> (dedupe key, entry) this request must complete
+    waits = []       # (position, entry) of sales another request is handling
+    to_commit = []   # (position, sale payload)
+    working_batches = {}
+
+    try:
+        # ----- 1. validate + allocate every sale in order, against the cache -----
+        for position, queued in enumerate(sales):
+            queued = queued if isinstance(queued, dict) else {}
+            sale_data = {
+                'shop_id': shop_id,
+                'user_id': user_id,
+                'seller': queued.get('seller') or data.get('seller') or {},
+                'items': queued.get('items') or [],
+                'payment': queued.get('payment') or data.get('payment') or {}
+            }
+            if keys[position]:
+                dedupe_key = f"{shop_id}:{keys[position]}"
+                try:
+                    entry, owner = sale_requests.claim(dedupe_key, sale_fingerprint(sale_data))
+                except IdempotencyConflict as e:
+                    results[position] = ({"success": False, "error": "Idempotency key reuse", "message": str(e)}, 422)
+                    continue
+                if not owner:
+                    waits.append((position, entry))
+                    continue
+                claims[position] = (dedupe_key, entry)
+
+            try:
+                if not sale_data['seller'] or not sale_data['items']:
+                    raise SaleItemError("Missing required fields: seller or items")
+                lines = allocate_queued_sale_lines(search_index, sale_data['items'], working_batches)
+                timestamp = parse_client_timestamp(queued.get('timestamp'))
+                sale_id, receipt_id = new_sale_ids(user_id, timestamp)
+                to_commit.append((position, build_sale_payload(
+                    shop_id, sale_data['seller'], lines, sale_data['payment'], sale_id, receipt_id, timestamp)))
+            except SaleItemError as e:
+                results[position] = ({
+                    "success": False,
+                    "error": f"Failed to process items: {str(e)}",
+                    "failed_at_item": e.item_name
+                }, 400)
+            except Exception as e:
+                # One broken queued sale must not fail the rest of the sync
+                logger.exception(f"❌ Bulk sync: sale {position} of shop {shop_id} failed")
+                results[position] = ({
+                    "success": False,
+                    "error": "Failed to process sale",
+                    "message": str(e)
+                }, 500)
+
+        # ----- 2. one group commit for everything that passed -----
+        if to_commit:
+            outcomes = sale_committer.submit_many(shop_id, [sale for _, sale in to_commit])
+            for (position, sale), outcome in zip(to_commit, outcomes):
+                if isinstance(outcome, ValueError):
+                    results[position] = ({"success": False, "error": "Insufficient stock",
+                                          "message": str(outcome), "sale_id": sale['sale_id']}, 409)
+                elif isinstance(outcome, Exception):
+                    results[position] = ({"success": False, "error": "Database update failed",
+                                          "message": str(outcome), "sale_id": sale['sale_id']}, 500)
+                else:
+                    results[position] = (sale_success_body(sale, outcome), 200)
+    finally:
+        # Always release claimed keys: anything left unanswered counts as a server error
+        for position, (dedupe_key, entry) in claims.items():
+            if results[position] is None:
+                results[position] = ({"success": False, "error": "Bulk sync failed"}, 500)
+            sale_requests.complete(dedupe_key, entry, results[position])
+
+    # ----- 3. sales another request was already handling -----
+    for position, entry in waits:
+        try:
+            results[position] = sale_requests.wait(entry)
+            replayed.add(position)
+        except Exception as e:
+            results[position] = ({"success": False, "error": "Database update failed", "message": str(e)}, 500)
+
+    completed = sum(1 for _, status in results if status == 200)
+    logger.info(f"✅ Bulk sync for shop {shop_id}: {completed}/{len(sales)} completed "
+                f"in {round((time.time() - start) * 1000, 2)}ms")
+
     return jsonify({
         "success": True,
-        "message": "Sale completed successfully",
-        "sale_id": sale_id,
-        "receipt_id": receipt_id,
-        "receipt_number": receipt_id.split('_')[1] if '_' in receipt_id else receipt_id,
-        "timestamp": timestamp.isoformat(),
+        "shop_id": shop_id,
+        "results": [
+            {
+                "index": position,
+                "idempotency_key": keys[position],
+                "status": status,
+                "replayed": position in replayed,
+                **body
+            }
+            for position, (body, status) in enumerate(results)
+        ],
         "summary": {
-            "total_amount": round(total_amount, 2),
-            "total_base_units": round(total_base_units, 6),
-            "items_count": len(items),
-            "selling_units_converted": sum(1 for i in processed_items if i['unit_info']['is_selling_unit'])
-        },
-        "receipt_url": f"/receipts/{receipt_id}",  # For frontend to display
-        "debug_info": {
-            "shop_id": shop_id,
-            "seller": seller.get('name'),
-            "batch_updates_count": len(batch_updates),
-            "transaction_records": len(transaction_records)
+            "total": len(sales),
+            "completed": completed,
+            "failed": len(sales) - completed,
+            "replayed": len(replayed),
+            "committed_now": sum(1 for position, _ in to_commit if results[position][1] == 200),
+            "processing_time_ms": round((time.time() - start) * 1000, 2)
         }
     }), 200
 
@@ -1692,8 +3763,7 @@ def test_sale_conversion():
     results = {}
     for test_name, test in test_data.items():
         if test['type'] == 'selling_unit':
-            base_qty = test['quantity'] * test['conversion_factor']
-            base_qty = round(base_qty, 6)
+            base_qty = from_micro(mul_ratio(to_micro(test['quantity']), test['conversion_factor']))
         else:
             base_qty = test['quantity']
         
@@ -1712,8 +3782,119 @@ def test_sale_conversion():
 # ======================================================
 # ITEM OPTIMIZATION (UPDATED WITH BATCH INFO)
 # ======================================================
+ITEM_OPTIMIZATION_STREAM_PAGE_SIZE = 500
+
+def export_cached_item(item, include_embeddings=False):
+    """JSON-safe copy of a cached item (numpy embedding arrays summarised or listed)"""
+    exported = dict(item)
+    embeddings = item.get("embeddings", [])
+    if include_embeddings:
+        exported["embeddings"] = [np.asarray(e).tolist() for e in embeddings]
+    else:
+        exported.pop("embeddings", None)
+    exported["embedding_count"] = len(embeddings)
+    exported["embedding_dim"] = int(np.asarray(embeddings[0]).size) if embeddings else 0
+    return exported
+
+def export_cached_shop(shop, include_embeddings=False):
+    """JSON-safe copy of a cached shop with all its categories and items"""
+    return {
+        "shop_id": shop["shop_id"],
+        "shop_name": shop.get("shop_name", ""),
+        "categories": [
+            {
+                "category_id": category["category_id"],
+                "category_name": category.get("category_name", ""),
+                "items": [export_cached_item(item, include_embeddings) for item in category["items"]]
+            }
+            for category in shop["categories"]
+        ]
+    }
+
+def iter_item_optimization_ndjson(shops, granularity, offset, limit, include_embeddings, last_updated):
+    """
+    Yield the cache as NDJSON: a meta line, one line per shop (or per item), an end line.
+    Only one record is serialised at a time, so memory stays flat for any catalog size.
+    """
+    yield app.json.dumps({
+        "type": "meta",
+        "granularity": granularity,
+        "offset": offset,
+        "limit": limit,
+        "last_updated": last_updated
+    }) + "\n"
+
+    position = 0
+    emitted = 0
+    for shop in shops:
+        if granularity == "shop":
+            records = [(shop, None, None)]
+        else:
+            records = ((shop, category, item) for category in shop["categories"] for item in category["items"])
+
+        for shop_ref, category, item in records:
+            if emitted >= limit:
+                break
+            if position < offset:
+                position += 1
+                continue
+
+            if item is None:
+                record = {"type": "shop", **export_cached_shop(shop_ref, include_embeddings)}
+            else:
+                record = {
+                    "type": "item",
+                    "shop_id": shop_ref["shop_id"],
+                    "shop_name": shop_ref.get("shop_name", ""),
+                    **export_cached_item(item, include_embeddings),
+                    "category_id": category["category_id"],
+                    "category_name": category.get("category_name", "")
+                }
+            yield app.json.dumps(record) + "\n"
+            position += 1
+            emitted += 1
+
+        if emitted >= limit:
+            break
+
+    yield app.json.dumps({
+        "type": "end",
+        "count": emitted,
+        "next_offset": offset + emitted if emitted >= limit else None
+    }) + "\n"
+
 @app.route("/item-optimization", methods=["GET"])
 def item_optimization():
+    # Streaming mode: /item-optimization?stream=1&granularity=item&shop_id=a,b&offset=0&limit=500
+    if request.args.get("stream") in ("1", "true", "ndjson") or request.args.get("format") == "ndjson":
+        try:
+            granularity = request.args.get("granularity", "shop")
+            if granularity not in ("shop", "item"):
+                raise ValueError("granularity must be 'shop' or 'item'")
+            offset = max(0, int(request.args.get("offset", 0)))
+            limit = max(1, int(request.args.get("limit", ITEM_OPTIMIZATION_STREAM_PAGE_SIZE)))
+        except ValueError as e:
+            return jsonify({"status": "error", "message": str(e)}), 400
+
+        include_embeddings = request.args.get("include_embeddings") in ("1", "true")
+        shop_filter = {s for s in request.args.get("shop_id", "").split(",") if s}
+
+        # Explicitly requested shops are loaded if they are not resident yet
+        for shop_id in shop_filter:
+            acquire_shop_index(shop_id)
+
+        # Snapshot the shop list now; refreshes swap in a new list rather than mutating it
+        shops = embedding_cache_full["shops"]
+        if shop_filter:
+            shops = [s for s in shops if s["shop_id"] in shop_filter]
+
+        return Response(
+            stream_with_context(iter_item_optimization_ndjson(
+                shops, granularity, offset, limit, include_embeddings, embedding_cache_full["last_updated"]
+            )),
+            mimetype="application/x-ndjson"
+        )
+
     # Calculate batch statistics
     total_batches = 0
     items_with_batches = 0
@@ -1792,6 +3973,114 @@ def debug_cache():
     except (IndexError, KeyError) as e:
         return jsonify({"error": f"Cache structure issue: {str(e)}"}), 500
 
+@app.route("/cache-stats", methods=["GET"])
+def cache_stats():
+    """Lazy shop cache metrics (hit rate, loads, LRU evictions, resident size) and single-flight counters"""
+    return jsonify({
+        "status": "success",
+        "cache": shop_cache_report(),
+        "single_flight": {flight.name: flight.stats() for flight in (shop_loads, plan_ensures)}
+    })
+
+
+# ======================================================
+# REQUEST METRICS (/metrics, Prometheus text format)
+# ======================================================
+# Routes are labelled by their rule ("/stock/changes/<shop_id>"), never the raw
+# path, so the number of series stays bounded.
+http_request_seconds = metrics_registry.histogram(
+    "http_request_duration_seconds", "Request latency", ("method", "route", "status"))
+http_response_bytes = metrics_registry.histogram(
+    "http_response_size_bytes", "Response body size (streamed responses excluded)", ("route",), buckets=SIZE_BUCKETS)
+http_in_flight = metrics_registry.gauge("http_requests_in_flight", "Requests being handled", ("route",))
+http_errors = metrics_registry.counter(
+    "http_request_errors_total", "Responses with status >= 400, and unhandled exceptions (kind=exception)",
+    ("route", "kind"))
+
+# Firestore documents a request cost, added to JSON responses as meta.firestore when
+# this is on, or per request with the X-Firestore-Cost: 1 header / ?firestore_cost=1
+FIRESTORE_COST_IN_RESPONSE = os.environ.get("FIRESTORE_COST_IN_RESPONSE", "0") == "1"
+
+@app.before_request
+def start_request_metrics():
+    g.metrics_route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    g.metrics_start = time.perf_counter()
+    g.firestore_cost = firestore_meter.open(g.metrics_route)
+    http_in_flight.inc(g.metrics_route)
+
+def wants_firestore_cost():
+    return FIRESTORE_COST_IN_RESPONSE or request.headers.get("X-Firestore-Cost") == "1" \
+        or request.args.get("firestore_cost") == "1"
+
+def firestore_cost_meta():
+    """meta.firestore for the JSON response being built: the request's Firestore document counts so far"""
+    if not has_request_context():
+        return None
+    cost = g.get("firestore_cost")
+    if cost is None or not wants_firestore_cost():
+        return None
+    return {"firestore": cost.totals()}
+
+app.json.response_meta = firestore_cost_meta
+
+@app.after_request
+def record_request_metrics(response):
+    start = g.get("metrics_start")
+    if start is None:
+        return response
+    route = g.metrics_route
+    status = response.status_code
+    http_request_seconds.observe(time.perf_counter() - start, request.method, route, str(status))
+    if not response.is_streamed and response.content_length is not None:
+        http_response_bytes.observe(response.content_length, route)
+    if status >= 400:
+        http_errors.inc(route, "server" if status >= 500 else "client")
+    return response
+
+@app.teardown_request
+def finish_request_metrics(exc):
+    cost = g.pop("firestore_cost", None)
+    if cost is not None:
+        firestore_meter.close(cost)
+    route = g.pop("metrics_route", None)
+    if route is None:
+        return
+    http_in_flight.dec(route)
+    if exc is not None:
+        http_errors.inc(route, "exception")
+
+def numeric_stats(prefix, stats):
+    """Flatten a component's stats() dict into (stat name, number) pairs"""
+    for key, value in stats.items():
+        name = f"{prefix}_{key}" if prefix else str(key)
+        if isinstance(value, dict):
+            yield from numeric_stats(name, value)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield name, value
+
+@metrics_registry.collector
+def component_stats():
+    """The counters the */stats routes report, as one gauge family"""
+    components = {
+        "shop_cache": shop_cache_report(),
+        "plan_ensure": plan_ensures.stats(),
+        "sale_group_commit": sale_committer.stats(),
+        "sale_record_writer": sale_record_writer_stats(),
+        "sale_idempotency": sale_requests.stats(),
+        "vectorize_pipeline": vectorize_pipeline.stats()
+    }
+    samples = [({"component": component, "stat": stat}, value)
+               for component, stats in components.items() for stat, value in numeric_stats("", stats)]
+    yield "app_component_stat", "gauge", "Numeric counters from the components' stats()", samples
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """
+    Request latency/size/error histograms, internal span timings, component
+    counters and Firestore document counts (per source, per shop, per scope)
+    """
+    return Response(metrics_registry.render(), mimetype="text/plain; version=0.0.4")
+
 
 
 
@@ -1799,6 +4088,34 @@ def debug_cache():
 # ======================================================
 # PLAN INITIALIZATION ROUTES
 # ======================================================
+plan_ensures = SingleFlight("plan_ensure")
+
+def ensure_default_plan(shop_id):
+    """Create Shops/{shop_id}/plan/default if missing; returns True if it was created"""
+    plan_ref = (
+        db.collection("Shops")
+          .document(shop_id)
+          .collection("plan")
+          .document("default")
+    )
+
+    if plan_ref.get().exists:
+        return False
+
+    plan_ref.set({
+        "name": "Solo",
+        "staffLimit": 0,
+        "features": {
+            "sell": True,
+            "manageStock": True,
+            "businessIntelligence": False,
+            "settings": True
+        },
+        "createdAt": firestore.SERVER_TIMESTAMP,
+        "updatedAt": firestore.SERVER_TIMESTAMP
+    })
+    return True
+
 @app.route("/ensure-plan", methods=["POST"])
 def ensure_plan():
     try:
@@ -1808,35 +4125,16 @@ def ensure_plan():
         if not shop_id:
             return jsonify({"success": False, "error": "shop_id is required"}), 400
 
-        plan_ref = (
-            db.collection("Shops")
-              .document(shop_id)
-              .collection("plan")
-              .document("default")
-        )
-
-        plan_doc = plan_ref.get()
+        # Tills logging in together share one read (and at most one create)
+        created = plan_ensures.do(shop_id, ensure_default_plan, shop_id)
 
-        if plan_doc.exists:
+        if not created:
             return jsonify({
                 "success": True,
                 "exists": True,
                 "message": "Plan already exists"
             }), 200
 
-        plan_ref.set({
-            "name": "Solo",
-            "staffLimit": 0,
-            "features": {
-                "sell": True,
-                "manageStock": True,
-                "businessIntelligence": False,
-                "settings": True
-            },
-            "createdAt": firestore.SERVER_TIMESTAMP,
-            "updatedAt": firestore.SERVER_TIMESTAMP
-        })
-
         return jsonify({
             "success": True,
             "created": True,
@@ -1851,6 +4149,570 @@ def ensure_plan():
         }), 500
 
 
+# ======================================================
+# STAFF DIRECTORY (email → shop/staff, replaces the all-shops scan)
+# ======================================================
+# Built by the collection_group('staff') listener: its first delivery holds
+# every staff doc, later ones only the changes. Only the ids are kept.
+staff_directory = {
+    "by_email": {},   # email -> {doc_path: record}
+    "by_path": {},    # doc_path -> email (so edits/removals drop the old email)
+    "ready": False,   # set once the listener's initial snapshot is applied
+    "last_updated": None,
+    "total_staff": 0
+}
+staff_directory_lock = threading.Lock()
+
+def normalize_email(email):
+    return (email or "").strip().lower()
+
+def staff_record_from_doc(staff_doc):
+    """Directory record for Shops/{shopId}/staff/{staffId}"""
+    shop_ref = staff_doc.reference.parent.parent
+    return {
+        "staffId": staff_doc.id,
+        "shopId": shop_ref.id if shop_ref else None,
+        "email": (staff_doc.to_dict() or {}).get("email"),
+        "staffDocPath": staff_doc.reference.path
+    }
+
+def _staff_directory_put(record):
+    """Insert/replace one record (caller holds staff_directory_lock)"""
+    _staff_directory_remove(record["staffDocPath"])
+    email = normalize_email(record.get("email"))
+    if not email:
+        return
+    staff_directory["by_email"].setdefault(email, {})[record["staffDocPath"]] = record
+    staff_directory["by_path"][record["staffDocPath"]] = email
+
+def _staff_directory_remove(doc_path):
+    """Drop one staff doc (caller holds staff_directory_lock)"""
+    old_email = staff_directory["by_path"].pop(doc_path, None)
+    if old_email is None:
+        return
+    entries = staff_directory["by_email"].get(old_email, {})
+    entries.pop(doc_path, None)
+    if not entries:
+        staff_directory["by_email"].pop(old_email, None)
+
+def on_staff_snapshot(col_snapshot, changes, read_time):
+    """Listener: apply staff adds/edits/removals to the directory in place"""
+    with staff_directory_lock:
+        for change in changes:
+            doc_path = change.document.reference.path
+            if change.type.name == "REMOVED":
+                _staff_directory_remove(doc_path)
+            else:
+                _staff_directory_put(staff_record_from_doc(change.document))
+        staff_directory["total_staff"] = len(staff_directory["by_path"])
+        staff_directory["last_updated"] = time.time()
+        staff_directory["ready"] = True
+    print(f"[LISTENER] Staff directory updated ({len(changes)} change(s))")
+
+def find_staff_by_email(email):
+    """Every shop/staff id pair registered for an email (sorted by document path)"""
+    with staff_directory_lock:
+        entries = staff_directory["by_email"].get(normalize_email(email)) or {}
+        return [{"shopId": entries[path]["shopId"], "staffId": entries[path]["staffId"]} for path in sorted(entries)]
+
+def verified_request_claims():
+    """Claims of the Firebase ID token in `Authorization: Bearer <token>` (None if missing/invalid/unverified email)"""
+    header = request.headers.get("Authorization", "")
+    if not header.startswith("Bearer "):
+        return None
+    try:
+        claims = firebase_auth.verify_id_token(header[len("Bearer "):])
+    except Exception as e:
+        print(f"⚠️ Rejected ID token: {e}")
+        return None
+    if not claims.get("email_verified") or not normalize_email(claims.get("email")):
+        return None
+    return claims
+
+def verified_request_email():
+    """Email of the Firebase ID token in `Authorization: Bearer <token>` (None if missing/invalid/unverified)"""
+    claims = verified_request_claims()
+    return normalize_email(claims.get("email")) if claims else None
+
+@app.route("/staff/lookup", methods=["POST"])
+def staff_lookup():
+    """
+    Staff login lookup for the signed-in user: the email comes from the
+    Firebase ID token, never from the body, and only shop/staff ids are
+    returned. 409 with every match if the email is staff in several shops.
+    """
+    try:
+        email = verified_request_email()
+        if not email:
+            return jsonify({"success": False, "error": "A valid Firebase ID token is required"}), 401
+
+        with staff_directory_lock:
+            ready = staff_directory["ready"]
+        if not ready:
+            return jsonify({"success": False, "error": "Staff directory is loading"}), 503, {"Retry-After": "2"}
+
+        matches = find_staff_by_email(email)
+        if not matches:
+            return jsonify({"success": True, "found": False}), 404
+        if len(matches) > 1:
+            return jsonify({
+                "success": False,
+                "found": True,
+                "error": "This email is registered as staff in several shops",
+                "matches": matches
+            }), 409
+
+        return jsonify({"success": True, "found": True, "staff": matches[0]}), 200
+
+    except Exception as e:
+        print("🔥 staff lookup failed:", e)
+        return jsonify({"success": False, "error": "Staff lookup failed"}), 500
+
+
+# ======================================================
+# CHANGE FEEDS (cursor polling, no request waits for changes)
+# ======================================================
+CHANGE_FEED_BUFFER_SIZE = 256
+CHANGE_FEED_WATCH_SECONDS = 60  # a topic polled this recently counts as watched
+CHANGE_FEED_EPOCH = uuid.uuid4().hex[:8]  # cursors from another process/restart force a reset
+
+class ChangeFeed:
+    """
+    Topic → ring buffer of recent events, each with a per-topic sequence number.
+    Clients poll since() with the cursor of their last answer and get the newer
+    events straight away, or reset=True when their cursor fell out of the buffer.
+    Publishing to a topic nobody polls is a no-op.
+    """
+
+    def __init__(self, buffer_size=CHANGE_FEED_BUFFER_SIZE, watch_seconds=CHANGE_FEED_WATCH_SECONDS):
+        self._buffer_size = buffer_size
+        self._watch_seconds = watch_seconds
+        self._topics = {}  # topic -> {"events": deque, "seq": int, "polled": float}
+        self._lock = threading.Lock()
+
+    def _prune(self, now):
+        """Forget topics nobody has polled for a while (caller holds the lock)"""
+        for topic in [t for t, state in self._topics.items() if now - state["polled"] > self._watch_seconds]:
+            del self._topics[topic]
+
+    def publish(self, topic, event, data):
+        with self._lock:
+            state = self._topics.get(topic)
+            if state is None:
+                return None
+            state["seq"] += 1
+            state["events"].append((state["seq"], event, data))
+            return state["seq"]
+
+    def since(self, topic, cursor=None):
+        """{"cursor", "reset", "events"}; cursor is the opaque string returned by the previous call"""
+        now = time.time()
+        with self._lock:
+            state = self._topics.get(topic)
+            if state is None:
+                self._prune(now)
+                state = self._topics[topic] = {"events": deque(maxlen=self._buffer_size), "seq": 0, "polled": now}
+            state["polled"] = now
+            seq = state["seq"]
+            oldest = state["events"][0][0] if state["events"] else seq + 1
+
+            epoch, _, last_seen = (cursor or "").partition(":")
+            last_seen = int(last_seen) if epoch == CHANGE_FEED_EPOCH and last_seen.isdigit() else None
+            reset = last_seen is None or last_seen > seq or last_seen < oldest - 1
+            events = [] if reset else [
+                {"seq": event_seq, "event": event, "data": data}
+                for event_seq, event, data in state["events"] if event_seq > last_seen
+            ]
+        return {"cursor": f"{CHANGE_FEED_EPOCH}:{seq}", "reset": reset, "events": events}
+
+    def is_watched(self, topic):
+        with self._lock:
+            state = self._topics.get(topic)
+            return state is not None and time.time() - state["polled"] <= self._watch_seconds
+
+    def watched_count(self):
+        now = time.time()
+        with self._lock:
+            return sum(1 for state in self._topics.values() if now - state["polled"] <= self._watch_seconds)
+
+change_feed = ChangeFeed()
+
+
+# ======================================================
+# LIVE STOCK CHANGES (one server listener → many polling tills)
+# ======================================================
+def stock_topic(shop_id):
+    return f"stock:{shop_id}"
+
+def collect_item_stock_deltas(changes):
+    """
+    Compare changed item docs with the cached copy → batch quantity deltas.
+    Handles both Shops/{shop}/categories/{cat}/items/{item} and Shops/{shop}/items/{item}.
+    """
+    deltas = []
+    for change in changes:
+        segments = change.document.reference.path.split("/")
+        if len(segments) < 4 or segments[0] != "Shops":
+            continue
+        shop_id, item_id = segments[1], segments[-1]
+        if not change_feed.is_watched(stock_topic(shop_id)):
+            continue  # nobody watching this shop
+
+        cached = find_item_in_cache(shop_id, item_id)
+        old_quantities = {b["batch_id"]: b["quantity"] for b in (cached or {}).get("batches", [])}
+
+        if change.type.name == "REMOVED":
+            new_batches = []
+        else:
+            item_data = change.document.to_dict() or {}
+            if shard_count(item_data):
+                # Base quantities changed; shard deltas are the cached ones
+                item_data = apply_shard_totals(item_data, (cached or {}).get("stock_shards", {}).values())
+            new_batches = item_data.get("batches", [])
+
+        new_ids = set()
+        for batch in new_batches:
+            batch_id = batch.get("id")
+            new_ids.add(batch_id)
+            quantity = float(batch.get("quantity", 0))
+            if old_quantities.get(batch_id) != quantity:
+                deltas.append({
+                    "type": "batch",
+                    "shop_id": shop_id,
+                    "item_id": item_id,
+                    "batch_id": batch_id,
+                    "quantity": quantity,
+                    "previous_quantity": old_quantities.get(batch_id)
+                })
+        for batch_id, old_quantity in old_quantities.items():
+            if batch_id not in new_ids:
+                deltas.append({
+                    "type": "batch_removed",
+                    "shop_id": shop_id,
+                    "item_id": item_id,
+                    "batch_id": batch_id,
+                    "quantity": 0,
+                    "previous_quantity": old_quantity
+                })
+    return deltas
+
+def collect_shard_stock_deltas(changes):
+    """Changed stock shard docs of hot items → batch quantity deltas (cached quantity + shard change)"""
+    deltas = []
+    for change in changes:
+        segments = change.document.reference.path.split("/")
+        if len(segments) < 6 or segments[0] != "Shops":
+            continue
+        shop_id, item_id, shard_id = segments[1], segments[-3], segments[-1]
+        if not change_feed.is_watched(stock_topic(shop_id)):
+            continue
+
+        cached = find_item_in_cache(shop_id, item_id)
+        if not cached:
+            continue
+        old_shard = cached.get("stock_shards", {}).get(shard_id) or {}
+        new_shard = {} if change.type.name == "REMOVED" else (change.document.to_dict() or {})
+        old_values = old_shard.get("batches") or {}
+        new_values = new_shard.get("batches") or {}
+
+        for batch in cached.get("batches", []):
+            batch_id = batch["batch_id"]
+            change_micro = to_micro(new_values.get(batch_id, 0)) - to_micro(old_values.get(batch_id, 0))
+            if change_micro:
+                deltas.append({
+                    "type": "batch",
+                    "shop_id": shop_id,
+                    "item_id": item_id,
+                    "batch_id": batch_id,
+                    "quantity": from_micro(to_micro(batch["quantity"]) + change_micro),
+                    "previous_quantity": batch["quantity"]
+                })
+    return deltas
+
+def collect_selling_unit_stock_deltas(changes):
+    """Changed sellUnits docs → available selling-unit deltas"""
+    deltas = []
+    for change in changes:
+        segments = change.document.reference.path.split("/")
+        if len(segments) < 6 or segments[0] != "Shops":
+            continue
+        shop_id, item_id, sell_unit_id = segments[1], segments[-3], segments[-1]
+        if not change_feed.is_watched(stock_topic(shop_id)):
+            continue
+
+        available = 0
+        if change.type.name != "REMOVED":
+            for link in (change.document.to_dict() or {}).get("batchLinks", []):
+                available += link.get("maxUnitsAvailable", 0) - link.get("allocatedUnits", 0)
+
+        cached = find_selling_unit_in_cache(shop_id, item_id, sell_unit_id)
+        previous = cached.get("total_units_available") if cached else None
+        if previous != available:
+            deltas.append({
+                "type": "selling_unit",
+                "shop_id": shop_id,
+                "item_id": item_id,
+                "sell_unit_id": sell_unit_id,
+                "quantity": available,
+                "previous_quantity": previous
+            })
+    return deltas
+
+def publish_stock_deltas(deltas):
+    """Append deltas to each shop's change feed, stamped with the cache version"""
+    version = embedding_cache_full["version"]
+    for delta in deltas:
+        delta["version"] = version
+        change_feed.publish(stock_topic(delta["shop_id"]), "stock", delta)
+    if deltas:
+        print(f"[STREAM] Published {len(deltas)} stock delta(s) at cache version {version}")
+
+@app.route("/stock/changes/<shop_id>", methods=["GET"])
+def stock_changes(shop_id):
+    """
+    Poll: ?cursor=<cursor from the previous answer>. Returns at once with the
+    compact stock deltas since then (item, batch, new quantity, cache version).
+    reset=true means the till missed changes and should re-run its search.
+    """
+    cursor = request.args.get("cursor")
+    if not cursor:
+        search_index = acquire_shop_index(shop_id)  # an open till keeps the shop's listeners alive
+    elif shop_listeners.touch(shop_id) or get_shop_search_index(shop_id) is None:
+        # Listeners had lapsed or the shop was evicted: reload and start over
+        search_index = load_shop_single_flight(shop_id)
+        cursor = None
+    else:
+        search_index = True
+
+    feed = change_feed.since(stock_topic(shop_id), cursor)
+    return jsonify({
+        "success": True,
+        "shop_id": shop_id,
+        "version": embedding_cache_full["version"],
+        "cached": search_index is not None,
+        "cursor": feed["cursor"],
+        "reset": feed["reset"],
+        "changes": [event["data"] for event in feed["events"]]
+    }), 200
+
+
+# ======================================================
+# ADMIN UPGRADE REQUESTS FEED (one collection-group listener)
+# ======================================================
+UPGRADE_PAID_STATUSES = ("submitted", "payment_submitted", "pending_verification")
+UPGRADE_GROUPS = ("paid", "requested", "verified")
+UPGRADE_FEED_PAGE_SIZE = 50
+
+upgrade_requests_store = {
+    "by_path": {},     # doc_path -> row
+    "by_status": {},   # status -> set(doc_path)
+    "by_shop": {},     # shop_id -> set(doc_path)
+    "totals": {"total": 0, "requested": 0, "paid": 0, "verified": 0},
+    "version": 0,
+    "last_updated": None
+}
+upgrade_requests_lock = threading.Lock()
+shop_name_lookup = {}  # shop_id -> name, for shops not in the item cache
+
+def get_shop_name(shop_id):
+    """Shop display name from the item cache, falling back to a cached single-doc read"""
+    search_index = get_shop_search_index(shop_id)
+    if search_index:
+        return search_index["shop"].get("shop_name") or "Unknown Shop"
+    if shop_id not in shop_name_lookup:
+        shop_doc = db.collection("Shops").document(shop_id).get()
+        shop_data = shop_doc.to_dict() if shop_doc.exists else {}
+        shop_name_lookup[shop_id] = (shop_data or {}).get("name") or (shop_data or {}).get("shopName") or "Unknown Shop"
+    return shop_name_lookup[shop_id]
+
+def timestamp_to_epoch(value):
+    """Sort key for Firestore timestamps, ISO strings and {seconds: ...} maps"""
+    if not value:
+        return 0
+    if isinstance(value, datetime):
+        return value.timestamp()
+    if isinstance(value, dict) and "seconds" in value:
+        return float(value["seconds"])
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return datetime.fromisoformat(str(value).replace("Z", "+00:00")).timestamp()
+    except ValueError:
+        return 0
+
+def upgrade_request_row(request_doc):
+    """Normalised admin row (same fields the dashboard used to build client-side)"""
+    req = request_doc.to_dict() or {}
+    shop_id = request_doc.reference.parent.parent.id
+    status = req.get("status") or req.get("paymentStatus") or "unknown"
+    return {
+        "id": request_doc.id,
+        "path": request_doc.reference.path,
+        "shopId": shop_id,
+        "shopName": req.get("shopName") or get_shop_name(shop_id),
+        "requestedPlan": req.get("requestedPlan") or req.get("planName") or "N/A",
+        "status": status,
+        "group": "paid" if status in UPGRADE_PAID_STATUSES else "requested",
+        "mpesaReference": req.get("mpesaReference") or "N/A",
+        "requestedAt": req.get("requestedAt") or req.get("timestamp"),
+        "verifiedAt": req.get("verifiedAt"),
+        "paymentSubmittedAt": req.get("paymentSubmittedAt"),
+        "priceKES": req.get("priceKES") or "N/A",
+        "staffLimit": req.get("staffLimit") or "N/A",
+        "updatedAt": int(time.time() * 1000)
+    }
+
+def _upgrade_totals_apply(row, sign):
+    totals = upgrade_requests_store["totals"]
+    totals["total"] += sign
+    totals[row["group"]] += sign
+    if row["verifiedAt"] is not None:
+        totals["verified"] += sign
+
+def _upgrade_store_remove(doc_path):
+    """Caller holds upgrade_requests_lock"""
+    row = upgrade_requests_store["by_path"].pop(doc_path, None)
+    if row is None:
+        return None
+    for index_name, key in (("by_status", row["status"]), ("by_shop", row["shopId"])):
+        paths = upgrade_requests_store[index_name].get(key)
+        if paths:
+            paths.discard(doc_path)
+            if not paths:
+                upgrade_requests_store[index_name].pop(key, None)
+    _upgrade_totals_apply(row, -1)
+    return row
+
+def _upgrade_store_put(row):
+    """Caller holds upgrade_requests_lock"""
+    _upgrade_store_remove(row["path"])
+    upgrade_requests_store["by_path"][row["path"]] = row
+    upgrade_requests_store["by_status"].setdefault(row["status"], set()).add(row["path"])
+    upgrade_requests_store["by_shop"].setdefault(row["shopId"], set()).add(row["path"])
+    _upgrade_totals_apply(row, +1)
+
+def on_upgrade_requests_snapshot(col_snapshot, changes, read_time):
+    """Single listener for every shop's upgradeRequests; first delivery is the full load"""
+    rows = []
+    for change in changes:
+        removed = change.type.name == "REMOVED"
+        rows.append((change.document.reference.path, None if removed else upgrade_request_row(change.document)))
+
+    with upgrade_requests_lock:
+        for doc_path, row in rows:
+            if row is None:
+                _upgrade_store_remove(doc_path)
+            else:
+                _upgrade_store_put(row)
+        upgrade_requests_store["version"] += 1
+        upgrade_requests_store["last_updated"] = time.time()
+        version = upgrade_requests_store["version"]
+
+    print(f"[LISTENER] Upgrade requests: {len(rows)} change(s), version {version}")
+
+def query_upgrade_requests(group=None, status=None, shop_id=None, offset=0, limit=UPGRADE_FEED_PAGE_SIZE):
+    """Filter via the status/shop indexes, newest first, then paginate"""
+    with upgrade_requests_lock:
+        if shop_id:
+            paths = set(upgrade_requests_store["by_shop"].get(shop_id, ()))
+        else:
+            paths = None
+        if status:
+            status_paths = upgrade_requests_store["by_status"].get(status, set())
+            paths = paths & status_paths if paths is not None else set(status_paths)
+        if paths is None:
+            rows = list(upgrade_requests_store["by_path"].values())
+        else:
+            rows = [upgrade_requests_store["by_path"][p] for p in paths]
+
+    if group == "verified":
+        rows = [r for r in rows if r["verifiedAt"] is not None]
+        sort_key = lambda r: timestamp_to_epoch(r["verifiedAt"])
+    elif group == "paid":
+        rows = [r for r in rows if r["group"] == "paid"]
+        sort_key = lambda r: timestamp_to_epoch(r["paymentSubmittedAt"] or r["requestedAt"])
+    else:
+        if group == "requested":
+            rows = [r for r in rows if r["group"] == "requested"]
+        sort_key = lambda r: timestamp_to_epoch(r["requestedAt"])
+
+    rows.sort(key=sort_key, reverse=True)
+    return {"rows": rows[offset:offset + limit], "total": len(rows), "offset": offset, "limit": limit}
+
+def upgrade_feed_snapshot(args):
+    """Totals plus one page per dashboard group (or just the requested group)"""
+    offset = max(0, int(args.get("offset", 0)))
+    limit = max(1, min(500, int(args.get("limit", UPGRADE_FEED_PAGE_SIZE))))
+    group = args.get("group")
+    if group and group not in UPGRADE_GROUPS:
+        raise ValueError(f"group must be one of {', '.join(UPGRADE_GROUPS)}")
+
+    with upgrade_requests_lock:
+        totals = dict(upgrade_requests_store["totals"])
+        version = upgrade_requests_store["version"]
+        last_updated = upgrade_requests_store["last_updated"]
+        shop_count = len(upgrade_requests_store["by_shop"])
+
+    groups = {
+        name: query_upgrade_requests(name, args.get("status"), args.get("shop_id"), offset, limit)
+        for name in ([group] if group else UPGRADE_GROUPS)
+    }
+    return {
+        "success": True,
+        "totals": totals,
+        "groups": groups,
+        "shops": shop_count,
+        "version": version,
+        "last_updated": last_updated
+    }
+
+# Admins: a verified Firebase ID token with the custom claim admin=true, or
+# whose email is listed in ADMIN_EMAILS (comma separated)
+ADMIN_EMAILS = {normalize_email(e) for e in os.environ.get("ADMIN_EMAILS", "").split(",") if e.strip()}
+
+def admin_auth_error():
+    """401/403 response unless the request carries an admin's ID token (None when it does)"""
+    claims = verified_request_claims()
+    if not claims:
+        return jsonify({"success": False, "error": "A valid Firebase ID token is required"}), 401
+    if claims.get("admin") is not True and normalize_email(claims.get("email")) not in ADMIN_EMAILS:
+        return jsonify({"success": False, "error": "Admin access required"}), 403
+    return None
+
+@app.route("/admin/upgrade-requests", methods=["GET"])
+def admin_upgrade_requests():
+    """Pre-aggregated totals and paginated rows: ?group=paid|requested|verified&status=&shop_id=&offset=&limit="""
+    denied = admin_auth_error()
+    if denied:
+        return denied
+    try:
+        return jsonify(upgrade_feed_snapshot(request.args)), 200
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    except Exception as e:
+        print("🔥 upgrade requests feed failed:", e)
+        return jsonify({"success": False, "error": str(e)}), 500
+
+@app.route("/admin/upgrade-requests/changes", methods=["GET"])
+def admin_upgrade_requests_changes():
+    """
+    Poll: ?since=<version from the last snapshot>. Answers immediately with the
+    current version and totals; the dashboard re-fetches pages when changed.
+    """
+    denied = admin_auth_error()
+    if denied:
+        return denied
+    try:
+        since = int(request.args.get("since", -1))
+    except ValueError:
+        return jsonify({"success": False, "error": "since must be an integer version"}), 400
+
+    with upgrade_requests_lock:
+        version = upgrade_requests_store["version"]
+        totals = dict(upgrade_requests_store["totals"])
+    return jsonify({"success": True, "version": version, "changed": version != since, "totals": totals}), 200
+
+
 # ======================================================
 # ADMIN DASHBOARD
 # ======================================================
@@ -1919,15 +4781,24 @@ def startup_init():
     if has_initialized:
         return
 
-    print("[INIT] Preloading FULL cache (with batch tracking)...")
+    # Shops are loaded on first use; only last run's busiest shops are pre-warmed
+    print(f"[INIT] Pre-warming up to {SHOP_CACHE_PREWARM_TOP_N} most active shops...")
     print("[NOTE] Embedding/vectorization features are disabled")
-    refresh_full_item_cache()
+    warmed = prewarm_shop_cache()
+    print(f"[READY] Pre-warmed {len(warmed)} shop(s); others load on demand")
+
+    # Replays receipts/audit logs a previous process logged but never stored
+    if sale_record_writer is not None:
+        sale_record_writer.start()
 
     print("[INIT] Setting up Firestore listeners...")
-    db.collection_group("items").on_snapshot(on_full_item_snapshot)
-    db.collection_group("sellUnits").on_snapshot(on_selling_units_snapshot)
+    # Items/sellUnits are watched per active shop (subscribed when a shop loads,
+    # dropped by the sweeper once idle).
+    shop_listeners.start_sweeper()
+    db.collection_group("staff").on_snapshot(on_staff_snapshot)
+    db.collection_group("upgradeRequests").on_snapshot(on_upgrade_requests_snapshot)
 
-    print("[READY] Listeners active for items and selling units")
+    print("[READY] Listeners active for staff, upgrade requests and items/selling units of active shops")
     print("[READY] App running without embedding/ML dependencies")
 
     has_initialized = True
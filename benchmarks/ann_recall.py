@@ -0,0 +1,82 @@
+"""
+Benchmark: IVF approximate image search vs the exact matrix scan.
+
+Builds a synthetic catalogue shaped like a large supermarket (items with a
+few photos each, products clustered by look), then measures recall@10 and
+per-query latency of ShopVectorIndex for several nprobe values against the
+exact scan of the same index.
+
+    python -m benchmarks.ann_recall [--items 20000 --photos 2 --dim 256 --queries 200]
+"""
+import argparse
+import time
+
+import numpy as np
+
+from vector_index import ShopVectorIndex
+
+
+def make_catalogue(items, photos, dim, groups, spread, rng):
+    """Items drawn around `groups` look-alike centres; each photo is a noisy view of its item"""
+    centres = rng.standard_normal((groups, dim)).astype(np.float32)
+    item_vectors = centres[rng.integers(0, groups, items)] + spread * rng.standard_normal((items, dim)).astype(np.float32)
+    rows = []
+    for i in range(items):
+        for p in range(photos):
+            rows.append((f"item_{i}", str(p), item_vectors[i] + 0.5 * rng.standard_normal(dim).astype(np.float32)))
+    return rows, item_vectors
+
+
+def time_queries(index, queries, **kwargs):
+    results = []
+    start = time.perf_counter()
+    for query in queries:
+        results.append([item_id for item_id, _ in index.search(query, k=10, **kwargs)])
+    return results, (time.perf_counter() - start) / len(queries) * 1000
+
+
+def recall_at_10(approx, exact):
+    return float(np.mean([len(set(a) & set(e)) / max(len(e), 1) for a, e in zip(approx, exact)]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--items", type=int, default=20000)
+    parser.add_argument("--photos", type=int, default=2, help="embeddings per item")
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--groups", type=int, default=20, help="look-alike product groups")
+    parser.add_argument("--spread", type=float, default=2.0, help="item spread around its group centre")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--nlist", type=int, default=None, help="default ~sqrt(vectors)")
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 8, 16, 32])
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    rows, item_vectors = make_catalogue(args.items, args.photos, args.dim, args.groups, args.spread, rng)
+    # Queries: a fresh photo of a random catalogue item
+    picks = rng.integers(0, args.items, args.queries)
+    queries = item_vectors[picks] + 0.5 * rng.standard_normal((args.queries, args.dim)).astype(np.float32)
+
+    start = time.perf_counter()
+    index = ShopVectorIndex.from_rows(rows)
+    load_s = time.perf_counter() - start
+    start = time.perf_counter()
+    index.build_ivf(nlist=args.nlist)
+    train_s = time.perf_counter() - start
+    stats = index.stats()
+
+    print(f"{stats['vectors']:,} vectors x {stats['dim']} dims ({stats['matrix_mb']} MB), "
+          f"{stats['ivf_lists']} lists; load {load_s * 1000:.0f}ms, k-means {train_s * 1000:.0f}ms")
+
+    exact, exact_ms = time_queries(index, queries, exact=True)
+    print(f"{'mode':<14}{'recall@10':>10}{'ms/query':>10}{'speedup':>9}")
+    print(f"{'exact':<14}{1.0:>10.3f}{exact_ms:>10.3f}{1.0:>8.1f}x")
+    for nprobe in args.nprobe:
+        approx, approx_ms = time_queries(index, queries, nprobe=nprobe)
+        print(f"{f'ivf nprobe={nprobe}':<14}{recall_at_10(approx, exact):>10.3f}{approx_ms:>10.3f}"
+              f"{exact_ms / approx_ms:>8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""
+Micro-benchmark: Flask's default JSON provider vs FastJSONProvider.
+
+Builds payloads shaped like the real /sales, /item-optimization and
+/complete-sale responses and times serialisation of each.
+
+    python -m benchmarks.json_serialization [--shops 5 --items 200 --repeat 5]
+"""
+import argparse
+import random
+import time
+
+import numpy as np
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider
+
+from json_provider import FastJSONProvider, orjson
+
+
+def make_batch(i):
+    return {
+        "batch_id": f"batch_{i}",
+        "batch_name": f"Batch {i}",
+        "quantity": random.uniform(0, 50),
+        "remaining_quantity": random.uniform(0, 50),
+        "unit": "unit",
+        "buy_price": random.uniform(10, 100),
+        "sell_price": random.uniform(10, 150),
+        "timestamp": 1700000000000 + i,
+        "date": "2024-01-01",
+        "added_by": "owner",
+        "selling_unit_allocations": {}
+    }
+
+
+def make_item(i, embedding_dim, embeddings_per_item):
+    return {
+        "item_id": f"item_{i}",
+        "name": f"Product {i} 500ml",
+        "thumbnail": f"https://cdn.example.com/{i}.jpg",
+        "sell_price": 60.0,
+        "buy_price": 50.0,
+        "stock": 12.0,
+        "base_unit": "unit",
+        "codes": [f"616110{i:07d}"],
+        "embeddings": [np.random.rand(embedding_dim) for _ in range(embeddings_per_item)],
+        "has_embeddings": embeddings_per_item > 0,
+        "selling_units": [{
+            "sell_unit_id": f"su_{i}_{j}",
+            "codes": [],
+            "name": f"Unit {j}",
+            "conversion_factor": 2.0,
+            "sell_price": 30.0,
+            "images": [],
+            "is_base_unit": False,
+            "thumbnail": None,
+            "batch_links": [{"batchId": "batch_0", "maxUnitsAvailable": 8, "allocatedUnits": 1, "pricePerUnit": 30}],
+            "total_units_available": 7,
+            "has_batch_links": True
+        } for j in range(2)],
+        "category_id": "cat",
+        "category_name": "Category",
+        "batches": [make_batch(b) for b in range(3)],
+        "has_batches": True,
+        "total_stock_from_batches": 30
+    }
+
+
+def make_sales_payload(rows):
+    items = []
+    for i in range(rows):
+        items.append({
+            "type": "main_item", "item_id": f"item_{i}", "main_item_id": f"item_{i}",
+            "category_id": "cat", "category_name": "Category", "name": f"Product {i}",
+            "display_name": f"Product {i}", "thumbnail": None, "batch_status": "active_healthy",
+            "batch_id": "batch_0", "batch_name": "Batch 0", "batch_remaining": 12.0,
+            "real_available": 12.0, "price": 60.0, "base_unit": "unit",
+            "batch_switch_required": False, "can_fulfill": True, "is_current_batch": False,
+            "next_batch_available": True, "next_batch_id": "batch_1", "next_batch_name": "Batch 1",
+            "next_batch_price": 65.0,
+            "notifications": [{"type": "low_stock_warning", "message": "Only 2.0 left", "severity": "warning"}],
+            "unit_type": "base", "search_score": np.float64(85.0), "parent_item_name": f"Product {i}",
+            "debug": {"match_type": "main_item_direct", "matched_text": f"Product {i}",
+                      "score_calculation": ["Word starts with: ..."], "query_used": "product",
+                      "batch_availability": 12.0}
+        })
+    return {"items": items, "meta": {"shop_id": "shop", "results": rows, "processing_time_ms": 1.2},
+            "debug": {"search_debug_info": [{"item_name": r["name"], "score": 85} for r in items]}}
+
+
+def make_item_optimization_payload(shops, items, embedding_dim, embeddings_per_item):
+    return {
+        "status": "success",
+        "shops": [{
+            "shop_id": f"shop_{s}", "shop_name": f"Shop {s}",
+            "categories": [{"category_id": "cat", "category_name": "Category",
+                            "items": [make_item(i, embedding_dim, embeddings_per_item) for i in range(items)]}]
+        } for s in range(shops)],
+        "total_shops": shops,
+        "last_updated": time.time()
+    }
+
+
+def make_complete_sale_payload(lines):
+    return {
+        "success": True, "message": "Sale completed successfully", "sale_id": "sale_1",
+        "receipt_id": "receipt_1", "timestamp": "2024-01-01T10:00:00",
+        "summary": {"total_amount": 1234.5, "total_base_units": 12.0, "items_count": lines},
+        "items": [{"item_id": f"item_{i}", "quantity": 1.5, "price": 60.0,
+                   "unit_info": {"is_selling_unit": False, "base_units_quantity": 1.5}} for i in range(lines)]
+    }
+
+
+def listify(obj):
+    """Stdlib baseline can't encode numpy, so give it plain lists (not timed)"""
+    if isinstance(obj, dict):
+        return {k: listify(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [listify(v) for v in obj]
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    return obj
+
+
+def best_of(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--shops", type=int, default=5)
+    parser.add_argument("--items", type=int, default=200, help="items per shop")
+    parser.add_argument("--embedding-dim", type=int, default=1280)
+    parser.add_argument("--embeddings-per-item", type=int, default=1)
+    parser.add_argument("--sales-rows", type=int, default=40)
+    parser.add_argument("--sale-lines", type=int, default=15)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    app = Flask("bench")
+    default_provider = DefaultJSONProvider(app)
+    fast_provider = FastJSONProvider(app)
+    fast_provider.sort_keys = False  # as configured in app.py
+
+    payloads = {
+        "/sales": make_sales_payload(args.sales_rows),
+        "/item-optimization": make_item_optimization_payload(
+            args.shops, args.items, args.embedding_dim, args.embeddings_per_item),
+        "/complete-sale": make_complete_sale_payload(args.sale_lines),
+    }
+
+    print(f"orjson available: {orjson is not None}")
+    print(f"{'endpoint':<22}{'size':>12}{'default ms':>14}{'fast ms':>12}{'saved ms':>12}{'speedup':>10}")
+    for endpoint, payload in payloads.items():
+        baseline_payload = listify(payload)
+        size = len(fast_provider.dumps_bytes(payload))
+        default_s = best_of(lambda: default_provider.dumps(baseline_payload), args.repeat)
+        fast_s = best_of(lambda: fast_provider.dumps_bytes(payload), args.repeat)
+        print(f"{endpoint:<22}{size:>12,}{default_s * 1000:>14.2f}{fast_s * 1000:>12.2f}"
+              f"{(default_s - fast_s) * 1000:>12.2f}{default_s / fast_s:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
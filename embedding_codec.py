@@ -0,0 +1,59 @@
+"""
+Compact storage format for item image embeddings.
+
+Embeddings used to be stored as a Firestore array of doubles ("vector").
+They are now packed into one bytes field:
+
+    {"vector_bytes": <bytes>, "encoding": "float16" | "int8", "dim": 1280, "scale": 0.0123}
+
+float16 halves a float32 vector (quarter of the Firestore doubles); int8
+stores one byte per dimension plus a per-vector scale (max |x| / 127).
+Decoding views the bytes with np.frombuffer (no per-element work) and
+legacy "vector" lists are still understood.
+"""
+import numpy as np
+
+ENCODINGS = ("float16", "int8")
+
+
+def encode_embedding(vector, encoding="float16"):
+    """Vector → Firestore fields for the chosen encoding ("list" keeps the legacy array)"""
+    vector = np.asarray(vector, dtype=np.float32).ravel()
+    if encoding == "list":
+        return {"vector": vector.tolist()}
+    if encoding == "float16":
+        packed, scale = vector.astype("<f2"), 1.0
+    elif encoding == "int8":
+        peak = float(np.max(np.abs(vector))) if vector.size else 0.0
+        scale = peak / 127 if peak > 0 else 1.0
+        packed = np.clip(np.rint(vector / scale), -127, 127).astype(np.int8)
+    else:
+        raise ValueError(f"Unknown embedding encoding: {encoding}")
+    return {"vector_bytes": packed.tobytes(), "encoding": encoding, "dim": int(vector.size), "scale": scale}
+
+
+def decode_embedding(data):
+    """
+    Firestore embedding doc → compact 1-D numpy vector (None if it holds none).
+    float16 bytes come back as a zero-copy float16 view; int8 is dequantised
+    to float16; legacy lists become float32.
+    """
+    raw = data.get("vector_bytes")
+    if raw is not None:
+        encoding = data.get("encoding", "float16")
+        if encoding == "float16":
+            vector = np.frombuffer(raw, dtype="<f2")
+        elif encoding == "int8":
+            vector = np.multiply(np.frombuffer(raw, dtype=np.int8), np.float16(data.get("scale", 1.0)),
+                                 dtype=np.float16)
+        else:
+            raise ValueError(f"Unknown embedding encoding: {encoding}")
+        dim = data.get("dim")
+        if dim is not None and vector.size != dim:
+            raise ValueError(f"Embedding has {vector.size} values, expected {dim}")
+        return vector
+
+    legacy = data.get("vector")
+    if legacy:
+        return np.asarray(legacy, dtype=np.float32)
+    return None
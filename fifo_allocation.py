@@ -0,0 +1,290 @@
+"""
+FIFO batch allocation.
+
+allocate_main_item_fifo / allocate_selling_unit_fifo allocate one request by
+walking the batches in Python. allocate_fifo_many does the same for a whole
+sequence of requests of one item (a cart's lines, a till's queued sales,
+simulated demand) in one NumPy pass: with the FIFO-ordered batch stock laid
+out on a cumulative axis, each sale takes the interval of that axis between
+the cumulative demand before and after it, so every (sale, batch) take falls
+out of one searchsorted over the merged breakpoints. It also prices each
+take at the batch's exact sell and buy price, rounded once per take:
+revenue, COGS and margin.
+
+All quantities are integer micro-units and all money integer minor units
+(see fixed_point), so the vectorised path and the loops agree exactly.
+"""
+import numpy as np
+
+from fixed_point import (QTY_SCALE, MONEY_SCALE, to_micro, from_micro, from_minor, ratio, div_ratio,
+                         line_total_minor, to_micro_array)
+
+
+def allocate_main_item_fifo(batches, requested_quantity):
+    """
+    Allocate quantity from batches using FIFO for main items
+    Returns: {
+        "success": True/False,
+        "allocation": [{"batch_id": "...", "quantity": x, "price": y}, ...],
+        "total_price": z
+    }
+    """
+    if not batches:
+        return {"success": False, "error": "No batches available"}
+    
+    # Sort batches by timestamp (oldest first)
+    sorted_batches = sorted(batches, key=lambda x: x.get("timestamp", 0))
+    
+    # Integer micro-units / minor units: exact sums, no drift
+    requested = to_micro(requested_quantity)
+    remaining = requested
+    allocation = []
+    total_minor = 0
+    
+    for batch in sorted_batches:
+        if remaining <= 0:
+            break
+        
+        available = to_micro(batch.get("remaining_quantity", 0))
+        if available > 0:
+            take = min(available, remaining)
+            batch_price = batch.get("sell_price", 0)
+            
+            allocation.append({
+                "batch_id": batch["batch_id"],
+                "batch_name": batch.get("batch_name", "Batch"),
+                "quantity": from_micro(take),
+                "quantity_micro": take,
+                "price": batch_price,
+                "unit": batch.get("unit", "unit"),
+                "batch_info": batch
+            })
+            
+            total_minor += line_total_minor(take, batch_price)
+            remaining -= take
+    
+    if remaining > 0:
+        return {"success": False, "error": f"Insufficient stock. Only {from_micro(requested - remaining)} available"}
+    
+    return {"success": True, "allocation": allocation, "total_price": from_minor(total_minor)}
+
+def allocate_selling_unit_fifo(batch_links, requested_units, conversion_factor):
+    """
+    Allocate selling units from batch links using FIFO
+    Returns allocation in MAIN units for stock deduction
+    """
+    if not batch_links:
+        return {"success": False, "error": "No batch links available"}
+    
+    # Sort batch links (FIFO - we need to get batch timestamps from cache)
+    # For now, use the order they appear (should be FIFO if created properly)
+    sorted_links = sorted(batch_links, key=lambda x: x.get("batchTimestamp", 0))
+    
+    factor = ratio(conversion_factor)  # exact decimal, never snapped
+    requested = to_micro(requested_units)
+    remaining_units = requested
+    allocation = []
+    total_minor = 0
+    
+    for link in sorted_links:
+        if remaining_units <= 0:
+            break
+        
+        available_units = to_micro(link.get("maxUnitsAvailable", 0)) - to_micro(link.get("allocatedUnits", 0))
+        if available_units > 0:
+            take_units = min(available_units, remaining_units)
+            price_per_unit = link.get("pricePerUnit", 0)
+            
+            # Convert to main units for stock deduction
+            take_main_units = div_ratio(take_units, factor)
+            batch_minor = line_total_minor(take_units, price_per_unit)
+            
+            allocation.append({
+                "batch_id": link.get("batchId"),
+                "units_taken": from_micro(take_units),
+                "main_units_taken": from_micro(take_main_units),
+                "main_units_taken_micro": take_main_units,
+                "price_per_unit": price_per_unit,
+                "total_for_batch": from_minor(batch_minor)
+            })
+            
+            total_minor += batch_minor
+            remaining_units -= take_units
+    
+    if remaining_units > 0:
+        return {"success": False, "error": f"Insufficient units. Only {from_micro(requested - remaining_units)} available"}
+    
+    return {"success": True, "allocation": allocation, "total_price": from_minor(total_minor)}
+
+
+# ---------- vectorised engine ----------
+def _line_totals(takes, rows, prices):
+    """line_total_minor of each take (micro) at prices[row]: exact price, rounded once per line"""
+    return [line_total_minor(take, prices[row]) for take, row in zip(takes, rows)]
+
+
+def fifo_accept(available, requests):
+    """
+    Which requests (int64 micro, in order) succeed against total stock when
+    processed one after another: a request that does not fit is rejected and
+    takes nothing, so a later, smaller one may still fit.
+    """
+    accepted = requests > 0
+    total = int(available.sum())
+    demand = np.cumsum(np.where(accepted, requests, 0))
+    if demand.size and demand[-1] > total:
+        first = int(np.argmax(demand > total))
+        left = total - (int(demand[first - 1]) if first else 0)
+        accepted[first] = False
+        # Past the first rejection stock is nearly gone: a scalar pass is enough
+        for j in range(first + 1, len(requests)):
+            if accepted[j]:
+                if requests[j] <= left:
+                    left -= int(requests[j])
+                else:
+                    accepted[j] = False
+    return accepted
+
+
+def fifo_segments(available, requests):
+    """
+    Allocate requests (int64 micro, in order) over batches (int64 micro, FIFO order).
+    Returns (accepted[m], sale_index[k], batch_index[k], take[k]): one row per
+    (sale, batch) pair with a positive take.
+    """
+    available = np.maximum(np.asarray(available, dtype=np.int64), 0)
+    requests = np.asarray(requests, dtype=np.int64)
+    accepted = fifo_accept(available, requests)
+
+    demand_end = np.cumsum(np.where(accepted, requests, 0))
+    stock_end = np.cumsum(available)
+    if not demand_end.size or demand_end[-1] == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return accepted, empty, empty, empty
+
+    points = np.union1d(np.union1d(demand_end, stock_end[stock_end < demand_end[-1]]), [0])
+    starts, ends = points[:-1], points[1:]
+    sale_index = np.searchsorted(demand_end, starts, side="right")
+    batch_index = np.searchsorted(stock_end, starts, side="right")
+    return accepted, sale_index, batch_index, ends - starts
+
+
+def allocate_fifo_many(batches, quantities):
+    """
+    FIFO-allocate several requests for ONE item in one pass, in order, as if
+    they were sold one after another. batches: cached batch dicts
+    (remaining_quantity or quantity, sell_price, buy_price, timestamp);
+    quantities: base units per request. Returns one result per request:
+
+        {"success": True, "allocation": [{"batch_id", "quantity", "quantity_micro",
+          "price", "buy_price", "revenue", "cogs"}, ...],
+         "total_price", "cogs", "margin", "margin_pct"}
+
+    or {"success": False, "error": ...} for requests that do not fit.
+    """
+    timestamps = np.array([b.get("timestamp", 0) or 0 for b in batches], dtype=np.float64)
+    order = np.argsort(timestamps, kind="stable")
+    available = to_micro_array([b.get("remaining_quantity", b.get("quantity", 0)) or 0 for b in batches])[order]
+    sell_prices = [ratio(b.get("sell_price", 0) or 0) for b in batches]
+    buy_prices = [ratio(b.get("buy_price", 0) or 0) for b in batches]
+    requests = to_micro_array(quantities).reshape(-1)
+
+    accepted, sale_index, batch_index, take = fifo_segments(available, requests)
+
+    # Plain Python values from here on: building dicts from NumPy scalars is slow
+    source = order[batch_index].tolist()
+    take_list = take.tolist()
+    revenue_list = _line_totals(take_list, source, sell_prices)
+    cogs_list = _line_totals(take_list, source, buy_prices)
+    bounds = np.searchsorted(sale_index, np.arange(len(requests) + 1)).tolist()  # rows of each sale
+
+    results = []
+    remaining_total = int(available.sum())
+    for j, requested in enumerate(requests.tolist()):
+        if not accepted[j]:
+            if requested <= 0:
+                error = f"Invalid quantity: {from_micro(requested)}"
+            else:
+                error = f"Insufficient stock. Only {from_micro(remaining_total)} available"
+            results.append({"success": False, "error": error})
+            continue
+        remaining_total -= requested
+        total_minor = sum(revenue_list[bounds[j]:bounds[j + 1]])
+        cogs_minor = sum(cogs_list[bounds[j]:bounds[j + 1]])
+        allocation = []
+        for r in range(bounds[j], bounds[j + 1]):
+            batch = batches[source[r]]
+            allocation.append({
+                "batch_id": batch["batch_id"],
+                "batch_name": batch.get("batch_name", "Batch"),
+                "quantity": take_list[r] / QTY_SCALE,
+                "quantity_micro": take_list[r],
+                "price": batch.get("sell_price", 0),
+                "buy_price": batch.get("buy_price", 0),
+                "revenue": revenue_list[r] / MONEY_SCALE,
+                "cogs": cogs_list[r] / MONEY_SCALE
+            })
+        results.append({
+            "success": True,
+            "allocation": allocation,
+            "total_price": from_minor(total_minor),
+            "cogs": from_minor(cogs_minor),
+            "margin": from_minor(total_minor - cogs_minor),
+            "margin_pct": round((total_minor - cogs_minor) / total_minor * 100, 2) if total_minor else None
+        })
+    return results
+
+
+def allocate_selling_units_many(batch_links, requested_units, conversion_factor, buy_prices=None):
+    """
+    allocate_selling_unit_fifo for several requests at once (selling units,
+    in order). buy_prices: batch_id -> buy price per main unit, for COGS.
+    Results as allocate_selling_unit_fifo plus "cogs"/"margin" per request.
+    """
+    factor = ratio(conversion_factor)
+    links = sorted(batch_links, key=lambda x: x.get("batchTimestamp", 0))
+    available = np.array([to_micro(l.get("maxUnitsAvailable", 0)) - to_micro(l.get("allocatedUnits", 0))
+                          for l in links], dtype=np.int64)
+    unit_prices = [ratio(l.get("pricePerUnit", 0) or 0) for l in links]
+    link_buy_prices = [ratio((buy_prices or {}).get(l.get("batchId"), 0) or 0) for l in links]
+    requests = np.array([to_micro(q) for q in requested_units], dtype=np.int64)
+
+    accepted, sale_index, link_index, take = fifo_segments(available, requests)
+    rows = link_index.tolist()
+    revenue = _line_totals(take.tolist(), rows, unit_prices)
+    if take.size and int(take.max()) * factor.denominator < 2 ** 61:
+        main_taken = (2 * take * factor.denominator + factor.numerator) // (2 * factor.numerator)  # half-up
+    else:
+        main_taken = np.array([div_ratio(int(t), factor) for t in take], dtype=np.int64)
+    cogs = _line_totals(main_taken.tolist(), rows, link_buy_prices)
+
+    results = []
+    remaining_total = int(np.maximum(available, 0).sum())
+    bounds = np.searchsorted(sale_index, np.arange(len(requests) + 1))
+    for j in range(len(requests)):
+        if not accepted[j]:
+            results.append({"success": False,
+                            "error": f"Insufficient units. Only {from_micro(remaining_total)} available"})
+            continue
+        remaining_total -= int(requests[j])
+        lo, hi = bounds[j], bounds[j + 1]
+        total_minor, cogs_minor = sum(revenue[lo:hi]), sum(cogs[lo:hi])
+        results.append({
+            "success": True,
+            "allocation": [
+                {
+                    "batch_id": links[link_index[r]].get("batchId"),
+                    "units_taken": from_micro(int(take[r])),
+                    "main_units_taken": from_micro(int(main_taken[r])),
+                    "main_units_taken_micro": int(main_taken[r]),
+                    "price_per_unit": links[link_index[r]].get("pricePerUnit", 0),
+                    "total_for_batch": from_minor(revenue[r]),
+                    "cogs": from_minor(cogs[r])
+                }
+                for r in range(lo, hi)
+            ],
+            "total_price": from_minor(total_minor),
+            "cogs": from_minor(cogs_minor),
+            "margin": from_minor(total_minor - cogs_minor)
+        })
+    return results
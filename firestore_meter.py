@@ -0,0 +1,415 @@
+"""
+Firestore read/write cost meter.
+
+Firestore bills per document read, written or deleted, and per document a
+listener delivers. MeteredClient wraps the client, and every reference,
+query, batch, transaction and snapshot it hands out, and charges each of
+those operations to the current cost scope:
+
+    db = MeteredClient(firestore.client(), metrics_registry)
+
+    with db.meter.scope("refresh_full_item_cache") as cost:
+        ...
+    cost.totals()  # {"read": 1204, "write": 0, "delete": 0, "listen": 0, "read_bytes": ..., ...}
+
+Scopes nest (a shop reload inside a request counts for both) and live in a
+ContextVar, so concurrent requests never mix. Every charge also goes to the
+metrics registry per source (innermost scope name, "background" outside any
+scope) and per shop (taken from the document path Shops/{shop_id}/...). Only
+the SHOP_LABEL_LIMIT costliest shops get their own shop label at scrape time;
+the rest are summed under shop="other", so the series count stays bounded.
+Byte counts are estimates using Firestore's storage size rules.
+"""
+import functools
+import heapq
+import threading
+from contextvars import ContextVar
+
+KINDS = ("read", "write", "delete", "listen")
+DOCUMENT_COUNT_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 50000)
+SHOP_LABEL_LIMIT = 20
+
+
+def value_size(value):
+    """Storage size of a field value (strings: length + 1, numbers 8, maps/arrays: sum of parts)"""
+    if value is None or isinstance(value, bool):
+        return 1
+    if isinstance(value, (int, float)):
+        return 8
+    if isinstance(value, str):
+        return len(value) + 1
+    if isinstance(value, bytes):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(len(key) + 1 + value_size(item) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return sum(value_size(item) for item in value)
+    return 8  # timestamps, references, sentinels (Increment, SERVER_TIMESTAMP)
+
+
+def document_size(path, data):
+    """Estimated stored size of one document: name + 32 bytes overhead + fields"""
+    return len(path or "") + 1 + 32 + value_size(data)
+
+
+def shop_of(path):
+    """Shops/{shop_id}/... → shop_id (None for other paths)"""
+    if path and path.startswith("Shops/"):
+        return path.split("/", 2)[1]
+    return None
+
+
+class CostScope:
+    """Document counts and bytes charged while the scope was open"""
+    __slots__ = ("name", "parent", "counts", "token")
+
+    def __init__(self, name, parent):
+        self.name = name
+        self.parent = parent
+        self.counts = dict.fromkeys(KINDS, 0)
+        for kind in ("read", "write", "listen"):
+            self.counts[f"{kind}_bytes"] = 0
+        self.token = None
+
+    def totals(self):
+        return dict(self.counts)
+
+
+class _ScopeContext:
+    __slots__ = ("meter", "name", "cost")
+
+    def __init__(self, meter, name):
+        self.meter = meter
+        self.name = name
+
+    def __enter__(self):
+        self.cost = self.meter.open(self.name)
+        return self.cost
+
+    def __exit__(self, exc_type, exc, tb):
+        self.meter.close(self.cost)
+        return False
+
+
+class FirestoreMeter:
+    def __init__(self, registry, measure_bytes=True, shop_label_limit=SHOP_LABEL_LIMIT):
+        self.measure_bytes = measure_bytes
+        self.shop_label_limit = shop_label_limit
+        self._current = ContextVar("firestore_cost_scope", default=None)
+        self.documents = registry.counter(
+            "firestore_documents_total", "Documents read, written, deleted or delivered to listeners",
+            ("source", "kind"))
+        self.bytes = registry.counter(
+            "firestore_document_bytes_total", "Estimated bytes of documents read, written or delivered",
+            ("source", "kind"))
+        self._shop_lock = threading.Lock()
+        self._shop_counts = {}  # shop_id -> {kind: documents}
+        registry.collector(self.shop_samples)
+        self.per_scope = registry.histogram(
+            "firestore_documents_per_scope", "Documents per request / refresh / listener delivery",
+            ("scope", "kind"), buckets=DOCUMENT_COUNT_BUCKETS)
+
+    # ---------- scopes ----------
+    def open(self, name):
+        """Start charging to a new scope (nested in the current one); pair with close()"""
+        cost = CostScope(name, self._current.get())
+        cost.token = self._current.set(cost)
+        return cost
+
+    def close(self, cost):
+        self._current.reset(cost.token)
+        for kind in KINDS:
+            self.per_scope.observe(cost.counts[kind], cost.name, kind)
+
+    def current(self):
+        return self._current.get()
+
+    def scope(self, name):
+        """Context manager: with meter.scope("refresh") as cost: ..."""
+        return _ScopeContext(self, name)
+
+    def scoped(self, name):
+        """Decorator form of scope()"""
+        def decorate(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.scope(name):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorate
+
+    # ---------- charging ----------
+    def charge(self, kind, docs):
+        """Charge documents [(path, data), ...] of one kind to the current scope chain"""
+        if not docs:
+            return
+        count = len(docs)
+        size = 0
+        if self.measure_bytes and kind != "delete":
+            size = sum(document_size(path, data) for path, data in docs if data is not None)
+
+        cost = self._current.get()
+        source = cost.name if cost is not None else "background"
+        while cost is not None:
+            cost.counts[kind] += count
+            if size:
+                cost.counts[f"{kind}_bytes"] += size
+            cost = cost.parent
+
+        self.documents.inc(source, kind, amount=count)
+        if size:
+            self.bytes.inc(source, kind, amount=size)
+        shops = {}
+        for path, _ in docs:
+            shop = shop_of(path)
+            if shop is not None:
+                shops[shop] = shops.get(shop, 0) + 1
+        if shops:
+            with self._shop_lock:
+                for shop, shop_count in shops.items():
+                    counts = self._shop_counts.get(shop)
+                    if counts is None:
+                        counts = self._shop_counts[shop] = dict.fromkeys(KINDS, 0)
+                    counts[kind] += shop_count
+
+    def shop_samples(self):
+        """Collector: per-shop document counts, top shop_label_limit shops by total plus shop="other" """
+        with self._shop_lock:
+            shops = [(shop, dict(counts)) for shop, counts in self._shop_counts.items()]
+        top = heapq.nlargest(self.shop_label_limit, shops, key=lambda item: sum(item[1].values()))
+        kept = {shop for shop, _ in top}
+        other = dict.fromkeys(KINDS, 0)
+        for shop, counts in shops:
+            if shop not in kept:
+                for kind, count in counts.items():
+                    other[kind] += count
+        rows = top + ([("other", other)] if len(shops) > len(top) else [])
+        yield ("firestore_shop_documents_total", "counter",
+               "Documents read, written, deleted or delivered, per shop (costliest shops, the rest as other)",
+               [({"shop": shop, "kind": kind}, counts[kind]) for shop, counts in rows for kind in KINDS
+                if counts[kind]])
+
+    def charge_reads(self, result):
+        """Charge what a get()/stream()/get_all() returned; returns it with snapshots wrapped"""
+        if _is_snapshot(result):
+            self.charge("read", [_snapshot_doc(result)])
+            return _Snapshot(result, self)
+        if isinstance(result, list):
+            # An empty query result is still billed one read
+            self.charge("read", [_snapshot_doc(snap) for snap in result] or [(None, None)])
+            return [_Snapshot(snap, self) for snap in result]
+        return self._counting(result)
+
+    def _counting(self, snapshots):
+        delivered = 0
+        for snap in snapshots:
+            delivered += 1
+            self.charge("read", [_snapshot_doc(snap)])
+            yield _Snapshot(snap, self)
+        if not delivered:
+            self.charge("read", [(None, None)])
+
+    def listener(self, callback):
+        """Wrap an on_snapshot callback: added/modified documents are charged to listener:<name>"""
+        name = f"listener:{getattr(callback, '__name__', 'callback')}"
+
+        @functools.wraps(callback)
+        def deliver(docs, changes, read_time):
+            with self.scope(name):
+                self.charge("listen", [_snapshot_doc(change.document) for change in changes
+                                       if getattr(getattr(change, "type", None), "name", None) != "REMOVED"])
+                return callback(docs, changes, read_time)
+        return deliver
+
+    def wrap(self, value):
+        """References, collections and queries come back metered; anything else as is"""
+        if type(value) not in _PROXY_TYPES and hasattr(value, "on_snapshot"):
+            return _Ref(value, self)
+        return value
+
+
+def _is_snapshot(value):
+    return hasattr(value, "exists") and hasattr(value, "to_dict")
+
+
+def _snapshot_doc(snap):
+    data = None
+    if snap.exists:
+        data = getattr(snap, "_data", None)  # to_dict() deep-copies; only the size is needed
+        if data is None:
+            data = snap.to_dict()
+    reference = getattr(snap, "reference", None)
+    return getattr(reference, "path", None), data
+
+
+def _unwrap(value):
+    if type(value) in _PROXY_TYPES:
+        return value._target
+    if isinstance(value, (list, tuple)) and any(type(item) in _PROXY_TYPES for item in value):
+        return [_unwrap(item) for item in value]
+    return value
+
+
+class _Proxy:
+    """
+    Forwards everything to the wrapped client object, unwrapping proxy
+    arguments and metering returned references. __class__ reports the
+    wrapped type so isinstance() checks inside the client library still pass.
+    """
+    __slots__ = ("_target", "_meter")
+
+    def __init__(self, target, meter):
+        self._target = target
+        self._meter = meter
+
+    @property
+    def __class__(self):
+        return type(self._target)
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if not callable(attr):
+            return self._meter.wrap(attr)
+
+        def call(*args, **kwargs):
+            return self._meter.wrap(attr(*[_unwrap(a) for a in args], **{k: _unwrap(v) for k, v in kwargs.items()}))
+        return call
+
+    def __eq__(self, other):
+        return self._target == _unwrap(other)
+
+    def __hash__(self):
+        return hash(self._target)
+
+    def __repr__(self):
+        return f"<metered {self._target!r}>"
+
+
+class _Ref(_Proxy):
+    """Document/collection reference or query"""
+    __slots__ = ()
+
+    def get(self, *args, **kwargs):
+        kwargs = {k: _unwrap(v) for k, v in kwargs.items()}  # transaction=
+        return self._meter.charge_reads(self._target.get(*args, **kwargs))
+
+    def stream(self, *args, **kwargs):
+        kwargs = {k: _unwrap(v) for k, v in kwargs.items()}
+        return self._meter.charge_reads(self._target.stream(*args, **kwargs))
+
+    def _write(self, kind, method, data, *args, **kwargs):
+        result = getattr(self._target, method)(data, *args, **kwargs)
+        self._meter.charge(kind, [(self._target.path, data)])
+        return result
+
+    def set(self, document_data, *args, **kwargs):
+        return self._write("write", "set", document_data, *args, **kwargs)
+
+    def create(self, document_data, *args, **kwargs):
+        return self._write("write", "create", document_data, *args, **kwargs)
+
+    def update(self, field_updates, *args, **kwargs):
+        return self._write("write", "update", field_updates, *args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        result = self._target.delete(*args, **kwargs)
+        self._meter.charge("delete", [(self._target.path, None)])
+        return result
+
+    def add(self, document_data, *args, **kwargs):
+        update_time, ref = self._target.add(document_data, *args, **kwargs)
+        self._meter.charge("write", [(ref.path, document_data)])
+        return update_time, _Ref(ref, self._meter)
+
+    def on_snapshot(self, callback):
+        return self._target.on_snapshot(self._meter.listener(callback))
+
+
+class _Snapshot(_Proxy):
+    __slots__ = ()
+
+    def __getattr__(self, name):
+        return getattr(self._target, name)
+
+    @property
+    def reference(self):
+        return _Ref(self._target.reference, self._meter)
+
+
+class _Batch(_Proxy):
+    """Write batch: staged writes are charged once commit() succeeds"""
+    __slots__ = ("_staged",)
+
+    def __init__(self, target, meter):
+        super().__init__(target, meter)
+        self._staged = []
+
+    def _stage(self, kind, method, reference, *args, **kwargs):
+        result = getattr(self._target, method)(_unwrap(reference), *args, **kwargs)
+        self._staged.append((kind, reference.path, args[0] if args else kwargs.get("document_data")))
+        return result
+
+    def set(self, reference, *args, **kwargs):
+        return self._stage("write", "set", reference, *args, **kwargs)
+
+    def create(self, reference, *args, **kwargs):
+        return self._stage("write", "create", reference, *args, **kwargs)
+
+    def update(self, reference, *args, **kwargs):
+        return self._stage("write", "update", reference, *args, **kwargs)
+
+    def delete(self, reference, *args, **kwargs):
+        return self._stage("delete", "delete", reference, *args, **kwargs)
+
+    def commit(self, *args, **kwargs):
+        result = self._target.commit(*args, **kwargs)
+        staged, self._staged = self._staged, []
+        for kind in ("write", "delete"):
+            self._meter.charge(kind, [(path, data if kind == "write" else None)
+                                      for staged_kind, path, data in staged if staged_kind == kind])
+        return result
+
+
+class _Transaction(_Batch):
+    """
+    Transaction: reads are charged as they are made, writes when staged
+    (commit runs inside the client library's retry loop). Retried attempts
+    are charged again, as Firestore bills them.
+    """
+    __slots__ = ()
+
+    def get(self, ref_or_query, *args, **kwargs):
+        return self._meter.charge_reads(self._target.get(_unwrap(ref_or_query), *args, **kwargs))
+
+    def get_all(self, references, *args, **kwargs):
+        return self._meter.charge_reads(self._target.get_all(_unwrap(list(references)), *args, **kwargs))
+
+    def _stage(self, kind, method, reference, *args, **kwargs):
+        result = getattr(self._target, method)(_unwrap(reference), *args, **kwargs)
+        self._meter.charge(kind, [(reference.path, (args[0] if args else kwargs.get("document_data"))
+                                   if kind == "write" else None)])
+        return result
+
+
+class MeteredClient(_Proxy):
+    """Firestore client whose document reads/writes/deletes/listener deliveries are metered"""
+    __slots__ = ()
+
+    def __init__(self, client, registry, measure_bytes=True):
+        super().__init__(client, FirestoreMeter(registry, measure_bytes))
+
+    @property
+    def meter(self):
+        return self._meter
+
+    def get_all(self, references, *args, **kwargs):
+        return self._meter.charge_reads(self._target.get_all(_unwrap(list(references)), *args, **kwargs))
+
+    def batch(self, *args, **kwargs):
+        return _Batch(self._target.batch(*args, **kwargs), self._meter)
+
+    def transaction(self, *args, **kwargs):
+        return _Transaction(self._target.transaction(*args, **kwargs), self._meter)
+
+
+_PROXY_TYPES = (_Ref, _Snapshot, _Batch, _Transaction, MeteredClient)
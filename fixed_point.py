@@ -0,0 +1,103 @@
+"""
+Fixed-point quantities and money.
+
+Stock quantities are integer micro-units (1 base unit = 1,000,000) and money
+is integer minor units (cents), so FIFO allocation, availability and sale
+deductions add and compare integers instead of floats patched with
+round(x, 6) and tolerances. Conversion factors and prices are exact
+Fractions of the decimal they are written as (0.25 → 1/4, 0.333333 →
+333333/1000000); nothing is snapped to a "nearby" fraction.
+
+Firestore keeps storing plain numbers; convert at the edges with to_micro()
+/ from_micro() and to_minor() / from_minor(). Values are assumed to carry at
+most 6 decimals, which float64 represents exactly enough up to ~9e9 units.
+"""
+from fractions import Fraction
+from functools import lru_cache
+
+import numpy as np
+
+QTY_SCALE = 1_000_000   # micro-units per base unit
+MONEY_SCALE = 100       # minor units (cents) per currency unit
+
+
+def to_micro(value):
+    """Quantity (number or numeric string) → int micro-units"""
+    if isinstance(value, int):
+        return value * QTY_SCALE
+    return int(round(float(value or 0) * QTY_SCALE))
+
+
+def from_micro(micro):
+    """int micro-units → float quantity (the nearest float to an exact 6-decimal value)"""
+    return micro / QTY_SCALE
+
+
+def to_minor(amount):
+    """Money (number or numeric string) → int minor units"""
+    if isinstance(amount, int):
+        return amount * MONEY_SCALE
+    return int(round(float(amount or 0) * MONEY_SCALE))
+
+
+def from_minor(minor):
+    return minor / MONEY_SCALE
+
+
+@lru_cache(maxsize=4096)
+def _ratio(text):
+    return Fraction(text)
+
+
+def ratio(value):
+    """
+    Conversion factor or price (number or numeric string) → the exact Fraction
+    of its decimal form (str() of a float is its shortest round-trip decimal).
+    """
+    if isinstance(value, Fraction):
+        return value
+    if isinstance(value, int):
+        return Fraction(value)
+    return _ratio(str(value).strip())
+
+
+def _div_round(numerator, denominator, rounding):
+    if rounding == "floor":
+        return numerator // denominator
+    if rounding == "ceil":
+        return -(-numerator // denominator)
+    quotient, remainder = divmod(numerator, denominator)  # half-up
+    return quotient + (2 * remainder >= denominator)
+
+
+def mul_ratio(micro, factor, rounding="half_up"):
+    """micro × factor, rounded to whole micro-units ("half_up", "floor" or "ceil")"""
+    factor = ratio(factor)
+    return _div_round(micro * factor.numerator, factor.denominator, rounding)
+
+
+def div_ratio(micro, factor, rounding="half_up"):
+    """micro ÷ factor, rounded to whole micro-units ("half_up", "floor" or "ceil")"""
+    factor = ratio(factor)
+    if factor <= 0:
+        raise ValueError(f"Invalid conversion factor: {factor}")
+    return _div_round(micro * factor.denominator, factor.numerator, rounding)
+
+
+def line_total_minor(quantity_micro, unit_price):
+    """
+    Price of quantity_micro units at unit_price (currency units, exact decimal)
+    in minor units: the exact product is rounded half-up ONCE, so a price with
+    sub-cent digits is not rounded before it is multiplied.
+    """
+    price = ratio(unit_price or 0)
+    return _div_round(quantity_micro * price.numerator * MONEY_SCALE, QTY_SCALE * price.denominator, "half_up")
+
+
+def to_micro_array(values):
+    """Quantities → int64 micro-unit array (for NumPy batch math)"""
+    return np.rint(np.asarray(values, dtype=np.float64) * QTY_SCALE).astype(np.int64)
+
+
+def from_micro_array(micro):
+    return np.asarray(micro, dtype=np.int64) / QTY_SCALE
@@ -0,0 +1,119 @@
+"""
+Group commit: merge concurrent writes per key into one commit.
+
+Requests call submit(key, payload) and block. The first request for a key
+becomes the group leader: it waits `window` seconds (or until `max_group`
+payloads are pending) so that other requests can join, then calls
+commit_group(key, payloads) once for all of them and hands every waiter its
+own outcome. Groups of the same key commit one after another, never
+concurrently, so commit_group can read-modify-write safely.
+"""
+import threading
+import time
+
+
+class _Group:
+    __slots__ = ("payloads", "outcomes", "done", "full")
+
+    def __init__(self):
+        self.payloads = []
+        self.outcomes = None
+        self.done = threading.Event()
+        self.full = threading.Event()
+
+
+class GroupCommitter:
+    """
+    commit_group(key, payloads) returns one outcome per payload, in order:
+    a result value, or an Exception instance that is raised in that caller.
+    If commit_group itself raises, every payload of the group gets the error.
+    """
+
+    def __init__(self, name, commit_group, window=0.005, max_group=100):
+        self.name = name
+        self.commit_group = commit_group
+        self.window = window
+        self.max_group = max_group
+        self._lock = threading.Lock()
+        self._open = {}        # key -> group still accepting payloads
+        self._key_locks = {}   # key -> lock held while that key's group commits
+        self.counters = {"submitted": 0, "groups": 0, "failed_groups": 0, "largest_group": 0,
+                         "commit_ms_total": 0.0}
+
+    def submit(self, key, payload):
+        with self._lock:
+            self.counters["submitted"] += 1
+            group = self._open.get(key)
+            leader = group is None
+            if leader:
+                group = _Group()
+                self._open[key] = group
+            group.payloads.append(payload)
+            position = len(group.payloads) - 1
+            if len(group.payloads) >= self.max_group:
+                self._open.pop(key, None)  # later arrivals start the next group
+                group.full.set()
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        if leader:
+            self._lead(key, group, key_lock)
+        else:
+            group.done.wait()
+
+        outcome = group.outcomes[position]
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    def submit_many(self, key, payloads):
+        """
+        Commit payloads that arrive together (e.g. a till's offline queue) as one
+        group of their own, without waiting for the window. Returns the outcomes
+        instead of raising them.
+        """
+        group = _Group()
+        group.payloads = list(payloads)
+        group.full.set()  # nobody else can join: commit without waiting
+        with self._lock:
+            self.counters["submitted"] += len(group.payloads)
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        self._lead(key, group, key_lock)
+        return group.outcomes
+
+    def _lead(self, key, group, key_lock):
+        group.full.wait(self.window)
+        with key_lock:  # the previous group of this key must finish first
+            with self._lock:
+                if self._open.get(key) is group:
+                    self._open.pop(key)
+                payloads = list(group.payloads)
+
+            start = time.time()
+            try:
+                outcomes = self.commit_group(key, payloads)
+                if len(outcomes) != len(payloads):
+                    raise RuntimeError(f"{self.name}: {len(outcomes)} outcomes for {len(payloads)} payloads")
+            except Exception as e:
+                outcomes = [e] * len(payloads)
+                with self._lock:
+                    self.counters["failed_groups"] += 1
+
+            with self._lock:
+                self.counters["groups"] += 1
+                self.counters["largest_group"] = max(self.counters["largest_group"], len(payloads))
+                self.counters["commit_ms_total"] += (time.time() - start) * 1000
+
+        group.outcomes = outcomes
+        group.done.set()
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self.counters)
+        commit_ms_total = counters.pop("commit_ms_total")
+        return {
+            **counters,
+            "window_ms": round(self.window * 1000, 2),
+            "max_group": self.max_group,
+            "avg_group_size": round(counters["submitted"] / counters["groups"], 2) if counters["groups"] else None,
+            "avg_commit_ms": round(commit_ms_total / counters["groups"], 2) if counters["groups"] else None
+        }
@@ -0,0 +1,134 @@
+"""
+Idempotency-key dedupe table.
+
+Clients send a key with a request that must not be applied twice (a sale).
+The first request with a key runs; its response is kept for `ttl` seconds
+(at most `max_entries` keys, oldest evicted first). A retry with the same
+key gets the stored response back without running again, and a duplicate
+that arrives while the first attempt is still running waits for it.
+
+Responses the caller marks as not storable (server errors) are handed to
+the waiting duplicates but forgotten afterwards, so a later retry runs again.
+
+The table is in-process memory: keys are not shared between worker processes
+and are lost on restart. A retry that lands on another worker, or arrives
+after a restart, runs again. Deployments that need more must run a single
+(threaded) worker or keep the keys in shared storage.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class IdempotencyConflict(Exception):
+    """The key was already used with a different request body"""
+
+
+class _Entry:
+    __slots__ = ("fingerprint", "done", "response", "error", "completed_at")
+
+    def __init__(self, fingerprint):
+        self.fingerprint = fingerprint
+        self.done = threading.Event()
+        self.response = None
+        self.error = None
+        self.completed_at = None
+
+
+class IdempotencyTable:
+    """
+        sales = IdempotencyTable("complete_sale", ttl=24 * 3600)
+        response, replayed = sales.run(key, fingerprint, handle_sale, data)
+
+    fn returns the response to store; storable(response) decides whether it
+    is kept (default: always).
+    """
+
+    def __init__(self, name, ttl=86400.0, max_entries=50000, storable=None):
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.storable = storable or (lambda response: True)
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> _Entry, oldest first
+        self.counters = {"calls": 0, "executed": 0, "replayed": 0, "waited": 0, "conflicts": 0,
+                         "evicted": 0, "not_stored": 0}
+
+    def run(self, key, fingerprint, fn, *args, **kwargs):
+        """Returns (response, replayed); raises IdempotencyConflict on a reused key"""
+        entry, owner = self.claim(key, fingerprint)
+        if not owner:
+            return self.wait(entry), True
+
+        try:
+            response = fn(*args, **kwargs)
+        except Exception as e:
+            self.complete(key, entry, error=e)
+            raise
+        self.complete(key, entry, response)
+        return response, False
+
+    def claim(self, key, fingerprint):
+        """
+        Lower-level form of run() for callers that handle many keys at once:
+        returns (entry, owner). The owner must call complete(); anyone else
+        gets the response with wait(entry). Wait only after completing your
+        own claims, or two callers can wait on each other.
+        """
+        with self._lock:
+            self.counters["calls"] += 1
+            self._expire(time.time())
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = _Entry(fingerprint)
+                self._entries[key] = entry
+                self._bound()
+                return entry, True
+            if entry.fingerprint != fingerprint:
+                self.counters["conflicts"] += 1
+                raise IdempotencyConflict(f"Idempotency key {key!r} was used for a different request")
+            self.counters["replayed" if entry.done.is_set() else "waited"] += 1
+            return entry, False
+
+    def wait(self, entry):
+        entry.done.wait()
+        if entry.error is not None:
+            raise entry.error
+        return entry.response
+
+    def complete(self, key, entry, response=None, error=None):
+        with self._lock:
+            entry.response = response
+            entry.error = error
+            self.counters["executed"] += 1
+            entry.completed_at = time.time()
+            if error is not None or not self.storable(response):
+                # Let a later retry run again; current waiters still get this outcome
+                self.counters["not_stored"] += 1
+                if self._entries.get(key) is entry:
+                    del self._entries[key]
+            else:
+                self._entries.move_to_end(key)  # TTL counts from completion
+        entry.done.set()
+
+    def _expire(self, now):
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if entry.completed_at is None or now - entry.completed_at < self.ttl:
+                break
+            del self._entries[key]
+            self.counters["evicted"] += 1
+
+    def _bound(self):
+        while len(self._entries) > self.max_entries:
+            key, entry = next(iter(self._entries.items()))
+            if entry.completed_at is None:
+                break  # never drop a running attempt
+            del self._entries[key]
+            self.counters["evicted"] += 1
+
+    def stats(self):
+        with self._lock:
+            running = sum(1 for entry in self._entries.values() if entry.completed_at is None)
+            return {**self.counters, "stored": len(self._entries) - running, "running": running,
+                    "ttl_s": self.ttl, "max_entries": self.max_entries}
@@ -0,0 +1,215 @@
+"""
+Bounded background job queue with a worker pool, batching and retries.
+
+Request threads call submit() and return immediately; worker threads pull up
+to batch_size jobs at a time and hand them to process_batch. Jobs that fail
+are retried with exponential backoff until max_attempts, and every job's
+status stays queryable for a while after it finishes.
+"""
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+
+class QueueFull(Exception):
+    """Raised by submit() when the queue is at capacity"""
+
+
+class BatchJobQueue:
+    """
+    process_batch(jobs) receives a list of job dicts and returns a list of
+    per-job outcomes in the same order: a result value on success or an
+    Exception instance on failure (raising fails the whole batch).
+
+        pipeline = BatchJobQueue("vectorize", process_batch, workers=2, batch_size=8)
+        job_id = pipeline.submit(payload, dedupe_key="shop/item/0")
+        pipeline.status(job_id)  # {"status": "queued" | "running" | "retrying" | "done" | "failed" | "superseded", ...}
+    """
+
+    def __init__(self, name, process_batch, workers=2, batch_size=8, max_queue=500,
+                 max_attempts=3, retry_backoff=2.0, batch_wait=0.05, keep_finished=2000):
+        self.name = name
+        self.process_batch = process_batch
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.batch_wait = batch_wait
+        self.keep_finished = keep_finished
+
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._jobs = OrderedDict()   # job_id -> job (finished jobs trimmed to keep_finished)
+        self._pending = {}           # dedupe_key -> job_id of a queued/retrying job
+        self._lock = threading.Lock()
+        self._threads = []
+        self._busy = 0
+        self.counters = {"submitted": 0, "deduplicated": 0, "rejected": 0, "succeeded": 0,
+                         "failed": 0, "retried": 0, "batches": 0, "batched_jobs": 0,
+                         "job_ms_total": 0.0}
+
+    # ---------- submission ----------
+    def submit(self, payload, dedupe_key=None):
+        """Queue one job; returns its id. Raises QueueFull when at capacity."""
+        self.start()
+        now = time.time()
+        with self._lock:
+            if dedupe_key is not None and dedupe_key in self._pending:
+                # Same target still waiting: run it once with the newest payload
+                job = self._jobs[self._pending[dedupe_key]]
+                job["payload"] = payload
+                job["updated_at"] = now
+                self.counters["deduplicated"] += 1
+                return job["id"]
+
+            job = {"id": uuid.uuid4().hex, "payload": payload, "dedupe_key": dedupe_key,
+                   "status": "queued", "attempts": 0, "error": None, "result": None,
+                   "created_at": now, "updated_at": now}
+            try:
+                self._queue.put_nowait(job["id"])
+            except queue.Full:
+                self.counters["rejected"] += 1
+                raise QueueFull(f"{self.name} queue is full ({self._queue.maxsize} jobs)")
+            self._jobs[job["id"]] = job
+            if dedupe_key is not None:
+                self._pending[dedupe_key] = job["id"]
+            self.counters["submitted"] += 1
+        return job["id"]
+
+    def status(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            return {k: v for k, v in job.items() if k != "payload"}
+
+    # ---------- workers ----------
+    def start(self):
+        if self._threads:
+            return
+        with self._lock:
+            if self._threads:
+                return
+            for n in range(self.workers):
+                thread = threading.Thread(target=self._run, name=f"{self.name}-worker-{n}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _next_batch(self):
+        """Block for one job, then take whatever else arrives within batch_wait"""
+        job_ids = [self._queue.get()]
+        deadline = time.time() + self.batch_wait
+        while len(job_ids) < self.batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                job_ids.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return job_ids
+
+    def _run(self):
+        while True:
+            job_ids = self._next_batch()
+            now = time.time()
+            with self._lock:
+                jobs = [self._jobs[job_id] for job_id in job_ids if job_id in self._jobs]
+                for job in jobs:
+                    job["status"] = "running"
+                    job["attempts"] += 1
+                    job["updated_at"] = now
+                    if self._pending.get(job["dedupe_key"]) == job["id"]:
+                        del self._pending[job["dedupe_key"]]
+                self._busy += 1
+                self.counters["batches"] += 1
+                self.counters["batched_jobs"] += len(jobs)
+
+            try:
+                outcomes = self.process_batch(jobs)
+            except Exception as e:
+                outcomes = [e] * len(jobs)
+
+            for job, outcome in zip(jobs, outcomes):
+                self._finish(job, outcome)
+            with self._lock:
+                self._busy -= 1
+            for job_id in job_ids:
+                self._queue.task_done()
+
+    def _finish(self, job, outcome):
+        now = time.time()
+        retry_in = None
+        with self._lock:
+            job["updated_at"] = now
+            if not isinstance(outcome, Exception):
+                job["status"] = "done"
+                job["result"] = outcome
+                job["error"] = None
+                self.counters["succeeded"] += 1
+                self.counters["job_ms_total"] += (now - job["created_at"]) * 1000
+            elif job["dedupe_key"] is not None and job["dedupe_key"] in self._pending:
+                # A newer job for the same target was submitted meanwhile: it wins
+                job["status"] = "superseded"
+                job["error"] = str(outcome)
+                job["superseded_by"] = self._pending[job["dedupe_key"]]
+            elif job["attempts"] < self.max_attempts:
+                job["status"] = "retrying"
+                job["error"] = str(outcome)
+                self.counters["retried"] += 1
+                retry_in = self.retry_backoff * (2 ** (job["attempts"] - 1))
+                if job["dedupe_key"] is not None:
+                    # Still the pending job for its target: new submits merge into the retry
+                    self._pending[job["dedupe_key"]] = job["id"]
+            else:
+                job["status"] = "failed"
+                job["error"] = str(outcome)
+                self.counters["failed"] += 1
+            self._trim_finished()
+
+        if retry_in is not None:
+            timer = threading.Timer(retry_in, self._requeue, args=(job["id"],))
+            timer.daemon = True
+            timer.start()
+
+    def _requeue(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return
+            try:
+                self._queue.put_nowait(job_id)
+                job["status"] = "queued"
+            except queue.Full:
+                job["status"] = "failed"
+                job["error"] = f"{job['error']} (retry dropped: queue full)"
+                self.counters["failed"] += 1
+                if self._pending.get(job["dedupe_key"]) == job_id:
+                    del self._pending[job["dedupe_key"]]
+
+    def _trim_finished(self):
+        """Forget the oldest finished jobs beyond keep_finished (caller holds the lock)"""
+        finished = [job_id for job_id, job in self._jobs.items() if job["status"] in ("done", "failed", "superseded")]
+        for job_id in finished[:max(0, len(finished) - self.keep_finished)]:
+            self._jobs.pop(job_id, None)
+
+    # ---------- metrics ----------
+    def stats(self):
+        with self._lock:
+            by_status = {}
+            for job in self._jobs.values():
+                by_status[job["status"]] = by_status.get(job["status"], 0) + 1
+            counters = dict(self.counters)
+            busy = self._busy
+        job_ms_total = counters.pop("job_ms_total")
+        return {
+            "queue_depth": self._queue.qsize(),
+            "queue_capacity": self._queue.maxsize,
+            "workers": self.workers,
+            "busy_workers": busy,
+            "jobs_by_status": by_status,
+            **counters,
+            "avg_batch_size": round(counters["batched_jobs"] / counters["batches"], 2) if counters["batches"] else None,
+            "avg_job_ms": round(job_ms_total / counters["succeeded"], 2) if counters["succeeded"] else None
+        }
@@ -0,0 +1,92 @@
+"""
+Fast JSON provider for the Flask app.
+
+Uses orjson when it is installed and falls back to the standard json module
+otherwise, so the app runs the same either way. Both paths understand numpy
+arrays/scalars, datetimes, Decimals and sets, which the cache and Firestore
+documents are full of.
+"""
+import json
+from datetime import date, datetime
+from decimal import Decimal
+
+import numpy as np
+from flask.json.provider import DefaultJSONProvider
+
+from metrics import span
+
+try:
+    import orjson
+except ImportError:  # optional dependency
+    orjson = None
+
+
+def encode_extra_types(obj):
+    """Fallback encoder for types neither json nor orjson handle natively"""
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    if isinstance(obj, Decimal):
+        return float(obj)
+    if isinstance(obj, (set, frozenset, tuple)):
+        return list(obj)
+    if isinstance(obj, bytes):
+        return obj.decode("utf-8", errors="replace")
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """
+    Drop-in replacement for Flask's DefaultJSONProvider.
+    Compact output only; calls asking for indent or other json.dumps options
+    go through the standard library path.
+    """
+
+    def _orjson_options(self):
+        options = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            options |= orjson.OPT_SORT_KEYS
+        return options
+
+    def dumps_bytes(self, obj):
+        """Serialize straight to UTF-8 bytes (no str round-trip on the orjson path)"""
+        if orjson is not None:
+            try:
+                return orjson.dumps(obj, default=encode_extra_types, option=self._orjson_options())
+            except (orjson.JSONEncodeError, TypeError):
+                pass  # e.g. integers beyond 64 bits, let the stdlib try
+        return self._stdlib_dumps(obj).encode("utf-8")
+
+    def dumps(self, obj, **kwargs):
+        if orjson is not None and not kwargs:
+            return self.dumps_bytes(obj).decode("utf-8")
+        return self._stdlib_dumps(obj, **kwargs)
+
+    def _stdlib_dumps(self, obj, **kwargs):
+        kwargs.setdefault("default", encode_extra_types)
+        kwargs.setdefault("ensure_ascii", self.ensure_ascii)
+        kwargs.setdefault("sort_keys", self.sort_keys)
+        kwargs.setdefault("separators", (",", ":"))
+        return json.dumps(obj, **kwargs)
+
+    def loads(self, s, **kwargs):
+        if orjson is not None and not kwargs:
+            return orjson.loads(s)
+        return json.loads(s, **kwargs)
+
+    # Optional callable → dict merged into a JSON object response's "meta"
+    # before it is serialized (None or {} adds nothing)
+    response_meta = None
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        if self.response_meta is not None and isinstance(obj, dict) and isinstance(obj.get("meta", {}), dict):
+            meta = self.response_meta()
+            if meta:
+                obj = {**obj, "meta": {**obj.get("meta", {}), **meta}}
+        with span("serialization"):
+            body = self.dumps_bytes(obj) + b"\n"
+        return self._app.response_class(body, mimetype=self.mimetype)
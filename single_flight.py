@@ -0,0 +1,107 @@
+"""
+Single-flight request coalescing.
+
+When several threads ask for the same key at the same time, only the first
+one (the leader) runs the fetch; the others wait and receive the leader's
+result or exception. Used to keep concurrent tills from repeating the same
+Firestore reads for a cold shop, an item or a shop plan.
+"""
+import threading
+import time
+
+
+class _Flight:
+    __slots__ = ("done", "result", "error", "waiters", "started")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+        self.started = time.time()
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent calls per key.
+
+        loads = SingleFlight("shop_load")
+        index = loads.do(shop_id, refresh_shop_cache, shop_id)
+
+    fresh=True is for refreshes triggered by a change: a flight that is already
+    running may have read before the change, so the caller waits for it and
+    then joins (or leads) the next one.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self._flights = {}  # key -> _Flight
+        self.calls = 0
+        self.fetches = 0
+        self.coalesced = 0
+        self.failures = 0
+        self.fetch_ms_total = 0.0
+        self.fetch_ms_max = 0.0
+        self.last_fetch_ms = None
+
+    def do(self, key, fn, *args, fresh=False, **kwargs):
+        if fresh:
+            with self._lock:
+                running = self._flights.get(key)
+            if running is not None:
+                running.done.wait()
+
+        with self._lock:
+            self.calls += 1
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self._flights[key] = flight
+            else:
+                flight.waiters += 1
+                self.coalesced += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = fn(*args, **kwargs)
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            elapsed_ms = (time.time() - flight.started) * 1000
+            with self._lock:
+                self._flights.pop(key, None)
+                self.fetches += 1
+                if flight.error is not None:
+                    self.failures += 1
+                self.fetch_ms_total += elapsed_ms
+                self.fetch_ms_max = max(self.fetch_ms_max, elapsed_ms)
+                self.last_fetch_ms = elapsed_ms
+            flight.done.set()
+        return flight.result
+
+    def in_flight(self):
+        """key -> number of callers currently waiting on that key's leader"""
+        with self._lock:
+            return {key: flight.waiters for key, flight in self._flights.items()}
+
+    def stats(self):
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "fetches": self.fetches,
+                "coalesced": self.coalesced,
+                "failures": self.failures,
+                "in_flight": len(self._flights),
+                "waiting": sum(flight.waiters for flight in self._flights.values()),
+                "avg_fetch_ms": round(self.fetch_ms_total / self.fetches, 2) if self.fetches else None,
+                "max_fetch_ms": round(self.fetch_ms_max, 2),
+                "last_fetch_ms": round(self.last_fetch_ms, 2) if self.last_fetch_ms is not None else None
+            }
@@ -1,61 +1,52 @@
-import { db } from "../firebase-config.js";
-import { 
-    collection, 
-    getDocs, 
-    onSnapshot,
-    query,
-    where
-} from "https://www.gstatic.com/firebasejs/9.23.0/firebase-firestore.js";
+import { auth } from "../firebase-config.js";
+import { onAuthStateChanged } from "https://www.gstatic.com/firebasejs/9.23.0/firebase-auth.js";
 
-// Store the unsubscribe functions to clean up later
-let unsubscribeFunctions = [];
+// Upgrade requests come from the backend feed (one server-side collection-group
+// listener) instead of one Firestore listener per shop.
+const FEED_URL = `${window.location.origin}/admin/upgrade-requests`;
+const FEED_PAGE_SIZE = 200;
+const FEED_POLL_MS = 5000;
+
+let pollTimer = null;
+let feedVersion = null;
 let isListening = false;
+let pendingRefresh = null;
+
+// The signed-in user once Firebase Auth has restored the session (null if signed out)
+function signedInUser() {
+    if (auth.currentUser) return Promise.resolve(auth.currentUser);
+    return new Promise(resolve => {
+        const unsubscribe = onAuthStateChanged(auth, user => {
+            unsubscribe();
+            resolve(user);
+        });
+    });
+}
+
+// The feed is admin-only: every request carries the admin's Firebase ID token
+async function fetchFeed(url) {
+    const user = await signedInUser();
+    if (!user) throw new Error("Sign in with an admin account to view upgrade requests");
+    const res = await fetch(url, { headers: { Authorization: `Bearer ${await user.getIdToken()}` } });
+    if (res.status === 401 || res.status === 403) {
+        throw new Error("This account is not allowed to view upgrade requests");
+    }
+    return res;
+}
 
 async function loadUpgradeSummary() {
     const container = document.getElementById('upgrade-summary');
     container.innerHTML = '<div class="loading">Loading upgrade requests...</div>';
 
     try {
-        console.log("📊 Loading upgrade requests from all shops...");
+        console.log("📊 Loading upgrade requests feed...");
 
-        // 1️⃣ Get all shops first to get shop names
-        const shopsSnapshot = await getDocs(collection(db, "Shops"));
-        if (shopsSnapshot.empty) {
-            container.innerHTML = '<p>No shops found.</p>';
-            updateStats(0, 0, 0, 0);
-            return;
-        }
+        const res = await fetchFeed(`${FEED_URL}?limit=${FEED_PAGE_SIZE}`);
+        if (!res.ok) throw new Error(`Feed request failed (${res.status})`);
+        const feed = await res.json();
 
-        // Create a map of shopId → shopName
-        const shopMap = {};
-        shopsSnapshot.forEach(shopDoc => {
-            const shopData = shopDoc.data();
-            shopMap[shopDoc.id] = shopData.name || shopData.shopName || "Unknown Shop";
-        });
-
-        console.log("🏪 Shop map:", shopMap);
-
-        // Clear any existing listeners
-        cleanupListeners();
-
-        // 2️⃣ Set up real-time listeners for each shop's upgradeRequests subcollection
-        const allRequests = [];
-        const shopPromises = [];
-
-        for (const shopId in shopMap) {
-            const promise = setupShopListener(shopId, shopMap[shopId], allRequests);
-            shopPromises.push(promise);
-        }
-
-        // Wait for all listeners to be set up
-        await Promise.all(shopPromises);
-
-        // Process the initial data
-        processAndDisplayData(allRequests, shopMap);
-
-        // Start listening for changes
-        isListening = true;
-        console.log("✅ Real-time listeners activated");
+        processAndDisplayData(feed);
+        startLiveUpdates();
 
     } catch (error) {
         console.error("❌ Error loading upgrade requests:", error);
@@ -70,106 +61,77 @@ async function loadUpgradeSummary() {
     }
 }
 
-function setupShopListener(shopId, shopName, allRequestsArray) {
-    return new Promise((resolve) => {
+// Poll the feed's version cursor; the server answers at once, so no
+// request holds a worker thread while waiting for changes.
+function startLiveUpdates() {
+    cleanupListeners();
+    isListening = true;
+    pollTimer = setTimeout(pollForChanges, FEED_POLL_MS);
+    console.log("✅ Live upgrade feed polling started");
+}
+
+async function pollForChanges() {
+    if (!isListening) return;
+    try {
+        if (!document.hidden && feedVersion !== null) {
+            const res = await fetchFeed(`${FEED_URL}/changes?since=${feedVersion}`);
+            if (res.ok) {
+                const change = await res.json();
+                if (change.changed) {
+                    const { total, requested, paid, verified } = change.totals;
+                    updateStats(total, requested, paid, verified);
+                    showUpdateNotification("Upgrade requests updated");
+                    scheduleRefresh();
+                }
+            }
+        }
+    } catch (error) {
+        console.warn("⚠️ Upgrade feed poll failed, retrying:", error);
+    }
+    if (isListening) pollTimer = setTimeout(pollForChanges, FEED_POLL_MS);
+}
+
+// Coalesce bursts of change events into one page re-fetch
+function scheduleRefresh() {
+    clearTimeout(pendingRefresh);
+    pendingRefresh = setTimeout(async () => {
         try {
-            const upgradeRequestsRef = collection(db, `Shops/${shopId}/upgradeRequests`);
-            
-            // Set up real-time listener
-            const unsubscribe = onSnapshot(upgradeRequestsRef, (snapshot) => {
-                console.log(`🔄 Real-time update for shop ${shopId}:`, snapshot.size, "documents");
-                
-                // Remove existing requests from this shop
-                const existingIndexes = [];
-                allRequestsArray.forEach((req, index) => {
-                    if (req.shopId === shopId) {
-                        existingIndexes.push(index);
-                    }
-                });
-                
-                // Remove from end to beginning to maintain indexes
-                existingIndexes.reverse().forEach(index => {
-                    allRequestsArray.splice(index, 1);
-                });
-                
-                // Add new/updated requests
-                snapshot.forEach(reqDoc => {
-                    const req = reqDoc.data();
-                    
-                    allRequestsArray.push({
-                        id: reqDoc.id,
-                        shopId,
-                        shopName: req.shopName || shopName || "Unknown Shop",
-                        requestedPlan: req.requestedPlan || req.planName || "N/A",
-                        status: req.status || req.paymentStatus || "unknown",
-                        mpesaReference: req.mpesaReference || "N/A",
-                        requestedAt: req.requestedAt || req.timestamp || null,
-                        verifiedAt: req.verifiedAt || null,
-                        paymentSubmittedAt: req.paymentSubmittedAt || null,
-                        priceKES: req.priceKES || "N/A",
-                        staffLimit: req.staffLimit || "N/A",
-                        _raw: req,
-                        _updatedAt: new Date() // Track when this record was last updated
-                    });
-                });
-                
-                // Process and display updated data
-                processAndDisplayData(allRequestsArray);
-                
-                // Show notification for new updates
-                showUpdateNotification(`Updated: ${shopName}`);
-            }, (error) => {
-                console.error(`❌ Listener error for shop ${shopId}:`, error);
-            });
-            
-            // Store unsubscribe function for cleanup
-            unsubscribeFunctions.push(unsubscribe);
-            resolve();
-            
+            const res = await fetchFeed(`${FEED_URL}?limit=${FEED_PAGE_SIZE}`);
+            if (res.ok) processAndDisplayData(await res.json());
         } catch (error) {
-            console.error(`⚠️ Error setting up listener for shop ${shopId}:`, error.message);
-            resolve(); // Resolve anyway to continue with other shops
+            console.error("❌ Error refreshing upgrade feed:", error);
         }
-    });
+    }, 300);
 }
 
-function processAndDisplayData(allRequests, shopMap = null) {
-    console.log("🔄 Processing data:", allRequests.length, "requests");
-    
-    if (allRequests.length === 0) {
-        document.getElementById('upgrade-summary').innerHTML = "<p>No upgrade requests found.</p>";
-        updateStats(0, 0, 0, 0);
-        return;
-    }
+function processAndDisplayData(feed) {
+    feedVersion = feed.version ?? feedVersion;
+    const totals = feed.totals || { total: 0, requested: 0, paid: 0, verified: 0 };
+    const paid = feed.groups?.paid?.rows || [];
+    const requestedOnly = feed.groups?.requested?.rows || [];
+    const verified = feed.groups?.verified?.rows || [];
 
-    // 3️⃣ Categorize properly
-    // Paid/Submitted statuses: 'submitted', 'payment_submitted', 'pending_verification'
-    const paidStatuses = ['submitted', 'payment_submitted', 'pending_verification'];
-    
-    const paid = allRequests.filter(r => paidStatuses.includes(r.status));
-    const requestedOnly = allRequests.filter(r => !paidStatuses.includes(r.status));
-    const verified = allRequests.filter(r => r.verifiedAt !== null);
+    console.log(`📊 Stats: Total=${totals.total}, Paid=${totals.paid}, RequestedOnly=${totals.requested}, Verified=${totals.verified}`);
 
-    console.log(`📊 Stats: Total=${allRequests.length}, Paid=${paid.length}, RequestedOnly=${requestedOnly.length}, Verified=${verified.length}`);
+    // Statistics come pre-aggregated from the server
+    updateStats(totals.total, totals.requested, totals.paid, totals.verified);
 
-    // 4️⃣ Update statistics
-    updateStats(allRequests.length, requestedOnly.length, paid.length, verified.length);
+    if (totals.total === 0) {
+        document.getElementById('upgrade-summary').innerHTML = "<p>No upgrade requests found.</p>";
+        return;
+    }
 
     // 5️⃣ Build HTML
     let html = '';
 
     // Paid / Waiting Verification
     if (paid.length > 0) {
-        // Sort by most recent first
-        const sortedPaid = [...paid].sort((a, b) => {
-            const dateA = a.paymentSubmittedAt || a.requestedAt;
-            const dateB = b.paymentSubmittedAt || b.requestedAt;
-            return getTimestamp(dateB) - getTimestamp(dateA);
-        });
+        // Already sorted most recent first by the server
+        const sortedPaid = paid;
         
         html += `
             <div style="margin-bottom: 2rem;">
-                <h3>💰 Paid / Waiting Verification (${paid.length})</h3>
+                <h3>💰 Paid / Waiting Verification (${totals.paid})</h3>
                 <table>
                     <thead>
                         <tr>
@@ -191,7 +153,7 @@ function processAndDisplayData(allRequests, shopMap = null) {
                                 <td><code>${r.mpesaReference}</code></td>
                                 <td>KES ${r.priceKES}</td>
                                 <td>${formatDate(r.paymentSubmittedAt || r.requestedAt)}</td>
-                                <td><small style="color: #6c757d;">${formatTimeAgo(r._updatedAt)}</small></td>
+                                <td><small style="color: #6c757d;">${formatTimeAgo(r.updatedAt)}</small></td>
                             </tr>
                         `).join('')}
                     </tbody>
@@ -202,14 +164,11 @@ function processAndDisplayData(allRequests, shopMap = null) {
 
     // Just Requested (not paid yet)
     if (requestedOnly.length > 0) {
-        // Sort by most recent first
-        const sortedRequested = [...requestedOnly].sort((a, b) => {
-            return getTimestamp(b.requestedAt) - getTimestamp(a.requestedAt);
-        });
+        const sortedRequested = requestedOnly;
         
         html += `
             <div style="margin-bottom: 2rem;">
-                <h3>📝 Just Requested - Awaiting Payment (${requestedOnly.length})</h3>
+                <h3>📝 Just Requested - Awaiting Payment (${totals.requested})</h3>
                 <table>
                     <thead>
                         <tr>
@@ -229,7 +188,7 @@ function processAndDisplayData(allRequests, shopMap = null) {
                                 <td><span style="padding: 3px 8px; background: #fff3cd; border-radius: 4px; color: #856404;">${r.status}</span></td>
                                 <td>${formatDate(r.requestedAt)}</td>
                                 <td>KES ${r.priceKES}</td>
-                                <td><small style="color: #6c757d;">${formatTimeAgo(r._updatedAt)}</small></td>
+                                <td><small style="color: #6c757d;">${formatTimeAgo(r.updatedAt)}</small></td>
                             </tr>
                         `).join('')}
                     </tbody>
@@ -240,14 +199,11 @@ function processAndDisplayData(allRequests, shopMap = null) {
 
     // Already Verified
     if (verified.length > 0) {
-        // Sort by most recent verification first
-        const sortedVerified = [...verified].sort((a, b) => {
-            return getTimestamp(b.verifiedAt) - getTimestamp(a.verifiedAt);
-        });
+        const sortedVerified = verified;
         
         html += `
             <div style="margin-bottom: 2rem;">
-                <h3>✅ Already Verified (${verified.length})</h3>
+                <h3>✅ Already Verified (${totals.verified})</h3>
                 <table>
                     <thead>
                         <tr>
@@ -265,7 +221,7 @@ function processAndDisplayData(allRequests, shopMap = null) {
                                 <td>${r.requestedPlan}</td>
                                 <td>${formatDate(r.verifiedAt)}</td>
                                 <td><code>${r.mpesaReference}</code></td>
-                                <td><small style="color: #6c757d;">${formatTimeAgo(r._updatedAt)}</small></td>
+                                <td><small style="color: #6c757d;">${formatTimeAgo(r.updatedAt)}</small></td>
                             </tr>
                         `).join('')}
                     </tbody>
@@ -282,7 +238,7 @@ function processAndDisplayData(allRequests, shopMap = null) {
     html += `
         <div style="margin-top: 2rem; padding: 1rem; background: #f8f9fa; border-radius: 5px; font-size: 0.9rem;">
             <h4>📋 Dashboard Status ${statusIndicator}</h4>
-            <p>Found ${allRequests.length} upgrade request(s) from ${shopMap ? Object.keys(shopMap).length : 'multiple'} shop(s)</p>
+            <p>Found ${totals.total} upgrade request(s) from ${feed.shops ?? 'multiple'} shop(s)</p>
             <p>Last updated: ${new Date().toLocaleTimeString()}</p>
             <button onclick="toggleAutoRefresh()" style="padding: 5px 10px; margin-top: 5px; font-size: 0.8rem;">
                 ${isListening ? '⏸️ Pause Updates' : '▶️ Resume Updates'}
@@ -328,25 +284,6 @@ function formatDate(timestamp) {
     }
 }
 
-function getTimestamp(dateObj) {
-    if (!dateObj) return 0;
-    
-    try {
-        if (dateObj.toDate) {
-            return dateObj.toDate().getTime();
-        } else if (dateObj.seconds) {
-            return dateObj.seconds * 1000;
-        } else if (typeof dateObj === 'string') {
-            return new Date(dateObj).getTime();
-        } else if (dateObj instanceof Date) {
-            return dateObj.getTime();
-        }
-    } catch (e) {
-        console.error("Timestamp error:", e);
-    }
-    return 0;
-}
-
 function formatTimeAgo(date) {
     if (!date) return "N/A";
     
@@ -413,15 +350,10 @@ function showUpdateNotification(message) {
 }
 
 function cleanupListeners() {
-    console.log("🧹 Cleaning up listeners...");
-    unsubscribeFunctions.forEach(unsubscribe => {
-        try {
-            unsubscribe();
-        } catch (error) {
-            console.error("Error unsubscribing:", error);
-        }
-    });
-    unsubscribeFunctions = [];
+    console.log("🧹 Closing live feed...");
+    clearTimeout(pollTimer);
+    pollTimer = null;
+    clearTimeout(pendingRefresh);
     isListening = false;
 }
 
@@ -2,7 +2,7 @@
 
 import { getAuth } from "https://www.gstatic.com/firebasejs/9.23.0/firebase-auth.js";
 import { db } from "./firebase-config.js";
-import { doc, getDoc, writeBatch, increment, arrayUnion, serverTimestamp } from "https://www.gstatic.com/firebasejs/9.23.0/firebase-firestore.js";
+import { doc, getDoc, runTransaction, increment, arrayUnion, serverTimestamp } from "https://www.gstatic.com/firebasejs/9.23.0/firebase-firestore.js";
 
 // ====================================================
 // GLOBAL CART STATE
@@ -977,6 +977,34 @@ function showPaymentModal() {
     };
 }
 
+// ====================================================
+// SALE IDEMPOTENCY KEY (one per cart, reused by retries)
+// ====================================================
+
+const SALE_KEY_STORAGE = 'pending_sale_key';
+
+function cartSignature() {
+    return JSON.stringify(cart.map(item => [item.item_id, item.batch_id, item.type, item.quantity, item.price || item.sellPrice || 0]));
+}
+
+// Same key for every attempt at the same cart (also across reloads), a new
+// one once the cart changes or the sale went through
+function getSaleIdempotencyKey() {
+    const signature = cartSignature();
+    try {
+        const saved = JSON.parse(localStorage.getItem(SALE_KEY_STORAGE) || 'null');
+        if (saved && saved.signature === signature) return saved;
+    } catch (e) {
+        // corrupt entry: start a new key
+    }
+    const key = window.crypto?.randomUUID
+        ? window.crypto.randomUUID()
+        : `${Date.now().toString(36)}${Math.random().toString(36).substr(2, 10)}`;
+    const entry = { key, signature, createdAt: Date.now() };
+    localStorage.setItem(SALE_KEY_STORAGE, JSON.stringify(entry));
+    return entry;
+}
+
 // ====================================================
 // COMPLETE SALE FUNCTION (FRONTEND VERSION)
 // ====================================================
@@ -1007,10 +1035,13 @@ async function completeSale(paymentDetails = {}) {
     });
 
     try {
-        // Create Firestore batch
-        const batch = writeBatch(db);
-        const saleId = `sale_${Date.now()}_${Math.random().toString(36).substr(2, 6)}`;
-        const receiptId = `receipt_${Date.now()}_${user.uid.substr(0, 8)}`;
+        // Ids come from the cart's idempotency key: a retry after an unclear
+        // failure (e.g. the commit landed but the response was lost) finds
+        // the receipt already written and does not deduct stock again
+        const saleKey = getSaleIdempotencyKey();
+        const saleId = `sale_${saleKey.createdAt}_${saleKey.key.substr(0, 12)}`;
+        const receiptId = `receipt_${saleKey.createdAt}_${user.uid.substr(0, 8)}_${saleKey.key.substr(0, 8)}`;
+        const writes = [];  // [ref, data, "update" | "set"]
         
         let totalAmount = 0;
         let totalBaseUnits = 0;
@@ -1026,12 +1057,12 @@ async function completeSale(paymentDetails = {}) {
             const itemRef = doc(db, 'Shops', currentShopId, 'items', item.item_id);
             
             // 1. Update stock
-            batch.update(itemRef, {
+            writes.push([itemRef, {
                 'stock': increment(-baseQty),
                 'lastStockUpdate': new Date().toISOString(),
                 'lastTransactionId': saleId,
                 'updatedAt': serverTimestamp()
-            });
+            }, 'update']);
             
             // 2. Add transaction record
             const transaction = {
@@ -1053,9 +1084,9 @@ async function completeSale(paymentDetails = {}) {
                 receipt_id: receiptId
             };
             
-            batch.update(itemRef, {
+            writes.push([itemRef, {
                 'stockTransactions': arrayUnion(transaction)
-            });
+            }, 'update']);
             
             totalAmount += transaction.totalPrice;
             totalBaseUnits += baseQty;
@@ -1084,14 +1115,15 @@ async function completeSale(paymentDetails = {}) {
             payment: paymentDetails,
             status: 'completed',
             sale_id: saleId,
+            idempotency_key: saleKey.key,
             created_at: serverTimestamp()
         };
         
-        batch.set(receiptRef, receiptData);
+        writes.push([receiptRef, receiptData, 'set']);
         
         // 4. Create audit log (optional)
         const auditRef = doc(db, 'Shops', currentShopId, 'auditLogs', `audit_${saleId}`);
-        batch.set(auditRef, {
+        writes.push([auditRef, {
             id: `audit_${saleId}`,
             action: 'sale_completed',
             performed_by: sellerInfo,
@@ -1103,10 +1135,18 @@ async function completeSale(paymentDetails = {}) {
                 total_amount: totalAmount,
                 seller_name: sellerInfo.name
             }
-        });
+        }, 'set']);
         
-        // Commit ALL operations
-        await batch.commit();
+        // Commit ALL operations, unless this cart's sale is already recorded
+        const alreadyRecorded = await runTransaction(db, async (tx) => {
+            if ((await tx.get(receiptRef)).exists()) return true;
+            for (const [ref, data, op] of writes) {
+                if (op === 'set') tx.set(ref, data);
+                else tx.update(ref, data);
+            }
+            return false;
+        });
+        if (alreadyRecorded) console.log('♻️ Sale already recorded for this cart, not applied again', { saleId });
         
         console.log('✅ Frontend sale successful!', {
             saleId,
@@ -1118,6 +1158,7 @@ async function completeSale(paymentDetails = {}) {
         // Clear cart
         cart = [];
         localStorage.removeItem('current_cart_id');
+        localStorage.removeItem(SALE_KEY_STORAGE);
         saveCartToStorage();
         updateCartIcon();
         
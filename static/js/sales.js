@@ -12,6 +12,9 @@ let salesOverlay = null;
 let searchTimeout = null;
 let currentShopId = null;
 let currentUser = null;
+let stockStream = null;
+let stockRefreshTimeout = null;
+let renderedItemIds = new Set();
 
 const NAV_HEIGHT = 64;
 
@@ -930,6 +933,7 @@ async function onSearchInput(query) {
 function renderResults(items) {
     const resultsContainer = document.getElementById("sales-results");
     resultsContainer.innerHTML = '';
+    renderedItemIds = new Set(items.map(item => item.item_id));
     
     console.log(`📋 Rendering ${items.length} results`);
     
@@ -1193,6 +1197,7 @@ async function openSalesOverlay() {
 
     createSalesOverlay();
     salesOverlay.style.display = 'flex';
+    startStockStream(shopId);
     
     console.log('Sales overlay displayed');
     
@@ -1209,6 +1214,64 @@ function closeSalesOverlay() {
         console.log('🔒 Closing Sales Overlay');
         salesOverlay.style.display = 'none';
     }
+    stopStockStream();
+}
+
+// ====================================================
+// LIVE STOCK UPDATES (cursor polling, one poll loop per till)
+// ====================================================
+
+const STOCK_POLL_MS = 3000;
+
+function startStockStream(shopId) {
+    stopStockStream();
+    if (!shopId) return;
+
+    const poll = { shopId, cursor: null, timer: null, stopped: false };
+    stockStream = poll;
+    pollStockChanges(poll);
+}
+
+async function pollStockChanges(poll) {
+    try {
+        if (!document.hidden) {
+            const params = poll.cursor ? `?cursor=${encodeURIComponent(poll.cursor)}` : '';
+            const res = await fetch(`${FLASK_BACKEND_URL}/stock/changes/${encodeURIComponent(poll.shopId)}${params}`);
+            if (res.ok) {
+                const body = await res.json();
+                const firstPoll = poll.cursor === null;
+                poll.cursor = body.cursor;
+                const changed = body.changes.filter((delta) => renderedItemIds.has(delta.item_id));
+                if ((body.reset && !firstPoll) || changed.length) {
+                    scheduleStockRefresh(changed);
+                }
+            }
+        }
+    } catch (error) {
+        console.warn('⚠️ Stock changes poll failed, retrying:', error);
+    }
+    if (!poll.stopped) poll.timer = setTimeout(() => pollStockChanges(poll), STOCK_POLL_MS);
+}
+
+// Re-run the visible search once per burst of changes
+function scheduleStockRefresh(deltas) {
+    clearTimeout(stockRefreshTimeout);
+    stockRefreshTimeout = setTimeout(() => {
+        const input = document.getElementById("sales-search-input");
+        if (input && input.value.trim().length >= 2) {
+            console.log('🔄 Stock changed for visible item, refreshing results', deltas);
+            onSearchInput(input.value);
+        }
+    }, 300);
+}
+
+function stopStockStream() {
+    clearTimeout(stockRefreshTimeout);
+    if (stockStream) {
+        stockStream.stopped = true;
+        clearTimeout(stockStream.timer);
+        stockStream = null;
+    }
 }
 
 // ====================================================
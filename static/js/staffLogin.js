@@ -178,6 +178,18 @@ async function handleStaffLogin() {
 // 3) FIND STAFF MEMBER (fast: collectionGroup)
 // ============================================
 async function findStaffByEmail(email) {
+  // Fast path: server-side staff directory, keyed by the signed-in user's ID token
+  try {
+    const ref = await lookupStaffRef();
+    if (ref === null) return null;
+    if (ref) {
+      const staffSnap = await getDoc(doc(db, "Shops", ref.shopId, "staff", ref.staffId));
+      if (staffSnap.exists()) return staffFromDoc(staffSnap);
+    }
+  } catch (e) {
+    console.warn("⚠️ Staff directory unavailable, falling back to Firestore:", e);
+  }
+
   console.log("🔍 Searching staff via collectionGroup for:", email);
 
   // NOTE: this requires staff docs to be under Shops/{shopId}/staff/{staffId}
@@ -186,15 +198,51 @@ async function findStaffByEmail(email) {
 
   if (snap.empty) return null;
 
-  // If an email exists under multiple shops, we use the first match
-  const staffDoc = snap.docs[0];
-  const staff = staffDoc.data();
+  const staffDoc = await chooseStaffShop(snap.docs);
+  return staffDoc ? staffFromDoc(staffDoc) : null;
+}
 
-  // staffDoc.ref.path => Shops/{shopId}/staff/{staffId}
-  const shopId = staffDoc.ref.parent.parent.id;
-  const staffId = staffDoc.id;
+// {shopId, staffId} for the signed-in user, null if not staff,
+// undefined if the directory can't answer (caller falls back)
+async function lookupStaffRef() {
+  const user = auth.currentUser;
+  if (!user) return undefined;
+
+  const res = await fetch(`${window.location.origin}/staff/lookup`, {
+    method: "POST",
+    headers: { Authorization: `Bearer ${await user.getIdToken()}` }
+  });
+  if (res.status === 404) return null;
+
+  const body = await res.json().catch(() => ({}));
+  if (res.ok && body.found) return body.staff;
 
-  // Prefer shop document name, fallback to staff.shopName
+  if (res.status === 409 && Array.isArray(body.matches)) {
+    const snaps = await Promise.all(
+      body.matches.map((m) => getDoc(doc(db, "Shops", m.shopId, "staff", m.staffId)))
+    );
+    const chosen = await chooseStaffShop(snaps.filter((s) => s.exists()));
+    return chosen ? { shopId: chosen.ref.parent.parent.id, staffId: chosen.id } : null;
+  }
+  return undefined;
+}
+
+// An email can be staff in several shops: ask which one to sign in to
+async function chooseStaffShop(staffDocs) {
+  if (staffDocs.length <= 1) return staffDocs[0] || null;
+
+  const names = await Promise.all(staffDocs.map((d) => shopNameFor(d.ref.parent.parent.id, d.data())));
+  const answer = prompt(
+    "This account is staff in several shops. Enter the number of the shop to sign in to:\n" +
+      names.map((name, i) => `${i + 1}. ${name}`).join("\n"),
+    "1"
+  );
+  const index = parseInt(answer, 10) - 1;
+  return staffDocs[index] || null;
+}
+
+// Prefer shop document name, fallback to staff.shopName
+async function shopNameFor(shopId, staff) {
   let shopName = staff.shopName || "Unknown Shop";
   try {
     const shopSnap = await getDoc(doc(db, "Shops", shopId));
@@ -205,11 +253,19 @@ async function findStaffByEmail(email) {
   } catch (e) {
     // ignore, fallback already set
   }
+  return shopName;
+}
+
+async function staffFromDoc(staffDoc) {
+  const staff = staffDoc.data();
+
+  // staffDoc.ref.path => Shops/{shopId}/staff/{staffId}
+  const shopId = staffDoc.ref.parent.parent.id;
 
   return {
     shopId,
-    shopName,
-    staffId,
+    shopName: await shopNameFor(shopId, staff),
+    staffId: staffDoc.id,
     staffDocPath: staffDoc.ref.path,
     email: staff.email,
     name: staff.name,
@@ -80,7 +80,32 @@ async function findStaffByEmail(email) {
     
     const normalizedEmail = email.toLowerCase().trim();
     
-    // Get all shops
+    // Fast path: server-side staff directory (no per-shop queries). It only
+    // answers for the signed-in user's own email, by ID token.
+    const user = getAuth().currentUser;
+    if (user && (user.email || "").toLowerCase() === normalizedEmail) {
+      try {
+        const res = await fetch(`${window.location.origin}/staff/lookup`, {
+          method: "POST",
+          headers: { Authorization: `Bearer ${await user.getIdToken()}` }
+        });
+        if (res.status === 404) return null;
+        if (res.ok) {
+          const body = await res.json();
+          if (body.found) {
+            const { staffId, shopId } = body.staff;
+            const staffSnap = await getDoc(doc(db, "Shops", shopId, "staff", staffId));
+            if (staffSnap.exists()) {
+              return { staffUid: staffId, shopId, staffData: staffSnap.data() };
+            }
+          }
+        }
+      } catch (e) {
+        console.warn("⚠️ Staff directory unavailable, falling back to shop scan:", e);
+      }
+    }
+    
+    // Fallback: get all shops
     const shopsRef = collection(db, "Shops");
     const shopsSnapshot = await getDocs(shopsRef);
     
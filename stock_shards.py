@@ -0,0 +1,103 @@
+"""
+Sharded stock counters for hot items.
+
+Firestore sustains about one write per second per document, so a fast
+selling item whose doc is rewritten on every sale caps checkout throughput.
+A sharded item keeps its base `stock` / `batches[i].quantity` on the item
+doc (marked with `stockShards: N`) and takes deductions as increments on one
+of N shard docs under it:
+
+    .../items/{item_id}/stockShards/{0..N-1}
+        {"stock": -3.5, "batches": {"<batch_id>": -3.5}, "stockTransactions": [...]}
+
+The real quantity is the base value plus the sum of all shards. Items are
+promoted when their write rate (WriteRateTracker) crosses a threshold.
+"""
+import math
+import threading
+import time
+
+from fixed_point import to_micro, from_micro
+
+SHARD_COLLECTION = "stockShards"
+
+
+def shard_count(item_data):
+    """Number of stock shards of an item doc (0 = not sharded)"""
+    try:
+        return max(int((item_data or {}).get("stockShards") or 0), 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+def shard_totals(shards):
+    """Sum shard docs → (stock delta, {batch_id: quantity delta}) in micro-units"""
+    stock = 0
+    batches = {}
+    for shard in shards:
+        if not shard:
+            continue
+        stock += to_micro(shard.get("stock", 0))
+        for batch_id, value in (shard.get("batches") or {}).items():
+            batches[batch_id] = batches.get(batch_id, 0) + to_micro(value)
+    return stock, batches
+
+
+def apply_shard_totals(item_data, shards):
+    """Copy of an item doc with the shard deltas added to stock and batch quantities"""
+    stock_delta, batch_deltas = shard_totals(shards)
+    if not stock_delta and not batch_deltas:
+        return item_data
+    summed = dict(item_data)
+    summed["stock"] = from_micro(to_micro(item_data.get("stock", 0)) + stock_delta)
+    summed["batches"] = [
+        {**batch, "quantity": from_micro(to_micro(batch.get("quantity", 0)) + batch_deltas[batch.get("id")])}
+        if batch.get("id") in batch_deltas else batch
+        for batch in item_data.get("batches", [])
+    ]
+    return summed
+
+
+class WriteRateTracker:
+    """
+    Exponentially decayed writes/second per key: O(1) per write, no timestamp
+    lists. `window` is the decay time constant in seconds; only the
+    `max_keys` busiest keys are kept.
+    """
+
+    def __init__(self, window=30.0, max_keys=10000):
+        self.window = window
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._rates = {}  # key -> (rate, last_update)
+
+    def _decayed(self, key, now):
+        rate, last = self._rates.get(key, (0.0, now))
+        return rate * math.exp(-(now - last) / self.window)
+
+    def record(self, key, now=None):
+        """Count one write; returns the key's current writes/second"""
+        now = time.time() if now is None else now
+        with self._lock:
+            rate = self._decayed(key, now) + 1.0 / self.window
+            self._rates[key] = (rate, now)
+            if len(self._rates) > self.max_keys:
+                self._prune(now)
+            return rate
+
+    def rate(self, key, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            return self._decayed(key, now)
+
+    def _prune(self, now):
+        ranked = sorted(self._rates, key=lambda k: self._decayed(k, now), reverse=True)
+        for key in ranked[self.max_keys // 2:]:
+            del self._rates[key]
+
+    def hottest(self, n=10, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            rates = [(key, self._decayed(key, now)) for key in self._rates]
+        rates.sort(key=lambda kv: kv[1], reverse=True)
+        return [{"key": key, "writes_per_s": round(rate, 3)} for key, rate in rates[:n]]
@@ -0,0 +1,52 @@
+import contextlib
+import io
+import itertools
+import os
+
+import pytest
+
+from tests.fake_firestore import FakeFirestore
+
+_shop_ids = itertools.count()
+
+
+@pytest.fixture(scope="session")
+def firestore_db():
+    return FakeFirestore()
+
+
+@pytest.fixture(scope="session")
+def app_module(firestore_db):
+    """app.py imported against the in-memory Firestore (no credentials, no network)"""
+    import firebase_admin
+    from firebase_admin import credentials, firestore
+
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setenv("FIREBASE_KEY", "{}")
+        patch.delenv("SALE_RECORD_WAL_DIR", raising=False)
+        patch.setenv("SHOP_ACTIVITY_FILE", os.devnull)
+        patch.setattr(credentials, "Certificate", lambda key: None)
+        patch.setattr(firebase_admin, "initialize_app", lambda *args, **kwargs: None)
+        patch.setattr(firestore, "client", lambda *args, **kwargs: firestore_db)
+        with contextlib.redirect_stdout(io.StringIO()):
+            import app
+    return app
+
+
+@pytest.fixture
+def client(app_module):
+    return app_module.app.test_client()
+
+
+@pytest.fixture
+def shop(firestore_db):
+    """A fresh shop id with one item (two batches) in both the category tree and the flat items collection"""
+    shop_id = f"shop{next(_shop_ids)}"
+    item = {"name": "Fresh Milk 500ml", "stock": 10, "sellPrice": 60, "buyPrice": 50,
+            "batches": [{"id": "b1", "batchName": "B1", "quantity": 4, "sellPrice": 60, "buyPrice": 50, "timestamp": 1},
+                        {"id": "b2", "batchName": "B2", "quantity": 6, "sellPrice": 65, "buyPrice": 52, "timestamp": 2}]}
+    firestore_db.write(f"Shops/{shop_id}", {"name": "Duka"})
+    firestore_db.write(f"Shops/{shop_id}/categories/dairy", {"name": "Dairy"})
+    firestore_db.write(f"Shops/{shop_id}/categories/dairy/items/milk", item)
+    firestore_db.write(f"Shops/{shop_id}/items/milk", item)
+    return shop_id
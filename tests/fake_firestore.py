@@ -0,0 +1,279 @@
+"""
+In-memory stand-in for the Firestore client, enough of it for app.py's routes
+and listeners: documents, collections, collection-group queries filtered on
+__name__, batches, get_all and on_snapshot. Listeners are called synchronously
+on every write, after an initial delivery like the real client's.
+"""
+import copy
+import itertools
+
+
+def _is_sentinel(value, name):
+    return type(value).__name__ == name
+
+
+def _resolve(value, old):
+    """Apply Increment / ArrayUnion / server timestamps the way Firestore stores them"""
+    if _is_sentinel(value, "Increment"):
+        return (old or 0) + value.value
+    if _is_sentinel(value, "ArrayUnion"):
+        old = list(old or [])
+        return old + [item for item in value.values if item not in old]
+    if _is_sentinel(value, "Sentinel"):
+        return "SERVER_TIMESTAMP"
+    if isinstance(value, dict):
+        old = old if isinstance(old, dict) else {}
+        return {key: _resolve(item, old.get(key)) for key, item in value.items()}
+    return value
+
+
+def _merge(base, data):
+    for key, value in data.items():
+        if isinstance(value, dict) and isinstance(base.get(key), dict):
+            _merge(base[key], value)
+        else:
+            base[key] = _resolve(value, base.get(key))
+
+
+class _ChangeType:
+    def __init__(self, name):
+        self.name = name
+
+
+class DocumentChange:
+    def __init__(self, document, kind):
+        self.document = document
+        self.type = _ChangeType(kind)
+
+
+class DocumentSnapshot:
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+        self.exists = data is not None
+
+    def to_dict(self):
+        return copy.deepcopy(self._data)
+
+
+class DocumentReference:
+    def __init__(self, store, path):
+        self._store = store
+        self.path = path
+        self.id = path.rsplit("/", 1)[-1]
+
+    @property
+    def parent(self):
+        return CollectionReference(self._store, self.path.rsplit("/", 1)[0])
+
+    def collection(self, name):
+        return CollectionReference(self._store, f"{self.path}/{name}")
+
+    def get(self, *args, **kwargs):
+        return DocumentSnapshot(self, copy.deepcopy(self._store.docs.get(self.path)))
+
+    def set(self, data, merge=False):
+        self._store.write(self.path, data, merge=merge)
+
+    def create(self, data):
+        if self.path in self._store.docs:
+            raise ValueError(f"Document already exists: {self.path}")
+        self._store.write(self.path, data)
+
+    def update(self, data):
+        self._store.update(self.path, data)
+
+    def delete(self):
+        self._store.delete(self.path)
+
+    def on_snapshot(self, callback):
+        return self._store.listen(lambda path: path == self.path, callback)
+
+    def __eq__(self, other):
+        return isinstance(other, DocumentReference) and other.path == self.path
+
+    def __hash__(self):
+        return hash(self.path)
+
+
+class Query:
+    def __init__(self, store, matches_path, filters=(), limit=None):
+        self._store = store
+        self._matches_path = matches_path
+        self._filters = tuple(filters)
+        self._limit = limit
+
+    def where(self, field=None, op=None, value=None, filter=None):
+        if filter is not None:
+            field, op, value = filter.field_path, filter.op_string, filter.value
+        return Query(self._store, self._matches_path, self._filters + ((field, op, value),), self._limit)
+
+    def order_by(self, *args, **kwargs):
+        return self
+
+    def limit(self, count):
+        return Query(self._store, self._matches_path, self._filters, count)
+
+    def _matches(self, path, data):
+        if not self._matches_path(path):
+            return False
+        for field, op, value in self._filters:
+            actual = path if str(field) == "__name__" else (data or {}).get(field)
+            if str(field) == "__name__":
+                value = value.path
+            if op == "==" and actual != value:
+                return False
+            if op == ">=" and not actual >= value:
+                return False
+            if op == "<" and not actual < value:
+                return False
+        return True
+
+    def stream(self, *args, **kwargs):
+        paths = [path for path in sorted(self._store.docs) if self._matches(path, self._store.docs[path])]
+        for path in paths[:self._limit] if self._limit else paths:
+            yield DocumentSnapshot(DocumentReference(self._store, path), copy.deepcopy(self._store.docs[path]))
+
+    def get(self, *args, **kwargs):
+        return list(self.stream())
+
+    def on_snapshot(self, callback):
+        watch = self._store.listen(lambda path: self._matches(path, self._store.docs.get(path) or {}), callback)
+        callback(self.get(), [], None)  # initial delivery
+        return watch
+
+
+class CollectionReference(Query):
+    def __init__(self, store, path):
+        super().__init__(store, lambda candidate: candidate.rsplit("/", 1)[0] == path)
+        self.path = path
+        self.id = path.rsplit("/", 1)[-1]
+
+    @property
+    def parent(self):
+        return DocumentReference(self._store, self.path.rsplit("/", 1)[0]) if "/" in self.path else None
+
+    def document(self, doc_id=None):
+        return DocumentReference(self._store, f"{self.path}/{doc_id or next(self._store.ids)}")
+
+    def add(self, data):
+        reference = self.document()
+        reference.set(data)
+        return None, reference
+
+
+class WriteBatch:
+    """Writes are applied at commit, all or none (an update of a missing doc fails the batch)"""
+
+    def __init__(self, store):
+        self._store = store
+        self._writes = []  # (kind, path, data, merge)
+
+    def set(self, reference, data, merge=False):
+        self._writes.append(("set", reference.path, data, merge))
+
+    def create(self, reference, data):
+        self._writes.append(("set", reference.path, data, False))
+
+    def update(self, reference, data):
+        self._writes.append(("update", reference.path, data, False))
+
+    def delete(self, reference):
+        self._writes.append(("delete", reference.path, None, False))
+
+    def commit(self):
+        if len(self._writes) > 500:
+            raise ValueError("A batch can hold at most 500 writes")
+        existing = set(self._store.docs)
+        for kind, path, _, _ in self._writes:
+            if kind == "update" and path not in existing:
+                raise KeyError(f"No document to update: {path}")
+            if kind == "set":
+                existing.add(path)
+            elif kind == "delete":
+                existing.discard(path)
+        self._store.commits += 1
+        for kind, path, data, merge in self._writes:
+            if kind == "set":
+                self._store.write(path, data, merge=merge)
+            elif kind == "update":
+                self._store.update(path, data)
+            else:
+                self._store.delete(path)
+        self._writes = []
+        return []
+
+
+class _Watch:
+    def __init__(self, store, key):
+        self._store = store
+        self._key = key
+
+    def unsubscribe(self):
+        self._store.listeners.pop(self._key, None)
+
+
+class FakeFirestore:
+    def __init__(self):
+        self.docs = {}
+        self.listeners = {}
+        self.commits = 0
+        self.ids = (f"auto{n}" for n in itertools.count())
+        self._listener_ids = itertools.count()
+
+    # ---------- client API ----------
+    def collection(self, name):
+        return CollectionReference(self, name)
+
+    def document(self, *parts):
+        return DocumentReference(self, "/".join(parts))
+
+    def collection_group(self, collection_id):
+        return Query(self, lambda path: path.split("/")[-2] == collection_id)
+
+    def batch(self):
+        return WriteBatch(self)
+
+    def get_all(self, references, *args, **kwargs):
+        for reference in references:
+            yield reference.get()
+
+    # ---------- storage ----------
+    def write(self, path, data, merge=False):
+        existed = path in self.docs
+        base = copy.deepcopy(self.docs.get(path, {})) if merge else {}
+        _merge(base, data)
+        self.docs[path] = base
+        self._notify(path, "MODIFIED" if existed else "ADDED")
+
+    def update(self, path, data):
+        if path not in self.docs:
+            raise KeyError(f"No document to update: {path}")
+        document = self.docs[path]
+        for field, value in data.items():
+            *parents, last = field.split(".")
+            target = document
+            for part in parents:
+                target = target[int(part)] if isinstance(target, list) else target.setdefault(part, {})
+            if isinstance(target, list):
+                target[int(last)] = _resolve(value, target[int(last)])
+            else:
+                target[last] = _resolve(value, target.get(last))
+        self._notify(path, "MODIFIED")
+
+    def delete(self, path):
+        if self.docs.pop(path, None) is not None:
+            self._notify(path, "REMOVED")
+
+    def listen(self, matches_path, callback):
+        key = next(self._listener_ids)
+        self.listeners[key] = (matches_path, callback)
+        return _Watch(self, key)
+
+    def _notify(self, path, kind):
+        data = copy.deepcopy(self.docs.get(path)) if kind != "REMOVED" else None
+        snapshot = DocumentSnapshot(DocumentReference(self, path), data)
+        for matches_path, callback in list(self.listeners.values()):
+            if matches_path(path):
+                callback([snapshot], [DocumentChange(snapshot, kind)], None)
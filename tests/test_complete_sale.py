@@ -0,0 +1,49 @@
+def _sale(shop_id, *lines):
+    return {"shop_id": shop_id, "user_id": "user1", "seller": {"name": "Amina"}, "payment": {"method": "cash"},
+            "items": [{"name": "Fresh Milk 500ml", "price": 60, **line} for line in lines]}
+
+
+def test_sale_that_would_take_a_batch_negative_answers_409(client, firestore_db, shop):
+    response = client.post("/complete-sale", json=_sale(shop, {"item_id": "milk", "batch_id": "b1", "quantity": 5}))
+
+    assert response.status_code == 409
+    body = response.get_json()
+    assert body["success"] is False and body["error"] == "Insufficient stock"
+    assert "b1" in body["message"] and body["sale_id"]
+    assert firestore_db.docs[f"Shops/{shop}/items/milk"]["batches"][0]["quantity"] == 4
+
+
+def test_bulk_and_single_sale_reject_the_same_sale_alike(client, firestore_db, shop):
+    sale = _sale(shop, {"item_id": "milk", "batch_id": "b1", "quantity": 2})
+
+    def bulk_sale(key):
+        response = client.post("/complete-sale/bulk", json={
+            "shop_id": shop, "user_id": "user1", "seller": {"name": "Amina"},
+            "sales": [{"idempotency_key": key, "items": sale["items"]}]})
+        [result] = response.get_json()["results"]
+        return result
+
+    assert bulk_sale("till-1")["status"] == 200  # loads the shop cache
+    # Another till empties the shelf; written straight into the store so the cache still counts 8
+    for batch in firestore_db.docs[f"Shops/{shop}/items/milk"]["batches"]:
+        batch["quantity"] = 0
+
+    result = bulk_sale("till-2")
+    single = client.post("/complete-sale", json=sale)
+
+    assert single.status_code == 409 and result["status"] == 409
+    body = single.get_json()
+    assert (result["success"], result["error"]) == (body["success"], body["error"]) == (False, "Insufficient stock")
+    assert set(result) - {"index", "idempotency_key", "status", "replayed"} == set(body)
+
+
+def test_missing_item_is_skipped_and_the_rest_of_the_sale_commits(client, firestore_db, shop):
+    response = client.post("/complete-sale", json=_sale(
+        shop,
+        {"item_id": "milk", "batch_id": "b1", "quantity": 1},
+        {"item_id": "gone", "batch_id": "bx", "quantity": 1}))
+
+    assert response.status_code == 200
+    milk = firestore_db.docs[f"Shops/{shop}/items/milk"]
+    assert milk["stock"] == 9 and milk["batches"][0]["quantity"] == 3
+    assert f"Shops/{shop}/items/gone" not in firestore_db.docs
@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+
+from embedding_codec import decode_embedding, encode_embedding
+
+
+@pytest.fixture
+def vector():
+    return np.random.default_rng(0).normal(size=1280).astype(np.float32)
+
+
+def test_float16_round_trip(vector):
+    fields = encode_embedding(vector)
+    assert fields["encoding"] == "float16" and fields["dim"] == 1280
+    assert len(fields["vector_bytes"]) == 2 * 1280
+    decoded = decode_embedding(fields)
+    assert decoded.dtype == np.float16
+    assert np.allclose(decoded, vector, atol=1e-2)
+
+
+def test_int8_round_trip_keeps_direction(vector):
+    fields = encode_embedding(vector, "int8")
+    assert len(fields["vector_bytes"]) == 1280
+    decoded = decode_embedding(fields).astype(np.float32)
+    cosine = decoded @ vector / (np.linalg.norm(decoded) * np.linalg.norm(vector))
+    assert cosine > 0.999
+    assert np.abs(decoded - vector).max() <= fields["scale"]
+
+
+def test_legacy_list_and_empty_docs():
+    assert decode_embedding(encode_embedding([1, 2, 3], "list")).tolist() == [1.0, 2.0, 3.0]
+    assert decode_embedding({"vector": [0.5]}).dtype == np.float32
+    assert decode_embedding({}) is None
+    assert encode_embedding(np.zeros(4), "int8")["scale"] == 1.0
+
+
+def test_bad_encoding_or_length_is_rejected(vector):
+    with pytest.raises(ValueError):
+        encode_embedding(vector, "float64")
+    with pytest.raises(ValueError):
+        decode_embedding({"vector_bytes": b"\0\0", "encoding": "bf16"})
+    with pytest.raises(ValueError):
+        decode_embedding({**encode_embedding(vector), "dim": 1000})
@@ -0,0 +1,69 @@
+import random
+
+from fifo_allocation import (allocate_fifo_many, allocate_main_item_fifo, allocate_selling_unit_fifo,
+                             allocate_selling_units_many)
+from fixed_point import from_micro, to_micro
+
+
+def _random_batches(rng, count):
+    return [{"batch_id": f"b{i}", "remaining_quantity": round(rng.uniform(0, 5), 3),
+             "sell_price": round(rng.uniform(0, 3), 3), "buy_price": round(rng.uniform(0, 2), 3),
+             "timestamp": rng.random()} for i in range(count)]
+
+
+def _random_links(rng, count):
+    return [{"batchId": f"b{i}", "maxUnitsAvailable": rng.randint(0, 12), "allocatedUnits": rng.randint(0, 3),
+             "pricePerUnit": round(rng.uniform(0, 2), 3), "batchTimestamp": rng.random()} for i in range(count)]
+
+
+def test_allocate_fifo_many_matches_sequential_loop():
+    rng = random.Random(7)
+    for _ in range(200):
+        batches = _random_batches(rng, rng.randint(1, 5))
+        quantities = [round(rng.uniform(0.1, 4), 2) for _ in range(rng.randint(1, 6))]
+        many = allocate_fifo_many(batches, quantities)
+
+        stock = [dict(b) for b in batches]
+        for quantity, result in zip(quantities, many):
+            expected = allocate_main_item_fifo(stock, quantity)
+            assert result["success"] == expected["success"]
+            if not expected["success"]:
+                continue
+            assert result["total_price"] == expected["total_price"]
+            assert [(a["batch_id"], a["quantity_micro"]) for a in result["allocation"]] == \
+                   [(a["batch_id"], a["quantity_micro"]) for a in expected["allocation"]]
+            for part in expected["allocation"]:
+                batch = next(b for b in stock if b["batch_id"] == part["batch_id"])
+                batch["remaining_quantity"] = from_micro(to_micro(batch["remaining_quantity"]) - part["quantity_micro"])
+
+
+def test_allocate_selling_units_many_matches_sequential_loop():
+    rng = random.Random(11)
+    for _ in range(200):
+        links = _random_links(rng, rng.randint(1, 4))
+        factor = rng.choice([1, 2, 0.25, 0.333333, 12])
+        requests = [rng.randint(1, 8) for _ in range(rng.randint(1, 5))]
+        many = allocate_selling_units_many(links, requests, factor)
+
+        state = [dict(l) for l in links]
+        for units, result in zip(requests, many):
+            expected = allocate_selling_unit_fifo(state, units, factor)
+            assert result["success"] == expected["success"]
+            if not expected["success"]:
+                continue
+            assert result["total_price"] == expected["total_price"]
+            assert [(a["batch_id"], a["units_taken"], a["main_units_taken_micro"]) for a in result["allocation"]] == \
+                   [(a["batch_id"], a["units_taken"], a["main_units_taken_micro"]) for a in expected["allocation"]]
+            for part in expected["allocation"]:
+                link = next(l for l in state if l["batchId"] == part["batch_id"])
+                link["allocatedUnits"] += part["units_taken"]
+
+
+def test_allocate_fifo_many_prices_cogs_and_rejects_what_does_not_fit():
+    batches = [{"batch_id": "new", "remaining_quantity": 5, "sell_price": 12, "buy_price": 9, "timestamp": 2},
+               {"batch_id": "old", "remaining_quantity": 2, "sell_price": 10, "buy_price": 8, "timestamp": 1}]
+    first, too_big, last = allocate_fifo_many(batches, [3, 10, 4])
+    assert [(a["batch_id"], a["quantity"]) for a in first["allocation"]] == [("old", 2.0), ("new", 1.0)]
+    assert (first["total_price"], first["cogs"], first["margin"]) == (32.0, 25.0, 7.0)
+    assert too_big == {"success": False, "error": "Insufficient stock. Only 4.0 available"}
+    assert last["success"] and last["total_price"] == 48.0
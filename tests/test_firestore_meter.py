@@ -0,0 +1,45 @@
+from firestore_meter import FirestoreMeter, document_size, shop_of, value_size
+from metrics import Registry
+
+
+def test_sizes_follow_storage_rules():
+    assert value_size("abc") == 4
+    assert value_size(3) == value_size(1.5) == 8
+    assert value_size(None) == value_size(True) == 1
+    assert value_size({"a": "bc", "n": [1, 2]}) == (2 + 3) + (2 + 16)
+    assert document_size("Shops/s1", {"a": 1}) == len("Shops/s1") + 1 + 32 + 2 + 8
+
+
+def test_shop_of_path():
+    assert shop_of("Shops/s1/categories/c1") == "s1"
+    assert shop_of("Users/u1") is None
+    assert shop_of(None) is None
+
+
+def test_nested_scopes_both_count_and_source_is_innermost():
+    registry = Registry()
+    meter = FirestoreMeter(registry, measure_bytes=False)
+    with meter.scope("request") as outer:
+        meter.charge("read", [("Shops/s1/items/a", {}), ("Shops/s1/items/b", {})])
+        with meter.scope("reload") as inner:
+            meter.charge("write", [("Shops/s1/items/a", {"q": 1})])
+    meter.charge("delete", [("Shops/s2/items/c", None)])
+
+    assert outer.totals()["read"] == 2 and outer.totals()["write"] == 1
+    assert inner.totals()["read"] == 0 and inner.totals()["write"] == 1
+    assert meter.current() is None
+    assert meter.documents.value("request", "read") == 2
+    assert meter.documents.value("reload", "write") == 1
+    assert meter.documents.value("background", "delete") == 1
+
+
+def test_shop_label_is_capped_to_the_costliest_shops():
+    registry = Registry()
+    meter = FirestoreMeter(registry, measure_bytes=False, shop_label_limit=2)
+    for shop, reads in (("big", 10), ("mid", 5), ("small", 2), ("tiny", 1)):
+        meter.charge("read", [(f"Shops/{shop}/items/{n}", {}) for n in range(reads)])
+
+    [(name, kind, _, samples)] = list(meter.shop_samples())
+    assert (name, kind) == ("firestore_shop_documents_total", "counter")
+    assert {labels["shop"]: value for labels, value in samples} == {"big": 10, "mid": 5, "other": 3}
+    assert 'firestore_shop_documents_total{shop="other",kind="read"} 3' in registry.render()
@@ -0,0 +1,48 @@
+from fractions import Fraction
+
+import numpy as np
+import pytest
+
+from fixed_point import (div_ratio, from_micro, from_micro_array, from_minor, line_total_minor, mul_ratio, ratio,
+                         to_micro, to_micro_array, to_minor)
+
+
+def test_micro_and_minor_round_trip():
+    assert to_micro(1.5) == 1_500_000
+    assert to_micro("0.000001") == 1
+    assert from_micro(2_250_000) == 2.25
+    assert to_minor(19.99) == 1999
+    assert from_minor(1999) == 19.99
+    assert to_micro_array([0.1, 0.2]).tolist() == [100_000, 200_000]
+    assert np.allclose(from_micro_array([100_000]), [0.1])
+
+
+def test_ratio_is_the_exact_decimal():
+    assert ratio(0.25) == Fraction(1, 4)
+    assert ratio("0.25") == Fraction(1, 4)
+    assert ratio(0.333333) == Fraction(333333, 1000000)  # not snapped to 1/3
+    assert ratio(3) == 3
+    assert ratio(Fraction(1, 3)) == Fraction(1, 3)
+
+
+def test_mul_and_div_ratio_rounding():
+    third = Fraction(1, 3)
+    assert mul_ratio(1_000_000, third) == 333_333
+    assert mul_ratio(2_000_000, third) == 666_667
+    assert mul_ratio(2_000_000, third, "floor") == 666_666
+    assert mul_ratio(1_000_000, third, "ceil") == 333_334
+    assert div_ratio(mul_ratio(3_000_000, third), third) == 3_000_000
+    assert div_ratio(1_000_000, "0.25") == 4_000_000
+
+
+def test_div_ratio_rejects_non_positive_factor():
+    with pytest.raises(ValueError):
+        div_ratio(1, 0)
+
+
+def test_line_total_rounds_once_at_the_exact_price():
+    # 3 × 0.335 = 1.005 → 101 cents; rounding the price first would give 3 × 34 = 102
+    assert line_total_minor(3_000_000, 0.335) == 101
+    assert line_total_minor(3_000_000, "0.335") == 101
+    assert line_total_minor(500_000, 0.01) == 1  # half a cent rounds up
+    assert line_total_minor(1_000_000, None) == 0
@@ -0,0 +1,81 @@
+import threading
+import time
+
+import pytest
+
+from group_commit import GroupCommitter
+
+
+def test_concurrent_submits_share_one_commit_and_get_their_own_outcome():
+    commits = []
+
+    def commit_group(key, payloads):
+        commits.append((key, list(payloads)))
+        return [ValueError(p) if p == "bad" else p.upper() for p in payloads]
+
+    committer = GroupCommitter("t", commit_group, window=0.2, max_group=3)
+    outcomes = {}
+
+    def submit(payload):
+        try:
+            outcomes[payload] = committer.submit("shop", payload)
+        except ValueError as e:
+            outcomes[payload] = e
+
+    threads = [threading.Thread(target=submit, args=(p,)) for p in ("a", "b", "bad")]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+
+    assert len(commits) == 1 and sorted(commits[0][1]) == ["a", "b", "bad"]
+    assert outcomes["a"] == "A" and outcomes["b"] == "B"
+    assert isinstance(outcomes["bad"], ValueError)
+    assert committer.stats()["largest_group"] == 3
+
+
+def test_failing_commit_raises_in_every_caller():
+    def commit_group(key, payloads):
+        raise RuntimeError("commit failed")
+
+    committer = GroupCommitter("t", commit_group, window=0)
+    with pytest.raises(RuntimeError):
+        committer.submit("shop", 1)
+    assert committer.submit_many("shop", [1, 2])[1].args == ("commit failed",)
+    assert committer.stats()["failed_groups"] == 2
+
+
+def test_wrong_number_of_outcomes_fails_the_group():
+    committer = GroupCommitter("t", lambda key, payloads: [], window=0)
+    with pytest.raises(RuntimeError):
+        committer.submit("shop", 1)
+
+
+def test_groups_of_one_key_never_commit_concurrently():
+    active, overlaps = [0], []
+    lock = threading.Lock()
+
+    def commit_group(key, payloads):
+        with lock:
+            active[0] += 1
+            overlaps.append(active[0])
+        time.sleep(0.01)
+        with lock:
+            active[0] -= 1
+        return payloads
+
+    committer = GroupCommitter("t", commit_group, window=0, max_group=1)
+    threads = [threading.Thread(target=committer.submit, args=("shop", n)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    assert max(overlaps) == 1
+    assert committer.stats()["groups"] == 8
+
+
+def test_submit_many_commits_at_once_without_the_window():
+    committer = GroupCommitter("t", lambda key, payloads: [p * 2 for p in payloads], window=5)
+    start = time.time()
+    assert committer.submit_many("shop", [1, 2, 3]) == [2, 4, 6]
+    assert time.time() - start < 1
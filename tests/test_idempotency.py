@@ -0,0 +1,92 @@
+import threading
+import time
+
+import pytest
+
+from idempotency import IdempotencyConflict, IdempotencyTable
+
+
+def test_first_call_runs_and_retry_replays():
+    calls = []
+    table = IdempotencyTable("t")
+
+    def handle(value):
+        calls.append(value)
+        return {"sold": value}, 200
+
+    assert table.run("k", "fp", handle, 1) == (({"sold": 1}, 200), False)
+    assert table.run("k", "fp", handle, 1) == (({"sold": 1}, 200), True)
+    assert calls == [1]
+
+
+def test_reused_key_with_other_body_conflicts():
+    table = IdempotencyTable("t")
+    table.run("k", "fp-a", lambda: ("ok", 200))
+    with pytest.raises(IdempotencyConflict):
+        table.run("k", "fp-b", lambda: ("ok", 200))
+    assert table.stats()["conflicts"] == 1
+
+
+def test_duplicate_waits_for_running_attempt():
+    started, release = threading.Event(), threading.Event()
+    calls = []
+    table = IdempotencyTable("t")
+
+    def slow():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return "done", 200
+
+    first = threading.Thread(target=table.run, args=("k", "fp", slow))
+    first.start()
+    started.wait(5)
+    results = []
+    second = threading.Thread(target=lambda: results.append(table.run("k", "fp", slow)))
+    second.start()
+    time.sleep(0.05)
+    release.set()
+    first.join(5)
+    second.join(5)
+
+    assert calls == [1]
+    assert results == [(("done", 200), True)]
+    assert table.stats()["waited"] == 1
+
+
+def test_unstorable_response_lets_retry_run_again():
+    table = IdempotencyTable("t", storable=lambda response: response[1] < 500)
+    assert table.run("k", "fp", lambda: ("boom", 500))[1] is False
+    assert table.run("k", "fp", lambda: ("ok", 200)) == (("ok", 200), False)
+
+
+def test_exception_is_not_stored():
+    table = IdempotencyTable("t")
+
+    def fail():
+        raise RuntimeError("down")
+
+    with pytest.raises(RuntimeError):
+        table.run("k", "fp", fail)
+    assert table.run("k", "fp", lambda: "ok") == ("ok", False)
+
+
+def test_completed_keys_expire_and_are_bounded():
+    table = IdempotencyTable("t", ttl=0.05, max_entries=2)
+    for key in ("a", "b", "c"):
+        table.run(key, "fp", lambda: "ok")
+    assert table.stats()["stored"] == 2  # "a" evicted by the bound
+
+    time.sleep(0.06)
+    assert table.run("b", "fp", lambda: "again") == ("again", False)  # expired: runs again
+
+
+def test_claim_and_complete_for_many_keys():
+    table = IdempotencyTable("t")
+    entry, owner = table.claim("k", "fp")
+    assert owner
+    other, other_owner = table.claim("k", "fp")
+    assert not other_owner and other is entry
+
+    table.complete("k", entry, ("ok", 200))
+    assert table.wait(other) == ("ok", 200)
@@ -0,0 +1,122 @@
+import threading
+import time
+
+import pytest
+
+from job_queue import BatchJobQueue, QueueFull
+
+
+def wait_for(pipeline, job_id, statuses=("done", "failed", "superseded"), timeout=5.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        job = pipeline.status(job_id)
+        if job["status"] in statuses:
+            return job
+        time.sleep(0.01)
+    raise AssertionError(f"job {job_id} still {pipeline.status(job_id)['status']}")
+
+
+def test_batches_jobs_and_returns_results():
+    seen = []
+
+    def process(jobs):
+        seen.append(len(jobs))
+        return [job["payload"] * 2 for job in jobs]
+
+    pipeline = BatchJobQueue("t", process, workers=1, batch_size=4, batch_wait=0.2)
+    job_ids = [pipeline.submit(n) for n in range(4)]
+    results = [wait_for(pipeline, job_id)["result"] for job_id in job_ids]
+
+    assert results == [0, 2, 4, 6]
+    assert sum(seen) == 4
+    assert pipeline.stats()["succeeded"] == 4
+
+
+def test_per_job_exception_retries_then_fails():
+    attempts = []
+
+    def process(jobs):
+        attempts.append(len(jobs))
+        return [ValueError("boom") for _ in jobs]
+
+    pipeline = BatchJobQueue("t", process, workers=1, max_attempts=2, retry_backoff=0.01)
+    job = wait_for(pipeline, pipeline.submit("x"))
+
+    assert job["status"] == "failed"
+    assert job["attempts"] == 2
+    assert job["error"] == "boom"
+
+
+def test_dedupe_merges_queued_jobs():
+    gate = threading.Event()
+    payloads = []
+
+    def process(jobs):
+        gate.wait(5)
+        payloads.extend(job["payload"] for job in jobs)
+        return [None for _ in jobs]
+
+    pipeline = BatchJobQueue("t", process, workers=1, batch_size=1)
+    blocker = pipeline.submit("blocker")
+    time.sleep(0.1)  # blocker is running, the next two wait in the queue
+    first = pipeline.submit("old", dedupe_key="k")
+    second = pipeline.submit("new", dedupe_key="k")
+    gate.set()
+
+    assert first == second
+    wait_for(pipeline, first)
+    wait_for(pipeline, blocker)
+    assert payloads == ["blocker", "new"]
+    assert pipeline.stats()["deduplicated"] == 1
+
+
+def test_retrying_job_keeps_its_dedupe_key():
+    calls = []
+
+    def process(jobs):
+        calls.extend(job["payload"] for job in jobs)
+        return [RuntimeError("transient") if len(calls) == 1 else job["payload"] for job in jobs]
+
+    pipeline = BatchJobQueue("t", process, workers=1, retry_backoff=0.3)
+    job_id = pipeline.submit("v1", dedupe_key="k")
+    time.sleep(0.1)  # first attempt failed, job is waiting to retry
+    assert pipeline.status(job_id)["status"] == "retrying"
+
+    assert pipeline.submit("v2", dedupe_key="k") == job_id
+    job = wait_for(pipeline, job_id)
+    assert job["status"] == "done"
+    assert job["result"] == "v2"
+    assert calls == ["v1", "v2"]
+
+
+def test_failed_attempt_yields_to_newer_submit():
+    started = threading.Event()
+    release = threading.Event()
+
+    def process(jobs):
+        if jobs[0]["payload"] == "old":
+            started.set()
+            release.wait(5)
+            return [RuntimeError("stale")]
+        return ["ok"]
+
+    pipeline = BatchJobQueue("t", process, workers=1, retry_backoff=0.01)
+    old = pipeline.submit("old", dedupe_key="k")
+    started.wait(5)
+    new = pipeline.submit("new", dedupe_key="k")  # old is running, so this is a new job
+    release.set()
+
+    assert new != old
+    assert wait_for(pipeline, old)["status"] == "superseded"
+    assert wait_for(pipeline, new)["result"] == "ok"
+
+
+def test_submit_raises_when_full():
+    gate = threading.Event()
+    pipeline = BatchJobQueue("t", lambda jobs: [gate.wait(5) for _ in jobs], workers=1, batch_size=1, max_queue=1)
+    pipeline.submit(1)
+    time.sleep(0.1)
+    pipeline.submit(2)
+    with pytest.raises(QueueFull):
+        pipeline.submit(3)
+    gate.set()
@@ -0,0 +1,73 @@
+import pytest
+
+from metrics import Registry, span, span_errors, span_seconds, timed
+
+
+def test_counter_and_gauge_render_with_labels():
+    registry = Registry()
+    hits = registry.counter("cache_hits_total", "Cache hits", ("cache",))
+    depth = registry.gauge("queue_depth", "Jobs waiting")
+    hits.inc("shop")
+    hits.inc("shop", amount=2)
+    depth.set(value=5)
+    depth.dec()
+
+    assert hits.value("shop") == 3 and hits.value("item") == 0
+    text = registry.render()
+    assert "# TYPE cache_hits_total counter" in text
+    assert 'cache_hits_total{cache="shop"} 3' in text
+    assert "queue_depth 4" in text
+
+
+def test_histogram_buckets_are_cumulative():
+    registry = Registry()
+    latency = registry.histogram("latency_seconds", "Latency", ("route",), buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 0.5, 3.0):
+        latency.observe(value, "/sales")
+
+    lines = registry.render().splitlines()
+    assert 'latency_seconds_bucket{route="/sales",le="0.1"} 1' in lines
+    assert 'latency_seconds_bucket{route="/sales",le="1"} 3' in lines
+    assert 'latency_seconds_bucket{route="/sales",le="+Inf"} 4' in lines
+    assert 'latency_seconds_sum{route="/sales"} 4.05' in lines
+    assert 'latency_seconds_count{route="/sales"} 4' in lines
+
+
+def test_label_values_are_escaped():
+    registry = Registry()
+    registry.counter("odd_total", "Odd labels", ("name",)).inc('a"b\\c\nd')
+    assert 'odd_total{name="a\\"b\\\\c\\nd"} 1' in registry.render()
+
+
+def test_collectors_are_read_at_scrape_time_and_failures_are_contained():
+    registry = Registry()
+    state = {"size": 1}
+
+    @registry.collector
+    def cache_size():
+        yield "cache_entries", "gauge", "Entries", [({"cache": "shop"}, state["size"])]
+
+    @registry.collector
+    def broken():
+        raise RuntimeError("boom")
+
+    state["size"] = 7
+    text = registry.render()
+    assert 'cache_entries{cache="shop"} 7' in text
+    assert "# collector broken failed: boom" in text
+
+
+def test_span_and_timed_record_duration_and_errors():
+    @timed("test_timed")
+    def work():
+        return "done"
+
+    before = span_errors.value("test_span")
+    assert work() == "done"
+    with pytest.raises(ValueError):
+        with span("test_span"):
+            raise ValueError
+    assert span_errors.value("test_span") == before + 1
+    rendered = "\n".join(span_seconds.render())
+    assert 'app_span_seconds_count{span="test_timed"}' in rendered
+    assert 'app_span_seconds_count{span="test_span"}' in rendered
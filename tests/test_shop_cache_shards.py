@@ -0,0 +1,25 @@
+def _cached_milk(app_module, shop_id):
+    milk = app_module.find_item_in_cache(shop_id, "milk")
+    return milk["stock"], {batch["batch_id"]: batch["quantity"] for batch in milk["batches"]}
+
+
+def test_shards_written_before_the_load_are_counted(app_module, firestore_db, shop):
+    firestore_db.write(f"Shops/{shop}/items/milk/stockShards/3", {"stock": -3, "batches": {"b1": -1, "b2": -2}})
+
+    app_module.acquire_shop_index(shop)
+
+    assert _cached_milk(app_module, shop) == (7, {"b1": 3, "b2": 4})
+
+
+def test_shard_changes_patch_the_cached_item(app_module, firestore_db, shop):
+    app_module.acquire_shop_index(shop)  # loads the shop and subscribes its listeners
+
+    firestore_db.write(f"Shops/{shop}/items/milk/stockShards/0", {"stock": -2, "batches": {"b1": -2}})
+    assert _cached_milk(app_module, shop) == (8, {"b1": 2, "b2": 6})
+
+    firestore_db.write(f"Shops/{shop}/items/milk/stockShards/0", {"stock": -3, "batches": {"b1": -3}})
+    firestore_db.write(f"Shops/{shop}/items/milk/stockShards/1", {"stock": -1, "batches": {"b2": -1}})
+    assert _cached_milk(app_module, shop) == (6, {"b1": 1, "b2": 5})
+
+    firestore_db.delete(f"Shops/{shop}/items/milk/stockShards/1")
+    assert _cached_milk(app_module, shop) == (7, {"b1": 1, "b2": 6})
@@ -0,0 +1,23 @@
+import numpy as np
+
+
+def test_listener_patches_keep_vectors_upserted_at_vectorize_time(app_module, firestore_db, shop, monkeypatch):
+    milk_vector, bread_vector = np.eye(4, dtype=np.float32)[:2]
+    app_module.acquire_shop_index(shop)
+
+    monkeypatch.setattr(app_module, "load_item_image", lambda target: "image")
+    monkeypatch.setattr(app_module, "embed_images", lambda images: [milk_vector for _ in images])
+    app_module.vectorize_and_store([{"shop_id": shop, "category_id": "dairy", "item_id": "milk", "image_index": 0}])
+
+    # A new item arrives through the items listener, then goes away again
+    firestore_db.write(f"Shops/{shop}/categories/dairy/items/bread/embeddings/0", {"vector": bread_vector.tolist()})
+    firestore_db.write(f"Shops/{shop}/categories/dairy/items/bread", {"name": "Bread", "stock": 5})
+    vectors = app_module.get_shop_search_index(shop)["vectors"]
+    assert len(vectors) == 2
+    assert vectors.search(milk_vector, k=1)[0][0] == "milk"
+    assert vectors.search(bread_vector, k=1)[0][0] == "bread"
+
+    firestore_db.delete(f"Shops/{shop}/categories/dairy/items/bread")
+    vectors = app_module.get_shop_search_index(shop)["vectors"]
+    assert len(vectors) == 1
+    assert vectors.search(milk_vector, k=1)[0][0] == "milk"
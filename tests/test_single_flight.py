@@ -0,0 +1,102 @@
+import threading
+import time
+
+import pytest
+
+from single_flight import SingleFlight
+
+
+def _wait_for_waiters(flights, key, count):
+    deadline = time.time() + 5
+    while flights.in_flight().get(key, -1) < count:
+        assert time.time() < deadline, "waiters never joined"
+        time.sleep(0.001)
+
+
+def test_concurrent_callers_share_one_fetch():
+    flights = SingleFlight("t")
+    release = threading.Event()
+    calls = []
+
+    def fetch(key):
+        calls.append(key)
+        release.wait(5)
+        return {"shop": key}
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(flights.do("s1", fetch, "s1"))) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    _wait_for_waiters(flights, "s1", 4)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert calls == ["s1"]
+    assert results == [{"shop": "s1"}] * 5
+    stats = flights.stats()
+    assert (stats["calls"], stats["fetches"], stats["coalesced"], stats["in_flight"]) == (5, 1, 4, 0)
+
+
+def test_waiters_receive_the_leaders_exception():
+    flights = SingleFlight("t")
+    release = threading.Event()
+
+    def fetch():
+        release.wait(5)
+        raise RuntimeError("firestore down")
+
+    errors = []
+
+    def call():
+        try:
+            flights.do("k", fetch)
+        except RuntimeError as e:
+            errors.append(str(e))
+
+    threads = [threading.Thread(target=call) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    _wait_for_waiters(flights, "k", 2)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert errors == ["firestore down"] * 3
+    assert flights.stats()["failures"] == 1
+
+
+def test_next_call_after_a_flight_fetches_again():
+    flights = SingleFlight("t")
+    counter = iter(range(10))
+    assert flights.do("k", lambda: next(counter)) == 0
+    assert flights.do("k", lambda: next(counter)) == 1
+    with pytest.raises(ValueError):
+        flights.do("k", lambda: int("x"))
+    assert flights.do("k", lambda: next(counter)) == 2
+
+
+def test_fresh_waits_for_the_running_flight_then_fetches():
+    flights = SingleFlight("t")
+    release = threading.Event()
+    versions = iter(["stale", "fresh"])
+
+    def fetch():
+        release.wait(5)
+        return next(versions)
+
+    stale = []
+    leader = threading.Thread(target=lambda: stale.append(flights.do("k", fetch)))
+    leader.start()
+    while not flights.in_flight():
+        time.sleep(0.001)
+    fresh = []
+    follower = threading.Thread(target=lambda: fresh.append(flights.do("k", fetch, fresh=True)))
+    follower.start()
+    time.sleep(0.02)
+    release.set()
+    leader.join(5)
+    follower.join(5)
+
+    assert stale == ["stale"] and fresh == ["fresh"]
+    assert flights.stats()["fetches"] == 2
@@ -0,0 +1,48 @@
+import pytest
+
+from stock_shards import WriteRateTracker, apply_shard_totals, shard_count, shard_totals
+
+
+def test_shard_count_tolerates_missing_or_bad_values():
+    assert shard_count({"stockShards": 4}) == 4
+    assert shard_count({"stockShards": "2"}) == 2
+    assert shard_count({"stockShards": -1}) == 0
+    assert shard_count({"stockShards": "many"}) == 0
+    assert shard_count(None) == 0
+
+
+def test_shard_totals_sum_exactly():
+    shards = [{"stock": -0.1, "batches": {"b1": -0.1}},
+              None,
+              {"stock": -0.2, "batches": {"b1": -0.05, "b2": -0.15}}]
+    assert shard_totals(shards) == (-300_000, {"b1": -150_000, "b2": -150_000})
+
+
+def test_apply_shard_totals_adds_deltas_to_a_copy():
+    item = {"name": "Milk", "stock": 10, "batches": [{"id": "b1", "quantity": 4}, {"id": "b2", "quantity": 6}]}
+    summed = apply_shard_totals(item, [{"stock": -1.5, "batches": {"b2": -1.5}}])
+    assert summed["stock"] == 8.5
+    assert summed["batches"] == [{"id": "b1", "quantity": 4}, {"id": "b2", "quantity": 4.5}]
+    assert item["stock"] == 10 and item["batches"][1]["quantity"] == 6
+    assert apply_shard_totals(item, [{}]) is item
+
+
+def test_write_rate_decays_and_ranks_hottest():
+    tracker = WriteRateTracker(window=10.0)
+    for n in range(50):
+        tracker.record("hot", now=100 + n * 0.1)
+    tracker.record("cold", now=104.9)
+    assert tracker.rate("hot", now=105) > tracker.rate("cold", now=105)
+    assert tracker.rate("hot", now=105) == pytest.approx(3.93, abs=0.05)
+    assert tracker.rate("hot", now=135) < tracker.rate("hot", now=105) / 10
+    assert [entry["key"] for entry in tracker.hottest(2, now=105)] == ["hot", "cold"]
+
+
+def test_write_rate_tracker_keeps_only_the_busiest_keys():
+    tracker = WriteRateTracker(window=10.0, max_keys=4)
+    for _ in range(3):
+        tracker.record("busy", now=0)
+    for n in range(5):
+        tracker.record(f"k{n}", now=0)
+    keys = [entry["key"] for entry in tracker.hottest(10, now=0)]
+    assert keys[0] == "busy" and len(keys) <= 4
@@ -0,0 +1,111 @@
+import numpy as np
+import pytest
+
+from vector_index import ShopVectorIndex, l2_normalize
+
+
+def _unit(*values):
+    return np.array(values, dtype=np.float32)
+
+
+def test_item_scores_as_its_best_photo():
+    index = ShopVectorIndex.from_rows([
+        ("milk", "0", _unit(1, 0, 0)),
+        ("milk", "1", _unit(0, 1, 0)),
+        ("bread", "0", _unit(0.6, 0.8, 0)),
+        ("soap", "0", _unit(0, 0, 1)),
+    ])
+    results = index.search(_unit(0, 2, 0), k=2)
+    assert [item for item, _ in results] == ["milk", "bread"]
+    assert results[0][1] == pytest.approx(1.0)
+    assert results[1][1] == pytest.approx(0.8)
+    assert index.search(_unit(0, 1, 0), k=5, min_score=0.5) == [("milk", pytest.approx(1.0)),
+                                                                 ("bread", pytest.approx(0.8))]
+
+
+def test_upsert_replaces_and_remove_item_hides_rows():
+    index = ShopVectorIndex.from_rows([("milk", "0", _unit(1, 0, 0)), ("soap", "0", _unit(0, 0, 1))])
+    index.upsert("milk", "0", _unit(0, 0, 1))
+    assert len(index) == 2
+    assert index.search(_unit(1, 0, 0), k=5, min_score=0.5) == []
+    assert sorted(item for item, _ in index.search(_unit(0, 0, 1), k=5)) == ["milk", "soap"]
+
+    index.remove_item("soap")
+    assert [item for item, _ in index.search(_unit(0, 0, 1), k=5)] == ["milk"]
+    assert index.stats()["dead_rows"] == 2
+
+
+def test_upsert_grows_past_capacity_and_rejects_other_dimensions():
+    index = ShopVectorIndex()
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(size=(150, 8)).astype(np.float32)
+    for n, vector in enumerate(vectors):
+        index.upsert(f"item{n}", "0", vector)
+    assert len(index) == 150
+    assert index.search(vectors[123], k=1)[0][0] == "item123"
+    with pytest.raises(ValueError):
+        index.upsert("bad", "0", np.ones(4))
+    with pytest.raises(ValueError):
+        index.search(np.ones(4))
+
+
+def test_from_rows_skips_other_dimensions_and_accepts_float16():
+    index = ShopVectorIndex.from_rows([("a", "0", np.array([3, 4], dtype=np.float16)),
+                                       ("b", "0", np.ones(3))])
+    assert len(index) == 1
+    assert np.allclose(np.linalg.norm(l2_normalize([[3, 4]])), 1.0)
+    assert index.search([1, 0], k=1) == [("a", pytest.approx(0.6))]
+
+
+def _clustered(rng, clusters=16, per_cluster=40, dim=16):
+    centres = l2_normalize(rng.normal(size=(clusters, dim)))
+    rows = []
+    for c, centre in enumerate(centres):
+        for n in range(per_cluster):
+            rows.append((f"item{c}-{n}", "0", centre + 0.05 * rng.normal(size=dim)))
+    return rows
+
+
+def test_ivf_with_every_list_probed_matches_exact_search():
+    rng = np.random.default_rng(1)
+    index = ShopVectorIndex.from_rows(_clustered(rng))
+    queries = rng.normal(size=(20, 16))
+    exact = [index.search(q, k=5) for q in queries]
+
+    index.build_ivf(nlist=16, seed=0)
+    assert index.stats()["ivf_lists"] == 16
+    for query, expected in zip(queries, exact):
+        assert [item for item, _ in index.search(query, k=5, nprobe=16)] == [item for item, _ in expected]
+        assert [item for item, _ in index.search(query, k=5, exact=True)] == [item for item, _ in expected]
+
+
+def test_ivf_recall_on_clustered_data_and_upserts_are_assigned():
+    rng = np.random.default_rng(2)
+    rows = _clustered(rng)
+    index = ShopVectorIndex.from_rows(rows, nprobe=2)
+    index.build_ivf(nlist=16, seed=0)
+
+    hits = sum(index.search(vector, k=1)[0][0] == item_id for item_id, _, vector in rows[::7])
+    assert hits == len(rows[::7])
+
+    index.upsert("new", "0", rows[0][2])
+    assert "new" in [item for item, _ in index.search(rows[0][2], k=2)]
+
+
+def test_save_and_load_keep_vectors_and_quantiser(tmp_path):
+    rng = np.random.default_rng(3)
+    index = ShopVectorIndex.from_rows(_clustered(rng, clusters=4, per_cluster=10), nprobe=3)
+    index.build_ivf(nlist=4, seed=0)
+    path = tmp_path / "shop.npz"
+    index.save(path)
+
+    loaded = ShopVectorIndex.load(path)
+    assert len(loaded) == len(index) and loaded.nprobe == 3
+    assert np.allclose(loaded.centroids, index.centroids)
+    query = rng.normal(size=16)
+    expected = index.search(query, k=3)
+    assert [item for item, _ in loaded.search(query, k=3)] == [item for item, _ in expected]
+
+    index.save(path, include_vectors=False)
+    quantiser_only = ShopVectorIndex.load(path)
+    assert len(quantiser_only) == 0 and quantiser_only.centroids is not None
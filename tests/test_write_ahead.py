@@ -0,0 +1,95 @@
+import json
+import os
+import time
+
+import pytest
+
+from write_ahead import WriteAheadQueue
+
+
+class Store:
+    def __init__(self):
+        self.docs = {}
+        self.fail = False
+
+    def write(self, records):
+        if self.fail:
+            raise RuntimeError("store down")
+        for record in records:
+            self.docs[record["path"]] = record["data"]
+
+
+def make_queue(directory, store, **kwargs):
+    kwargs.setdefault("flush_interval", 3600)  # tests flush by hand
+    return WriteAheadQueue(str(directory), store.write, prefix="t", **kwargs)
+
+
+def read_log(queue):
+    with open(queue._log_path(os.getpid()), encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_relative_directory_is_rejected():
+    with pytest.raises(ValueError):
+        WriteAheadQueue("relative/wal", lambda records: None)
+
+
+def test_append_logs_before_flush_and_truncates_after(tmp_path):
+    store = Store()
+    queue = make_queue(tmp_path, store)
+    queue.append([{"path": "a/1", "data": {"n": 1}}, {"path": "a/2", "data": {"n": 2}}])
+
+    assert [r["path"] for r in read_log(queue)] == ["a/1", "a/2"]
+    assert queue.is_pending("a/1")
+    assert store.docs == {}
+
+    queue.flush()
+    assert store.docs == {"a/1": {"n": 1}, "a/2": {"n": 2}}
+    assert not queue.is_pending("a/1")
+    assert read_log(queue) == []
+    assert queue.stats()["pending"] == 0
+
+
+def test_failed_flush_keeps_records_pending(tmp_path):
+    store = Store()
+    queue = make_queue(tmp_path, store)
+    queue.append([{"path": "a/1", "data": {}}])
+
+    store.fail = True
+    with pytest.raises(RuntimeError):
+        queue.flush()
+    assert queue.is_pending("a/1")
+    assert len(read_log(queue)) == 1
+
+    store.fail = False
+    queue.flush()
+    assert "a/1" in store.docs and not queue.is_pending("a/1")
+
+
+def test_background_flush_respects_max_batch(tmp_path):
+    sizes = []
+    queue = WriteAheadQueue(str(tmp_path), lambda records: sizes.append(len(records)),
+                            prefix="t", max_batch=2, flush_interval=0.01)
+    queue.append([{"path": f"a/{n}", "data": {}} for n in range(5)])
+
+    deadline = time.time() + 5
+    while queue.stats()["pending"] and time.time() < deadline:
+        time.sleep(0.01)
+    assert sizes == [2, 2, 1]
+
+
+def test_start_replays_logs_of_dead_processes(tmp_path):
+    dead_pid = 2 ** 22 + 12345  # above the default pid_max, so never alive
+    with open(tmp_path / f"t-{dead_pid}.log", "w", encoding="utf-8") as f:
+        f.write(json.dumps({"path": "a/1", "data": {"n": 1}}) + "\n")
+        f.write('{"path": "a/2", "da')  # torn write of a crash: never acknowledged
+
+    store = Store()
+    queue = make_queue(tmp_path, store)
+    queue.start()
+    assert queue.stats()["replayed"] == 1
+    assert queue.is_pending("a/1")
+
+    queue.flush()
+    assert store.docs == {"a/1": {"n": 1}}
+    assert not any(name.endswith((".claim", f"-{dead_pid}.log")) for name in os.listdir(tmp_path))
@@ -0,0 +1,302 @@
+"""
+In-memory image-embedding index for one shop.
+
+All embedding vectors of a shop live in one contiguous, L2-normalised float32
+matrix, so an exact query is a single matrix-vector product. Items may have
+several embeddings (one per photo); an item scores as its best matching photo.
+
+Large catalogues can add an IVF layer (spherical k-means coarse quantiser +
+inverted lists): a query only scores the rows of the `nprobe` lists whose
+centroids are closest, trading a little recall for sub-linear work.
+
+Updates are incremental: new rows are appended into spare capacity that no
+reader can see yet, then a new view is published in one assignment. Readers
+therefore never lock and never observe a half-written row.
+"""
+import threading
+
+import numpy as np
+
+
+def l2_normalize(vectors):
+    """Row-wise L2 normalisation to float32 (zero rows stay zero)"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def assign_to_centroids(vectors, centroids, chunk=8192):
+    """Nearest centroid (max cosine) per row, in chunks to bound memory"""
+    labels = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), chunk):
+        labels[start:start + chunk] = np.argmax(vectors[start:start + chunk] @ centroids.T, axis=1)
+    return labels
+
+
+def train_kmeans(vectors, nlist, iterations=10, sample_per_list=256, seed=0):
+    """
+    Spherical k-means on normalised vectors → (nlist, dim) unit centroids.
+    Trains on at most nlist * sample_per_list rows; empty lists are reseeded.
+    """
+    rng = np.random.default_rng(seed)
+    if len(vectors) > nlist * sample_per_list:
+        vectors = vectors[rng.choice(len(vectors), nlist * sample_per_list, replace=False)]
+    nlist = min(nlist, len(vectors))
+    centroids = vectors[rng.choice(len(vectors), nlist, replace=False)].copy()
+
+    for _ in range(iterations):
+        labels = assign_to_centroids(vectors, centroids)
+        order = np.argsort(labels, kind="stable")
+        counts = np.bincount(labels, minlength=nlist)
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        sums = np.zeros_like(centroids)
+        filled = counts > 0
+        sums[filled] = np.add.reduceat(vectors[order], starts[filled], axis=0)
+        empty = np.flatnonzero(~filled)
+        if len(empty):
+            sums[empty] = vectors[rng.choice(len(vectors), len(empty), replace=False)]
+        centroids = l2_normalize(sums)
+    return centroids
+
+
+class ShopVectorIndex:
+    """
+        index = ShopVectorIndex.from_rows([(item_id, embedding_key, vector), ...])
+        index.build_ivf(nlist=None)                 # optional, for big catalogues
+        index.search(query_vector, k=10)            # -> [(item_id, cosine_similarity), ...]
+        index.search(query_vector, k=10, nprobe=32) # more lists: higher recall, slower
+        index.upsert(item_id, embedding_key, vector)
+        index.remove_item(item_id)
+        index.save(path) / ShopVectorIndex.load(path)
+    """
+
+    def __init__(self, dim=None, capacity=64, nprobe=8):
+        self.dim = dim
+        self.nprobe = nprobe
+        self.centroids = None            # (nlist, dim) once build_ivf ran
+        self.trained_on = 0              # vectors in the index when the centroids were trained
+        self._lock = threading.Lock()
+        self._buffer = np.zeros((capacity, dim), dtype=np.float32) if dim else None
+        self._assign = np.zeros(capacity, dtype=np.int32)  # row -> inverted list
+        self._used = 0                   # rows written into _buffer
+        self._rows = {}                  # (item_id, embedding_key) -> row
+        self._row_keys = []              # row -> (item_id, embedding_key), None when dead
+        self._dead = 0
+        self._view = {                   # published view, replaced atomically
+            "matrix": np.zeros((0, dim or 0), dtype=np.float32),
+            "owners": [],
+            "dead": np.zeros(0, dtype=bool),
+            "per_item": 0,
+            "lists": None                # tuple of row-id arrays when IVF is built
+        }
+
+    @classmethod
+    def from_rows(cls, rows, nprobe=8):
+        """
+        Build from (item_id, embedding_key, vector) rows. Vectors of any float
+        dtype (e.g. float16 views from embedding_codec) are cast straight into
+        the preallocated float32 matrix and normalised in place.
+        """
+        rows = [(item_id, key, np.asarray(vector).ravel()) for item_id, key, vector in rows]
+        if not rows:
+            return cls(nprobe=nprobe)
+        index = cls(dim=rows[0][2].shape[0], capacity=max(64, len(rows)), nprobe=nprobe)
+
+        used = 0
+        for item_id, key, vector in rows:
+            if vector.shape[0] != index.dim:
+                continue  # other model / dimension
+            index._buffer[used] = vector
+            index._row_keys.append((item_id, key))
+            used += 1
+
+        matrix = index._buffer[:used]
+        matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+        index._used = used
+        index._rows = {row_key: n for n, row_key in enumerate(index._row_keys)}
+        index._publish()
+        return index
+
+    def __len__(self):
+        return len(self._rows)
+
+    # ---------- IVF ----------
+    def build_ivf(self, nlist=None, iterations=10, centroids=None, seed=0):
+        """
+        Partition the vectors into nlist inverted lists (default ~sqrt(N)).
+        Pass centroids to reuse a previously trained quantiser and skip k-means.
+        """
+        with self._lock:
+            live = self._buffer[:self._used] if self._buffer is not None else None
+            if live is None or not len(self._rows):
+                return
+            if centroids is None:
+                nlist = nlist or max(1, int(round(np.sqrt(len(self._rows)))))
+                alive = np.array([row_key is not None for row_key in self._row_keys])
+                centroids = train_kmeans(live[alive], nlist, iterations=iterations, seed=seed)
+                self.trained_on = len(self._rows)
+            self.centroids = l2_normalize(centroids)
+            self._assign[:self._used] = assign_to_centroids(live, self.centroids)
+            self._publish()
+
+    def _ivf_lists(self):
+        labels = self._assign[:self._used]
+        order = np.argsort(labels, kind="stable").astype(np.int32)
+        bounds = np.searchsorted(labels[order], np.arange(len(self.centroids) + 1))
+        return tuple(order[bounds[c]:bounds[c + 1]] for c in range(len(self.centroids)))
+
+    # ---------- queries ----------
+    def search(self, query, k=10, min_score=None, nprobe=None, exact=False):
+        """Top-k items by cosine similarity → [(item_id, score)], best first"""
+        view = self._view
+        matrix, owners = view["matrix"], view["owners"]
+        if not len(owners) or k <= 0:
+            return []
+        query = l2_normalize(np.asarray(query).ravel())
+        if query.shape[0] != matrix.shape[1]:
+            raise ValueError(f"Query has {query.shape[0]} dimensions, index has {matrix.shape[1]}")
+
+        lists = view["lists"]
+        nprobe = nprobe or self.nprobe
+        if lists is None or exact or nprobe >= len(lists):
+            rows = None
+            scores = matrix @ query
+            scores[view["dead"]] = -np.inf
+        else:
+            centroid_scores = view["centroids"] @ query
+            probes = np.argpartition(-centroid_scores, nprobe - 1)[:nprobe]
+            rows = np.concatenate([lists[c] for c in probes])
+            scores = matrix[rows] @ query
+            scores[view["dead"][rows]] = -np.inf
+
+        # An item's best row can rank no lower than k * (rows per item), so
+        # partitioning that many rows is enough to find the top-k distinct items.
+        take = min(len(scores), k * max(view["per_item"], 1))
+        if not take:
+            return []
+        top = np.argpartition(-scores, take - 1)[:take] if take < len(scores) else np.arange(len(scores))
+        top = top[np.argsort(-scores[top])]
+
+        results, seen = [], set()
+        for n in top:
+            score = float(scores[n])
+            item_id = owners[n if rows is None else rows[n]]
+            if item_id is None or score == -np.inf or (min_score is not None and score < min_score):
+                break
+            if item_id in seen:
+                continue
+            seen.add(item_id)
+            results.append((item_id, score))
+            if len(results) == k:
+                break
+        return results
+
+    # ---------- incremental updates ----------
+    def upsert(self, item_id, embedding_key, vector):
+        """Add or replace one embedding of an item"""
+        vector = l2_normalize(np.asarray(vector).ravel())
+        with self._lock:
+            if self.dim is None:
+                self.dim = vector.shape[0]
+                self._buffer = np.zeros((64, self.dim), dtype=np.float32)
+            if vector.shape[0] != self.dim:
+                raise ValueError(f"Vector has {vector.shape[0]} dimensions, index has {self.dim}")
+
+            self._kill((item_id, embedding_key))
+            if self._used == len(self._buffer):
+                self._grow()
+            # Row beyond the published view: invisible to readers until _publish
+            self._buffer[self._used] = vector
+            if self.centroids is not None:
+                self._assign[self._used] = int(np.argmax(self.centroids @ vector))
+            self._rows[(item_id, embedding_key)] = self._used
+            self._row_keys.append((item_id, embedding_key))
+            self._used += 1
+            self._publish()
+
+    def remove_item(self, item_id):
+        with self._lock:
+            for row_key in [rk for rk in self._rows if rk[0] == item_id]:
+                self._kill(row_key)
+            self._publish()
+
+    def _kill(self, row_key):
+        row = self._rows.pop(row_key, None)
+        if row is not None:
+            self._row_keys[row] = None
+            self._dead += 1
+
+    def _grow(self):
+        """Move live rows into a new buffer (compacts dead rows, doubles if still full)"""
+        live = [n for n, row_key in enumerate(self._row_keys) if row_key is not None]
+        capacity = max(64, len(self._buffer) * (2 if len(live) * 2 > len(self._buffer) else 1))
+        buffer = np.zeros((capacity, self.dim), dtype=np.float32)
+        buffer[:len(live)] = self._buffer[live]
+        assign = np.zeros(capacity, dtype=np.int32)
+        assign[:len(live)] = self._assign[live]
+        self._row_keys = [self._row_keys[n] for n in live]
+        self._rows = {row_key: n for n, row_key in enumerate(self._row_keys)}
+        self._buffer = buffer
+        self._assign = assign
+        self._used = len(live)
+        self._dead = 0
+
+    def _publish(self):
+        owners = [row_key[0] if row_key else None for row_key in self._row_keys]
+        counts = {}
+        for item_id in owners:
+            if item_id is not None:
+                counts[item_id] = counts.get(item_id, 0) + 1
+        self._view = {
+            "matrix": self._buffer[:self._used] if self._buffer is not None else np.zeros((0, 0), dtype=np.float32),
+            "owners": owners,
+            "dead": np.fromiter((item_id is None for item_id in owners), dtype=bool, count=len(owners)),
+            "per_item": max(counts.values(), default=0),
+            "centroids": self.centroids,
+            "lists": self._ivf_lists() if self.centroids is not None else None
+        }
+
+    # ---------- persistence ----------
+    def save(self, path, include_vectors=True):
+        """Write the index (or only its trained quantiser) to an .npz file"""
+        with self._lock:
+            live = [n for n, row_key in enumerate(self._row_keys) if row_key is not None] if include_vectors else []
+            dim = self.dim or 0
+            np.savez(
+                path,
+                vectors=self._buffer[live] if live else np.zeros((0, dim), dtype=np.float32),
+                item_ids=np.array([self._row_keys[n][0] for n in live], dtype=str),
+                embedding_keys=np.array([self._row_keys[n][1] for n in live], dtype=str),
+                centroids=self.centroids if self.centroids is not None else np.zeros((0, dim), dtype=np.float32),
+                meta=np.array([dim, self.nprobe, self.trained_on], dtype=np.int64)
+            )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            dim, nprobe, trained_on = (int(v) for v in data["meta"])
+            index = cls.from_rows(zip(data["item_ids"].tolist(), data["embedding_keys"].tolist(), data["vectors"]),
+                                  nprobe=nprobe)
+            if index.dim is None and dim:
+                index = cls(dim=dim, nprobe=nprobe)
+            if len(data["centroids"]):
+                index.centroids = data["centroids"].astype(np.float32)
+                index.trained_on = trained_on
+                if len(index):
+                    index.build_ivf(centroids=index.centroids)
+                    index.trained_on = trained_on
+        return index
+
+    def stats(self):
+        view = self._view
+        lists = view["lists"]
+        return {
+            "vectors": len(self._rows),
+            "items": len({o for o in view["owners"] if o is not None}),
+            "dim": self.dim,
+            "dead_rows": self._dead,
+            "matrix_mb": round(view["matrix"].nbytes / (1024 * 1024), 3),
+            "max_vectors_per_item": view["per_item"],
+            "ivf_lists": len(lists) if lists is not None else None,
+            "nprobe": self.nprobe if lists is not None else None
+        }
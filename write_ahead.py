@@ -0,0 +1,193 @@
+"""
+Durable write-behind queue for bookkeeping documents (receipts, audit logs).
+
+append() writes the records to a local append-only log and fsyncs it before
+returning, so a record survives a crash once the caller has it. A background
+thread flushes pending records to the store in bulk and truncates the log
+once everything in it is stored. On start, logs left behind by dead processes
+(or a previous run) are replayed. Flushes use set() semantics, so replaying a
+record that was already stored is harmless.
+
+Each process logs to its own file (`<prefix>-<pid>.log`) inside `directory`,
+so several gunicorn workers can share the directory. `directory` must be an
+absolute path on storage that outlives the process: a relative one would
+depend on the working directory the server happens to start in.
+"""
+import glob
+import json
+import os
+import threading
+import time
+from collections import deque
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class WriteAheadQueue:
+    """
+    write_batch(records) stores a list of {"path": ..., "data": ...} records
+    (at most max_batch per call) and raises on failure; failed records stay
+    queued and are retried with backoff.
+    """
+
+    def __init__(self, directory, write_batch, prefix="records", max_batch=500,
+                 flush_interval=0.5, max_backoff=30.0, encode_default=str):
+        if not directory or not os.path.isabs(directory):
+            raise ValueError(f"write-ahead directory must be an absolute path, got {directory!r}")
+        self.directory = directory
+        self.write_batch = write_batch
+        self.prefix = prefix
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.max_backoff = max_backoff
+        self.encode_default = encode_default
+
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._pending = deque()      # records not yet stored
+        self._pending_paths = {}     # path -> count of pending records for it
+        self._replay_files = []      # claimed logs of dead processes, deleted once flushed
+        self._file = None
+        self._pid = None
+        self._thread = None
+        self.counters = {"appended": 0, "replayed": 0, "flushed": 0, "flushes": 0, "flush_failures": 0,
+                         "last_flush_ms": None, "last_error": None}
+
+    # ---------- lifecycle ----------
+    def start(self):
+        """Open this process' log, replay orphaned logs, start the writer (idempotent, fork-safe)"""
+        if self._thread and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread and self._pid == os.getpid():
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            self._pid = os.getpid()
+            self._pending.clear()
+            self._pending_paths.clear()
+            self._replay_orphans()
+            self._file = open(self._log_path(self._pid), "a", encoding="utf-8")
+            self._thread = threading.Thread(target=self._run, name=f"{self.prefix}-writer", daemon=True)
+            self._thread.start()
+
+    def _log_path(self, pid):
+        return os.path.join(self.directory, f"{self.prefix}-{pid}.log")
+
+    def _replay_orphans(self):
+        """Claim logs whose process is gone (including our own pid from a previous run)"""
+        log_prefix = os.path.join(self.directory, f"{self.prefix}-")
+        claim_prefix = f"{log_prefix}replay-"
+        candidates = []
+        for path in sorted(glob.glob(f"{log_prefix}*.log")):
+            owner = path[len(log_prefix):-len(".log")]
+            candidates.append((path, owner))
+        # claims of a worker that died while replaying
+        for path in sorted(glob.glob(f"{claim_prefix}*.claim")):
+            candidates.append((path, path[len(claim_prefix):].split("-")[0]))
+
+        for path, owner in candidates:
+            if owner.isdigit() and int(owner) != self._pid and _pid_alive(int(owner)):
+                continue
+            claimed = f"{claim_prefix}{self._pid}-{time.time_ns()}.claim"
+            try:
+                os.rename(path, claimed)  # atomic: only one worker claims a log
+            except OSError:
+                continue
+            self._load(claimed)
+
+    def _load(self, path):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                    self._pending.append(record)
+                    self._track(record, +1)
+                    self.counters["replayed"] += 1
+                except ValueError:
+                    pass  # torn last line of a crashed write: it was never acknowledged
+        self._replay_files.append(path)
+
+    def _track(self, record, delta):
+        """Count pending records per path (caller holds the lock)"""
+        path = record.get("path")
+        count = self._pending_paths.get(path, 0) + delta
+        if count > 0:
+            self._pending_paths[path] = count
+        else:
+            self._pending_paths.pop(path, None)
+
+    # ---------- producer side ----------
+    def append(self, records):
+        """Durably log records (fsync) and queue them for the background flush"""
+        self.start()
+        lines = "".join(json.dumps(r, default=self.encode_default, separators=(",", ":")) + "\n" for r in records)
+        with self._lock:
+            self._file.write(lines)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._pending.extend(records)
+            for record in records:
+                self._track(record, +1)
+            self.counters["appended"] += len(records)
+        if len(self._pending) >= self.max_batch:
+            self._wake.set()
+
+    # ---------- writer side ----------
+    def _run(self):
+        backoff = self.flush_interval
+        while True:
+            self._wake.wait(backoff)
+            self._wake.clear()
+            try:
+                self.flush()
+                backoff = self.flush_interval
+            except Exception as e:
+                with self._lock:
+                    self.counters["flush_failures"] += 1
+                    self.counters["last_error"] = str(e)
+                backoff = min(max(backoff * 2, 1.0), self.max_backoff)
+
+    def flush(self):
+        """Store everything pending, max_batch records per write; truncate the log when drained"""
+        while True:
+            with self._lock:
+                chunk = [self._pending[i] for i in range(min(self.max_batch, len(self._pending)))]
+            if not chunk:
+                return
+
+            start = time.time()
+            self.write_batch(chunk)  # raises → records stay pending
+
+            with self._lock:
+                for _ in chunk:
+                    self._track(self._pending.popleft(), -1)
+                self.counters["flushed"] += len(chunk)
+                self.counters["flushes"] += 1
+                self.counters["last_flush_ms"] = round((time.time() - start) * 1000, 2)
+                if not self._pending:
+                    # Everything logged so far is stored: start the logs over
+                    self._file.truncate(0)
+                    self._file.seek(0)
+                    for path in self._replay_files:
+                        try:
+                            os.remove(path)
+                        except OSError:
+                            pass
+                    self._replay_files = []
+
+    def is_pending(self, path):
+        """True while a record for path is logged here but not yet stored"""
+        with self._lock:
+            return path in self._pending_paths
+
+    def stats(self):
+        with self._lock:
+            return {**self.counters, "pending": len(self._pending), "directory": self.directory}